@@ -23,8 +23,9 @@ class ReviewInline(admin.StackedInline):
 
 
 class TitleAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name', 'year', 'category', 'get_genres')
+    list_display = ('id', 'name', 'year', 'category', 'get_genres', 'rating')
     search_fields = ('name',)
+    readonly_fields = ('rating', 'review_count', 'score_sum')  # поддерживаются сигналами Review
     list_filter = ('year', 'category', 'genre')
     inlines = [ReviewInline]  # дополнительно выводятся отзывы к произведению
     save_on_top = True  # добавление панели сохранения в верхнюю часть страницы
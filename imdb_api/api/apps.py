@@ -4,3 +4,15 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from django.core.signals import request_finished, request_started
+        from django.db.backends.signals import connection_created
+        from . import checks, signals  # noqa: F401
+        from .metrics import install_db_wrapper
+        from .utils.pools import check_connections, count_connection, mark_idle
+        connection_created.connect(install_db_wrapper, dispatch_uid='api.metrics.install_db_wrapper')
+        connection_created.connect(count_connection, dispatch_uid='api.utils.pools.count_connection')
+        # после close_old_connections Django, который подключен к этим же сигналам раньше
+        request_started.connect(check_connections, dispatch_uid='api.utils.pools.check_connections')
+        request_finished.connect(mark_idle, dispatch_uid='api.utils.pools.mark_idle')
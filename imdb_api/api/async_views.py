@@ -0,0 +1,81 @@
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from rest_framework.response import Response
+from .metrics import record_cache
+from .utils.pools import check_connections, mark_idle
+from .utils.cache_functions import get_cached_entry, not_modified, set_validators
+
+
+def _render(response):
+    # отложенный рендеринг DRF выполняется в потоке view, а не в event loop
+    if hasattr(response, 'render') and not response.is_rendered:
+        response.render()
+    return response
+
+
+def _prepare_connections():
+    # соединения с БД локальны для потока пула, поэтому сигналы запроса их не касаются
+    close_old_connections()
+    check_connections()
+
+
+def _release_connections():
+    close_old_connections()
+    mark_idle()
+
+
+def _dispatch(view, request, args, kwargs):
+    _prepare_connections()
+    try:
+        return _render(view(request, *args, **kwargs))
+    finally:
+        _release_connections()
+
+
+def _dispatch_cached(view, request, entry, args, kwargs):
+    """
+    Ответ из кэша: аутентификация, права и лимиты запросов проверяются как в APIView.dispatch,
+    но queryset и сериализатор не выполняются. ETag и Last-Modified - по версиям тегов записи,
+    как в conditional_response
+    """
+    versions, data = entry
+    _prepare_connections()
+    try:
+        self = view.view_class(**view.view_initkwargs)
+        self.args, self.kwargs = args, kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+        try:
+            self.initial(request, *args, **kwargs)
+            record_cache('hit')
+            response = set_validators(not_modified(request, versions) or Response(data), versions)
+        except Exception as exc:
+            response = self.handle_exception(exc)
+        return _render(self.finalize_response(request, response, *args, **kwargs))
+    finally:
+        _release_connections()
+
+
+def async_view(view):
+    """
+    Асинхронная обертка DRF view для ASGI.
+    В Django 3.2 нет асинхронного ORM, поэтому view выполняется в общем пуле потоков
+    (thread_sensitive=False), а не в единственном потоке синхронных view, и запросы не ждут друг друга.
+    Закэшированный ответ (CACHE_KEY_PREFIX) читается асинхронным клиентом Redis без занятия потока
+    """
+    key_prefix = getattr(view.view_class, 'CACHE_KEY_PREFIX', None)
+    dispatch = sync_to_async(_dispatch, thread_sensitive=False)
+    dispatch_cached = sync_to_async(_dispatch_cached, thread_sensitive=False)
+
+    # wraps переносит view_class и csrf_exempt из DRF view
+    @wraps(view)
+    async def handler(request, *args, **kwargs):
+        if key_prefix and request.method == 'GET':
+            entry = await get_cached_entry(request, key_prefix)
+            if entry is not None:
+                return await dispatch_cached(view, request, entry, args, kwargs)
+        return await dispatch(view, request, args, kwargs)
+
+    return handler
@@ -0,0 +1,58 @@
+from django.db import router
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+from users.models import User
+from .utils.reference_cache import AUTH_TOKENS, AUTH_USERS
+
+
+def cached_user(pk):
+    """
+    Пользователь из AUTH_USERS без запроса к БД или None.
+    Отложено (deferred) только поле password: хэш пароля не хранится в кэше
+    """
+    values = AUTH_USERS.get(pk)
+    if values is None:
+        return None
+    # from_db ожидает значения в порядке полей модели
+    names = [field.attname for field in User._meta.concrete_fields if field.attname in values]
+    return User.from_db(router.db_for_read(User), names, [values[name] for name in names])
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWT проверяется без состояния (подпись и срок действия), пользователь берется из AUTH_USERS
+    (USER_ID_FIELD = 'id', значение simplejwt по умолчанию)
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_('Token contained no recognizable user identification'))
+
+        user = cached_user(user_id)
+        if user is None:
+            raise AuthenticationFailed(_('User not found'), code='user_not_found')
+        if not user.is_active:
+            raise AuthenticationFailed(_('User is inactive'), code='user_inactive')
+        return user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Токен DRF и его пользователь из AUTH_TOKENS и AUTH_USERS, без select_related по таблице токенов
+    """
+
+    def authenticate_credentials(self, key):
+        user_id = AUTH_TOKENS.get(key)
+        user = cached_user(user_id) if user_id is not None else None
+        if user is None:
+            raise AuthenticationFailed(_('Invalid token.'))
+        if not user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+        return user, Token.from_db(router.db_for_read(Token), ['key', 'user_id'], [key, user_id])
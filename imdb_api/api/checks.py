@@ -0,0 +1,19 @@
+import math
+from django.conf import settings
+from django.core.checks import Error, register
+
+
+@register()
+def check_ranking_settings(app_configs, **kwargs):
+    """
+    RANKING_TRENDING_HALF_LIFE - делитель в trending_weight: ноль или отрицательный период
+    ломает запись отзывов (сигналы TitleRanking)
+    """
+    half_life = getattr(settings, 'RANKING_TRENDING_HALF_LIFE', None)
+    if isinstance(half_life, (int, float)) and not isinstance(half_life, bool) and 0 < half_life < math.inf:
+        return []
+    return [Error(
+        'RANKING_TRENDING_HALF_LIFE must be a positive number of seconds.',
+        hint=f'Got {half_life!r}.',
+        id='api.E001',
+    )]
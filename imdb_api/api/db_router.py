@@ -0,0 +1,150 @@
+import hashlib
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, DEFAULT_DB_ALIAS, connections
+
+# отставание реплики PostgreSQL в секундах; 0, если реплика применила все полученные изменения
+LAG_SQL = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+_lag = {}  # alias -> (время проверки, отставание), отдельно в каждом процессе
+
+
+class RoutingState:
+    """
+    Маршрутизация запросов к БД в рамках одного HTTP-запроса (ReplicaRoutingMiddleware)
+    """
+    __slots__ = ('client', 'safe', 'replica', 'wrote', 'primary', 'pin_cookie')
+
+    def __init__(self, client, safe: bool):
+        self.client = client  # None - анонимный клиент, еще не получивший cookie REPLICA_PIN_COOKIE
+        self.safe = safe
+        self.replica = None  # реплика выбирается один раз на запрос при первом чтении
+        self.wrote = False
+        self.primary = 0  # глубина вложенных блоков primary_reads
+        self.pin_cookie = None  # новое значение REPLICA_PIN_COOKIE, выдаваемое клиенту после записи
+
+
+routing_state: ContextVar = ContextVar('routing_state', default=None)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Чтение из default в пределах блока - для данных, которые сохраняются в кэш: запись кэша живет
+    дольше отставания реплики и иначе хранила бы прежние данные под уже измененными версиями
+    """
+    state = routing_state.get()
+    if state is not None:
+        state.primary += 1
+    try:
+        yield
+    finally:
+        if state is not None:
+            state.primary -= 1
+
+
+def _hash(identity: str) -> str:
+    return hashlib.md5(identity.encode()).hexdigest()
+
+
+def client_key(request):
+    # клиент определяется без обращения к БД: по токену, сессии или cookie REPLICA_PIN_COOKIE.
+    # Адрес не используется: за одним NAT или прокси много клиентов
+    identity = (
+        request.META.get('HTTP_AUTHORIZATION')
+        or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        or request.COOKIES.get(settings.REPLICA_PIN_COOKIE)
+    )
+    return _hash(identity) if identity else None
+
+
+def set_pin_cookie(state: RoutingState, response):
+    # анонимный клиент, записавший данные, читает с default, пока жива cookie
+    if state.pin_cookie:
+        response.set_cookie(
+            settings.REPLICA_PIN_COOKIE, state.pin_cookie, max_age=settings.REPLICA_PIN_SECONDS,
+            httponly=True, samesite='Lax',
+        )
+    return response
+
+
+def _pin_key(client: str) -> str:
+    return f'replica-pin:{client}'
+
+
+def measure_lag(alias: str) -> float:
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        # тестовая замена реплики (SQLite) не реплицируется
+        return 0.0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(LAG_SQL)
+            lag = cursor.fetchone()[0]
+    except DatabaseError:
+        return float('inf')
+    return float(lag or 0)
+
+
+def replica_lag(alias: str) -> float:
+    checked = _lag.get(alias)
+    now = time.monotonic()
+    if checked is None or now - checked[0] >= settings.REPLICA_LAG_CHECK_INTERVAL:
+        checked = _lag[alias] = (now, measure_lag(alias))
+    return checked[1]
+
+
+def healthy_replicas() -> list:
+    return [alias for alias in settings.DATABASE_REPLICAS if replica_lag(alias) <= settings.REPLICA_MAX_LAG]
+
+
+class ReplicaRouter:
+    """
+    Чтение в безопасных (GET, HEAD, OPTIONS) запросах - с реплик DATABASE_REPLICAS, запись - в default.
+    На default остаются: чтение внутри транзакции, после записи в том же запросе и для кэшей
+    (primary_reads), чтение клиента
+    в течение REPLICA_PIN_SECONDS после его записи (read-your-writes) и чтение при отставании
+    всех реплик больше REPLICA_MAX_LAG секунд
+    """
+
+    def db_for_read(self, model, **hints):
+        state = routing_state.get()
+        if state is None:
+            # вне HTTP-запроса (команды, задачи Celery, миграции) - выбор Django по умолчанию
+            return None
+        if not state.safe or state.wrote or state.primary or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        if state.replica is None:
+            replicas = healthy_replicas() if settings.DATABASE_REPLICAS else []
+            pinned = replicas and state.client and cache.get(_pin_key(state.client))
+            state.replica = random.choice(replicas) if replicas and not pinned else DEFAULT_DB_ALIAS
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        state = routing_state.get()
+        if state is None:
+            return None
+        if not state.wrote:
+            state.wrote = True
+            if settings.DATABASE_REPLICAS:
+                if state.client is None:
+                    state.pin_cookie = secrets.token_hex(16)
+                    state.client = _hash(state.pin_cookie)
+                cache.set(_pin_key(state.client), 1, settings.REPLICA_PIN_SECONDS)
+        # объекты, прочитанные с реплики, сохраняются в default
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # реплики содержат те же данные, что и default
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
@@ -7,13 +7,16 @@ class CharFilterInFilter(filters.BaseInFilter, filters.CharFilter):
 
 
 class TitleFilter(filters.FilterSet):
-    name = filters.CharFilter(field_name='name', lookup_expr='icontains')
+    name = filters.CharFilter(method='search_name')
     year = filters.NumberFilter()
     category = filters.CharFilter(
         field_name='category__slug',
         lookup_expr='exact')
-    genre = CharFilterInFilter(field_name='genre__slug', lookup_expr='in')
+    genre = CharFilterInFilter(field_name='genre__slug', lookup_expr='in', distinct=True)
 
     class Meta:
         models = Title
         fields = ['category', 'year', 'name', 'genre']
+
+    def search_name(self, queryset, name, value):
+        return queryset.search(value)
@@ -0,0 +1,351 @@
+import asyncio
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import nullcontext
+from itertools import count
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, connections
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from rest_framework.views import APIView
+from rest_framework_simplejwt.tokens import AccessToken
+from api.models import Category, Genre, Title, Review, Comment
+from users.models import User
+
+GENRES = 20
+CATEGORIES = 10
+BATCH_SIZE = 10000
+
+
+def volume(value: str) -> int:
+    """
+    Объем данных: 10000, 10k, 1M
+    """
+    match = re.fullmatch(r'(\d+)([kKmM]?)', value)
+    if not match:
+        raise ValueError(value)
+    return int(match.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[match.group(2).lower()]
+
+
+def percentile(values: list, percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def server_timing_queries(headers):
+    # количество запросов к БД из заголовка Server-Timing (METRICS_SERVER_TIMING)
+    match = re.search(r'(\d+) queries', headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def benchmark_caches(stdout):
+    """
+    Кэш на время прогона: без REDIS_HOST настройки CACHES указывают на несуществующий Redis,
+    поэтому используется локальный кэш процесса
+    """
+    if settings.REDIS_HOST:
+        return nullcontext()
+    stdout.write('REDIS_HOST is not set, using the local memory cache')
+    return override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+
+
+class Dataset:
+    """
+    Синтетический каталог с явными id: связи вычисляются арифметически, без чтения из БД.
+    Отзыв i: произведение i % titles + 1, автор i // titles + 1 (пара title-author уникальна)
+    """
+
+    def __init__(self, titles: int, reviews: int, comments: int):
+        self.titles = titles
+        self.reviews = reviews
+        self.comments = comments
+        self.authors = max(1, math.ceil(reviews / titles))
+
+    def review_title(self, review_id: int) -> int:
+        return (review_id - 1) % self.titles + 1
+
+    def seed(self, stdout):
+        Category.objects.bulk_create(
+            Category(pk=i, name=f'category {i}', slug=f'category-{i}') for i in range(1, CATEGORIES + 1))
+        Genre.objects.bulk_create(Genre(pk=i, name=f'genre {i}', slug=f'genre-{i}') for i in range(1, GENRES + 1))
+        self.insert(User, self.authors, lambda i: User(pk=i, username=f'bench-{i}', email=f'bench-{i}@example.com'))
+        self.insert(Title, self.titles, lambda i: Title(
+            pk=i, name=f'title {i}', year=1900 + i % 120, category_id=i % CATEGORIES + 1))
+        self.insert(Title.genre.through, self.titles, lambda i: Title.genre.through(
+            title_id=i, genre_id=i % GENRES + 1))
+        self.insert(Review, self.reviews, lambda i: Review(
+            pk=i, text=f'review {i}', title_id=self.review_title(i), author_id=(i - 1) // self.titles + 1,
+            score=i % 10 + 1))
+        self.insert(Comment, self.comments, lambda i: Comment(
+            pk=i, text=f'comment {i}', review_id=(i - 1) % self.reviews + 1, author_id=i % self.authors + 1))
+
+        # bulk_create не отправляет сигналы: пересчитываем денормализованные поля
+        call_command('rebuild_ratings', stdout=stdout)
+        Review.objects.rebuild_comment_count()
+        Title.objects.update_search_vector()
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), [User, Category, Genre, Title, Review, Comment]):
+                cursor.execute(sql)
+            cursor.execute('ANALYZE')
+
+    @staticmethod
+    def insert(model, total: int, build):
+        for start in range(1, total + 1, BATCH_SIZE):
+            model.objects.bulk_create(build(i) for i in range(start, min(start + BATCH_SIZE, total + 1)))
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест эндпоинтов /api/v1 на синтетических данных: '
+            'p50/p99, запросов в секунду и запросов к БД на запрос, сравнение с базовой линией')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=volume, default='10k')
+        parser.add_argument('--reviews', type=volume, default='10k', help='например 10k, 1M, 10M')
+        parser.add_argument('--comments', type=volume, default='10k')
+        parser.add_argument('--requests', type=int, default=200, help='количество запросов на эндпоинт')
+        parser.add_argument('--concurrency', default='1,8', help='уровни параллельности через запятую')
+        parser.add_argument('--endpoints', help='эндпоинты через запятую, по умолчанию все')
+        parser.add_argument('--url', help='адрес запущенного сервера (WSGI / ASGI), по умолчанию Django test client')
+        parser.add_argument('--asgi', action='store_true',
+                            help='запросы через ASGI-обработчик в одном event loop (AsyncClient), '
+                                 'требует ASYNC_VIEWS=yes; сравнение с WSGI: --baseline результатов без --asgi')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='не удалять тестовую БД и не заполнять ее повторно при следующем запуске')
+        parser.add_argument('--baseline', help='JSON с результатами предыдущего запуска для сравнения')
+        parser.add_argument('--save-baseline', help='сохранить результаты в JSON')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='допустимое ухудшение p99 и запросов в секунду относительно базовой линии')
+
+    def handle(self, *args, **options):
+        self.dataset = Dataset(options['titles'], options['reviews'], options['comments'])
+        self.base_url = options['url']
+        if options['asgi'] and not settings.ASYNC_VIEWS:
+            raise CommandError('Run with ASYNC_VIEWS=yes to benchmark the async views.')
+        run = self.run_async if options['asgi'] else self.run
+        endpoints = self.endpoints()
+        if options['endpoints']:
+            endpoints = {name: endpoints[name] for name in options['endpoints'].split(',')}
+        levels = [int(level) for level in options['concurrency'].split(',')]
+
+        # тестовая БД, чтобы не затрагивать рабочие данные; в режиме --url сервер должен смотреть в нее же
+        with benchmark_caches(self.stdout):
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'])
+            try:
+                if not Title.objects.exists():
+                    self.stdout.write(f'Seeding {self.dataset.titles} titles, {self.dataset.reviews} reviews, '
+                                      f'{self.dataset.comments} comments...')
+                    self.dataset.seed(self.stdout)
+                self.token = str(AccessToken.for_user(User.objects.create(
+                    username=f'bench-writer-{time.time_ns()}', email=f'writer-{time.time_ns()}@example.com')))
+
+                results = {}
+                # лимиты запросов отключаются только для test client,
+                # у сервера (--url) они должны быть сняты настройками
+                # Server-Timing нужен для учета запросов к БД, выполняемых в пуле потоков (--asgi)
+                with mock.patch.object(APIView, 'throttle_classes', ()), override_settings(METRICS_SERVER_TIMING=True):
+                    for name, build in endpoints.items():
+                        for level in levels:
+                            results[f'{name}@{level}'] = run(build, options['requests'], level)
+                            self.report(f'{name}@{level}', results[f'{name}@{level}'])
+            finally:
+                connections.close_all()
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+                teardown_test_environment()
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as file:
+                json.dump(results, file, indent=2)
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def endpoints(self) -> dict:
+        dataset = self.dataset
+
+        def title(i):
+            return i % dataset.titles + 1
+
+        def review(i):
+            return i % dataset.reviews + 1
+
+        return {
+            'title-list': lambda i: ('GET', f'/api/v1/titles/?page={i % 10 + 1}', None),
+            'title-filter': lambda i: (
+                'GET', f'/api/v1/titles/?genre=genre-{i % GENRES + 1}&year={1900 + i % 120}', None),
+            'title-detail': lambda i: ('GET', f'/api/v1/titles/{title(i)}/', None),
+            'review-list': lambda i: ('GET', f'/api/v1/titles/{title(i)}/reviews/', None),
+            'review-detail': lambda i: (
+                'GET', f'/api/v1/titles/{dataset.review_title(review(i))}/reviews/{review(i)}/', None),
+            'comment-list': lambda i: (
+                'GET', f'/api/v1/titles/{dataset.review_title(review(i))}/reviews/{review(i)}/comments/', None),
+            'review-create': lambda i: (
+                'POST', f'/api/v1/titles/{title(i)}/reviews/', {'text': 'benchmark', 'score': i % 10 + 1}),
+            'comment-create': lambda i: (
+                'POST', f'/api/v1/titles/{dataset.review_title(review(i))}/reviews/{review(i)}/comments/',
+                {'text': 'benchmark'}),
+        }
+
+    def run(self, build, total: int, concurrency: int) -> dict:
+        counter = count()
+        latencies, queries, errors = [], [], []
+        lock = threading.Lock()
+
+        def worker():
+            client = Client(HTTP_AUTHORIZATION=f'Bearer {self.token}')
+            try:
+                while True:
+                    i = next(counter)
+                    if i >= total:
+                        return
+                    method, path, data = build(i)
+                    try:
+                        elapsed, status, query_count = self.request(client, method, path, data)
+                    except Exception as error:
+                        with lock:
+                            errors.append(repr(error))
+                        continue
+                    with lock:
+                        latencies.append(elapsed)
+                        if query_count is not None:
+                            queries.append(query_count)
+                        if status >= 400 and not (method == 'POST' and status == 400):
+                            errors.append(status)
+            finally:
+                connections.close_all()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.summary(latencies, queries, errors, total, time.perf_counter() - start)
+
+    def run_async(self, build, total: int, concurrency: int) -> dict:
+        return async_to_sync(self.arun)(build, total, concurrency)
+
+    async def arun(self, build, total: int, concurrency: int) -> dict:
+        """
+        concurrency одновременных запросов в одном event loop, как в одном процессе ASGI-сервера
+        """
+        counter = count()
+        latencies, queries, errors = [], [], []
+        client = AsyncClient()
+        # в Django 3.2 AsyncClient передает дополнительные аргументы запроса как заголовки ASGI
+        headers = {'authorization': f'Bearer {self.token}'}
+
+        async def worker():
+            while True:
+                i = next(counter)
+                if i >= total:
+                    return
+                method, path, data = build(i)
+                start = time.perf_counter()
+                try:
+                    if method == 'GET':
+                        response = await client.get(path, **headers)
+                    else:
+                        response = await client.post(path, data, content_type='application/json', **headers)
+                except Exception as error:
+                    errors.append(repr(error))
+                    continue
+                latencies.append(time.perf_counter() - start)
+                query_count = server_timing_queries(response)
+                if query_count is not None:
+                    queries.append(query_count)
+                if response.status_code >= 400 and not (method == 'POST' and response.status_code == 400):
+                    errors.append(response.status_code)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return self.summary(latencies, queries, errors, total, time.perf_counter() - start)
+
+    @staticmethod
+    def summary(latencies: list, queries: list, errors: list, total: int, duration: float) -> dict:
+        if not latencies:
+            raise CommandError(f'All requests failed: {errors[0]}')
+
+        return {
+            'p50': percentile(latencies, 50) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'rps': total / duration,
+            'queries': sum(queries) / len(queries) if queries else None,
+            'errors': len(errors),
+        }
+
+    def request(self, client, method: str, path: str, data):
+        if self.base_url:
+            return self.http_request(method, path, data)
+
+        query_count = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal query_count
+            query_count += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            if method == 'GET':
+                response = client.get(path)
+            else:
+                response = client.post(path, data, content_type='application/json')
+        return time.perf_counter() - start, response.status_code, query_count
+
+    def http_request(self, method: str, path: str, data):
+        body = json.dumps(data).encode() if data is not None else None
+        request = urllib.request.Request(self.base_url.rstrip('/') + path, data=body, method=method, headers={
+            'Authorization': f'Bearer {self.token}', 'Content-Type': 'application/json',
+        })
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            status, headers = error.code, error.headers
+        elapsed = time.perf_counter() - start
+        # на сервере должен быть включен METRICS_SERVER_TIMING
+        return elapsed, status, server_timing_queries(headers)
+
+    def report(self, name: str, result: dict):
+        queries = f'{result["queries"]:.1f}' if result['queries'] is not None else '-'
+        self.stdout.write(
+            f'{name:<24} p50 {result["p50"]:8.2f} ms  p99 {result["p99"]:8.2f} ms  '
+            f'{result["rps"]:9.1f} req/s  {queries:>6} queries/req  {result["errors"]} errors'
+        )
+
+    def compare(self, results: dict, baseline_path: str, tolerance: float):
+        if not os.path.exists(baseline_path):
+            raise CommandError(f'Baseline {baseline_path} does not exist.')
+        with open(baseline_path) as file:
+            baseline = json.load(file)
+
+        regressions = []
+        for name, result in results.items():
+            base = baseline.get(name)
+            if base is None:
+                continue
+            self.stdout.write(
+                f'{name:<24} p99 x{result["p99"] / base["p99"]:.2f}  req/s x{result["rps"] / base["rps"]:.2f}')
+            if result['p99'] > base['p99'] * (1 + tolerance):
+                regressions.append(f'{name}: p99 {result["p99"]:.2f} ms > {base["p99"]:.2f} ms')
+            if result['rps'] < base['rps'] * (1 - tolerance):
+                regressions.append(f'{name}: {result["rps"]:.1f} req/s < {base["rps"]:.1f} req/s')
+            if None not in (result['queries'], base.get('queries')) and (
+                    round(result['queries'], 1) > round(base['queries'], 1)):
+                regressions.append(f'{name}: {result["queries"]:.1f} queries/req > {base["queries"]:.1f}')
+        if regressions:
+            raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+        self.stdout.write(self.style.SUCCESS('No regressions against baseline'))
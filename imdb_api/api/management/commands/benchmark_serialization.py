@@ -0,0 +1,80 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import setup_test_environment, teardown_test_environment
+from rest_framework.renderers import JSONRenderer
+from api.models import Title, Review, Comment
+from api.renderers import FastJSONRenderer
+from api.serializer import TitleReadSerializer, ReviewReadSerializer, CommentSerializer
+from .benchmark import Dataset, benchmark_caches, volume
+
+SERIALIZERS = {
+    'titles': (Title, TitleReadSerializer),
+    'reviews': (Review, ReviewReadSerializer),
+    'comments': (Comment, CommentSerializer),
+}
+
+
+def timed(func, repeat: int) -> float:
+    # медиана времени вызова, мс
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations) * 1000
+
+
+class Command(BaseCommand):
+    help = ('Сравнение сериализации страницы списка: модели + ModelSerializer + JSONRenderer '
+            'и values_list + to_representation_rows + FastJSONRenderer (чтение страницы из БД включено). '
+            'Ответы обоих режимов должны совпадать байт в байт')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--titles', type=volume, default='1k')
+        parser.add_argument('--reviews', type=volume, default='1k')
+        parser.add_argument('--comments', type=volume, default='1k')
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--repeat', type=int, default=50, help='количество замеров на режим')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='не удалять тестовую БД и не заполнять ее повторно при следующем запуске')
+
+    def handle(self, *args, **options):
+        dataset = Dataset(options['titles'], options['reviews'], options['comments'])
+        with benchmark_caches(self.stdout):
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'])
+            try:
+                if not Title.objects.exists():
+                    self.stdout.write(f'Seeding {dataset.titles} titles, {dataset.reviews} reviews, '
+                                      f'{dataset.comments} comments...')
+                    dataset.seed(self.stdout)
+                for name, (model, serializer_class) in SERIALIZERS.items():
+                    self.compare(name, model, serializer_class, options['page_size'], options['repeat'])
+            finally:
+                connections.close_all()
+                connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+                teardown_test_environment()
+
+    def compare(self, name: str, model, serializer_class, page_size: int, repeat: int):
+        meta = serializer_class.Meta
+        queryset = model.objects.order_by('-id')
+
+        def models():
+            page = queryset.select_related(*meta.select_related).prefetch_related(
+                *getattr(meta, 'prefetch_related', ()))[:page_size]
+            return JSONRenderer().render(serializer_class(page, many=True).data)
+
+        def values():
+            serializer = serializer_class()
+            rows = list(serializer.values_queryset(queryset)[:page_size])
+            return FastJSONRenderer().render(serializer.to_representation_rows(rows))
+
+        if models() != values():
+            raise CommandError(f'{name}: values serialization output differs from the model serializer.')
+        models_time, values_time = timed(models, repeat), timed(values, repeat)
+        self.stdout.write(
+            f'{name:<10} models {models_time:8.2f} ms  values {values_time:8.2f} ms  '
+            f'x{models_time / values_time:.1f}  ({page_size} rows/page)'
+        )
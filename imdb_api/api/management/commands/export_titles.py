@@ -0,0 +1,32 @@
+import sys
+from django.core.management.base import BaseCommand
+from api.filters import TitleFilter
+from api.models import Title
+from api.utils.export import export_titles, EXPORT_FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Потоковая выгрузка каталога произведений с категорией, жанрами и рейтингом в NDJSON / CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS.keys(), default='ndjson')
+        parser.add_argument('--output', help='путь к файлу, по умолчанию stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+        # фильтры TitleFilter
+        parser.add_argument('--name')
+        parser.add_argument('--year')
+        parser.add_argument('--category')
+        parser.add_argument('--genre', help='слаги жанров через запятую')
+
+    def handle(self, *args, **options):
+        filters = {key: options[key] for key in TitleFilter.Meta.fields if options.get(key)}
+        queryset = TitleFilter(data=filters, queryset=Title.objects.all()).qs
+        rows = export_titles(queryset, chunk_size=options['chunk_size'])
+
+        output = open(options['output'], 'w', encoding='utf-8', newline='') if options['output'] else sys.stdout
+        try:
+            for line in EXPORT_FORMATS[options['format']](rows):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
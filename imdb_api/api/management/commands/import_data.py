@@ -0,0 +1,279 @@
+import csv
+import json
+import os
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import Pool
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from api.models import Category, Genre, Title, TitleRanking, Review
+from api.utils.cache_functions import (
+    invalidate_tags, title_tag, category_tag, genre_tag, TITLES_TAG, CATEGORIES_TAG, GENRES_TAG)
+from users.models import User
+
+FORMATS = ('csv', 'jsonl')
+
+
+def read_rows(path: str, file_format: str):
+    """
+    Потоковое чтение файла: в памяти находится только текущая строка
+    """
+    with open(path, encoding='utf-8', newline='') as file:
+        if file_format == 'csv':
+            yield from csv.DictReader(file)
+        else:
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def chunked(rows, size: int):
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+@lru_cache(maxsize=None)
+def slug_map(model) -> dict:
+    # справочники небольшие, загружаются один раз на процесс
+    return dict(model.objects.values_list('slug', 'pk'))
+
+
+def resolve_slug(model, slug: str) -> int:
+    try:
+        return slug_map(model)[slug]
+    except KeyError:
+        raise CommandError(f'{model.__name__} with slug "{slug}" does not exist.')
+
+
+def split_slugs(value) -> list:
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [slug.strip() for slug in value if slug.strip()]
+
+
+def import_categories(rows: list) -> int:
+    Category.objects.bulk_create(Category(name=row['name'], slug=row['slug']) for row in rows)
+    invalidate_tags(CATEGORIES_TAG, *[category_tag(row['slug']) for row in rows])
+    return len(rows)
+
+
+def import_genres(rows: list) -> int:
+    Genre.objects.bulk_create(Genre(name=row['name'], slug=row['slug']) for row in rows)
+    invalidate_tags(GENRES_TAG, *[genre_tag(row['slug']) for row in rows])
+    return len(rows)
+
+
+def import_titles(rows: list) -> int:
+    titles = [
+        Title(
+            pk=int(row['id']) if row.get('id') else None,
+            name=row['name'],
+            year=int(row['year']),
+            category_id=resolve_slug(Category, row['category']) if row.get('category') else None,
+        )
+        for row in rows
+    ]
+    Title.objects.bulk_create(titles)
+
+    # связи M2M записываются в промежуточную таблицу одним bulk_create
+    through = Title.genre.through
+    links = []
+    for title, row in zip(titles, rows):
+        slugs = split_slugs(row.get('genre'))
+        if slugs and title.pk is None:
+            raise CommandError('Title ids are required to import genres on this database backend.')
+        links += [through(title_id=title.pk, genre_id=resolve_slug(Genre, slug)) for slug in slugs]
+    through.objects.bulk_create(links)
+    Title.objects.filter(pk__in=[title.pk for title in titles if title.pk]).update_search_vector()
+    TitleRanking.objects.sync(title.pk for title in titles if title.pk)
+
+    invalidate_tags(TITLES_TAG, *{category_tag(row['category']) for row in rows if row.get('category')})
+    return len(rows)
+
+
+def import_reviews(rows: list) -> int:
+    usernames = {row['author'] for row in rows}
+    authors = dict(User.objects.filter(username__in=usernames).values_list('username', 'pk'))
+    missing = usernames - authors.keys()
+    if missing:
+        raise CommandError(f'Users do not exist: {", ".join(sorted(missing))}.')
+    Review.objects.bulk_create(
+        Review(text=row['text'], title_id=int(row['title']), author_id=authors[row['author']], score=int(row['score']))
+        for row in rows
+    )
+    return len(rows)
+
+
+def rebuild_titles(title_ids, batch_size: int = 1000):
+    """
+    Пересчет рейтинга и TitleRanking произведений после записи отзывов (bulk_create не отправляет сигналы).
+    Выполняется одним процессом после записи чанков: пересчеты одного произведения в параллельных
+    транзакциях не видят отзывы друг друга и конфликтуют по уникальности TitleRanking
+    """
+    title_ids = sorted(title_ids)
+    for start in range(0, len(title_ids), batch_size):
+        batch = title_ids[start:start + batch_size]
+        with transaction.atomic():
+            Title.objects.filter(pk__in=batch).lock()
+            Title.objects.filter(pk__in=batch).rebuild_rating()
+            TitleRanking.objects.sync(batch)
+            invalidate_tags(*[title_tag(pk) for pk in batch])
+
+
+IMPORTERS = {
+    'categories': import_categories,
+    'genres': import_genres,
+    'titles': import_titles,
+    'reviews': import_reviews,
+}
+
+
+def affected_titles(kind: str, rows: list) -> set:
+    # произведения, производные поля которых пересчитываются после записи чанка
+    return {int(row['title']) for row in rows} if kind == 'reviews' else set()
+
+
+def import_chunk(kind: str, rows: list) -> int:
+    with transaction.atomic():
+        return IMPORTERS[kind](rows)
+
+
+def import_chunk_worker(args) -> tuple:
+    """
+    Запись чанка с результатом (смещение, строки, затронутые произведения, ошибка):
+    ошибка одного чанка не скрывает остальные чанки волны, уже закоммиченные другими процессами
+    """
+    offset, kind, rows = args
+    try:
+        return offset, import_chunk(kind, rows), affected_titles(kind, rows), None
+    except Exception as exc:
+        return offset, 0, set(), f'{type(exc).__name__}: {exc}'
+
+
+def offset_chunks(rows, size: int, start: int):
+    # чанки вместе с номером первой строки в файле
+    for chunk in chunked(rows, size):
+        yield start, chunk
+        start += len(chunk)
+
+
+def close_connections():
+    # дочерние процессы не должны использовать соединение с БД родительского процесса
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Массовый импорт категорий, жанров, произведений и отзывов из CSV / JSONL файла'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=IMPORTERS.keys())
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=FORMATS,
+                            help='формат файла, по умолчанию определяется по расширению')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='количество строк, записываемых в одной транзакции')
+        parser.add_argument('--resume', action='store_true',
+                            help='продолжить импорт с последней сохраненной контрольной точки')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='количество параллельных процессов записи')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        file_format = options['format'] or os.path.splitext(path)[1].lstrip('.')
+        if file_format not in FORMATS:
+            raise CommandError(f'Unknown file format "{file_format}", use --format.')
+        kind = options['kind']
+        workers = options['workers']
+        batch_size = options['batch_size']
+
+        checkpoint_path = f'{path}.checkpoint'
+        state = {'rows': 0, 'batch_size': batch_size, 'committed': [], 'rebuild': []}
+        if options['resume'] and os.path.exists(checkpoint_path):
+            state = self.load_checkpoint(checkpoint_path, batch_size)
+        if state['rebuild']:
+            # пересчет, прерванный в прошлом запуске
+            rebuild_titles(state['rebuild'])
+            state['rebuild'] = []
+            self.checkpoint(checkpoint_path, state)
+
+        rows = islice(read_rows(path, file_format), state['rows'], None)
+        # чанки отправляются волнами, чтобы не читать весь файл в память
+        waves = chunked(offset_chunks(rows, batch_size, state['rows']), max(workers, 1) * 2)
+        if workers > 1:
+            close_connections()
+            with Pool(workers, initializer=close_connections) as pool:
+                for wave in waves:
+                    self.import_wave(pool.map, kind, wave, state, checkpoint_path)
+        else:
+            for wave in waves:
+                self.import_wave(map, kind, wave, state, checkpoint_path)
+
+        if kind == 'titles':
+            self.reset_sequences(Title)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(self.style.SUCCESS(f'Imported {state["rows"]} rows into {kind}'))
+
+    def import_wave(self, map_func, kind: str, wave: list, state: dict, checkpoint_path: str):
+        """
+        Запись волны чанков и пересчет затронутых произведений. Закоммиченные чанки сохраняются
+        в контрольной точке до пересчета, поэтому --resume после сбоя не записывает их повторно
+        """
+        committed = set(state['committed'])
+        tasks = [(offset, kind, chunk) for offset, chunk in wave if offset not in committed]
+        errors = []
+        rebuild = set(state['rebuild'])
+        for offset, count, title_ids, error in map_func(import_chunk_worker, tasks):
+            if error is None:
+                committed.add(offset)
+                rebuild.update(title_ids)
+            else:
+                errors.append(f'Rows from {offset + 1}: {error}')
+        state.update(committed=sorted(committed), rebuild=sorted(rebuild))
+        self.checkpoint(checkpoint_path, state)
+
+        if rebuild:
+            rebuild_titles(rebuild)
+        # контрольная точка сдвигается только по непрерывно записанным чанкам
+        for offset, chunk in wave:
+            if offset not in committed:
+                break
+            committed.discard(offset)
+            state['rows'] = offset + len(chunk)
+        state.update(committed=sorted(committed), rebuild=[])
+        self.checkpoint(checkpoint_path, state)
+        if errors:
+            raise CommandError('\n'.join(errors))
+
+    @staticmethod
+    def reset_sequences(*models):
+        # после вставки с явными id последовательность первичного ключа нужно сдвинуть
+        connection = connections['default']
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+
+    @staticmethod
+    def load_checkpoint(checkpoint_path: str, batch_size: int) -> dict:
+        with open(checkpoint_path) as file:
+            state = json.load(file)
+        if state['committed'] and state['batch_size'] != batch_size:
+            # закоммиченные чанки определяются смещениями, которые зависят от размера чанка
+            raise CommandError(f'Resume with --batch-size {state["batch_size"]}.')
+        return state
+
+    @staticmethod
+    def checkpoint(checkpoint_path: str, state: dict):
+        """
+        Контрольная точка: rows - строки начала файла, записанные в закоммиченных транзакциях;
+        committed - номера первых строк чанков после них, уже записанных при сбое параллельного импорта;
+        rebuild - произведения, у которых еще не пересчитаны рейтинг и TitleRanking
+        """
+        with open(checkpoint_path, 'w') as file:
+            json.dump(state, file)
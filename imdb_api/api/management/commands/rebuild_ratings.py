@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from api.models import Title, TitleRanking
+
+
+class Command(BaseCommand):
+    help = ('Пересчет денормализованных рейтингов (rating, review_count, score_sum) '
+            'и материализованных рейтингов TitleRanking всех произведений')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='количество произведений, пересчитываемых в одной транзакции')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_pk = 0
+        updated = 0
+        while True:
+            pks = list(
+                Title.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]
+            )
+            if not pks:
+                break
+            with transaction.atomic():
+                updated += Title.objects.filter(pk__gte=pks[0], pk__lte=pks[-1]).rebuild_rating()
+                TitleRanking.objects.sync(pks)
+            last_pk = pks[-1]
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt ratings for {updated} titles'))
@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+from api.models import Title, Review, SCORES, SCORE_COUNT_FIELDS
+
+
+def pk_batches(model, batch_size: int):
+    # границы пакетов по первичному ключу: каждый пакет читается по диапазону индекса
+    last_pk = 0
+    while True:
+        pks = list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        yield model.objects.filter(pk__gte=pks[0], pk__lte=pks[-1])
+        last_pk = pks[-1]
+
+
+def drifted_titles(queryset):
+    # произведения, у которых количество отзывов, сумма оценок или гистограмма не совпадает с таблицей отзывов
+    actual = {'actual_review_count': Count('reviews'), 'actual_score_sum': Coalesce(Sum('reviews__score'), 0)}
+    actual.update({
+        f'actual_{field}': Count('reviews', filter=Q(reviews__score=score))
+        for score, field in zip(SCORES, SCORE_COUNT_FIELDS)
+    })
+    return queryset.annotate(**actual).exclude(
+        review_count=F('actual_review_count'), score_sum=F('actual_score_sum'),
+        **{field: F(f'actual_{field}') for field in SCORE_COUNT_FIELDS})
+
+
+def drifted_reviews(queryset):
+    return queryset.annotate(actual=Count('comments')).exclude(comment_count=F('actual'))
+
+
+class Command(BaseCommand):
+    help = ('Сверка денормализованных счетчиков с исходными таблицами: рейтинг и гистограмма оценок '
+            'произведений, количество комментариев отзывов. Расхождения пересчитываются пакетами')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='количество строк, сверяемых в одной транзакции')
+        parser.add_argument('--dry-run', action='store_true', help='только показать количество расхождений')
+
+    def handle(self, *args, **options):
+        batch_size, dry_run = options['batch_size'], options['dry_run']
+        checks = (
+            ('titles', Title, drifted_titles, lambda queryset: queryset.rebuild_rating()),
+            ('reviews', Review, drifted_reviews, lambda queryset: queryset.rebuild_comment_count()),
+        )
+        for name, model, drifted, rebuild in checks:
+            total = 0
+            for batch in pk_batches(model, batch_size):
+                with transaction.atomic():
+                    pks = list(drifted(batch).values_list('pk', flat=True))
+                    if pks and not dry_run:
+                        rebuild(model.objects.filter(pk__in=pks))
+                total += len(pks)
+            action = 'found' if dry_run else 'fixed'
+            self.stdout.write(self.style.SUCCESS(f'{name}: {action} {total} rows with drifted counters'))
@@ -0,0 +1,121 @@
+import ipaddress
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CollectorRegistry, Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# метрики хранятся в памяти процесса, каждый воркер отдает свои значения на /metrics/
+REGISTRY = CollectorRegistry(auto_describe=True)
+
+REQUEST_DURATION = Histogram(
+    'api_request_duration_seconds', 'Request wall time',
+    ['route', 'method', 'status'], registry=REGISTRY,
+)
+DB_QUERIES = Histogram(
+    'api_db_queries', 'Database queries per request',
+    ['route'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, float('inf')), registry=REGISTRY,
+)
+DB_DURATION = Counter('api_db_query_duration_seconds', 'Time spent in database queries', ['route'], registry=REGISTRY)
+SERIALIZER_DURATION = Counter('api_serializer_duration_seconds', 'Time spent in serializers', ['route'], registry=REGISTRY)
+CACHE_REQUESTS = Counter('api_cache_requests', 'Response cache lookups', ['route', 'result'], registry=REGISTRY)
+
+# пулы соединений (api.utils.pools)
+DB_CONNECTIONS = Counter('api_db_connections', 'Database connections opened', ['alias'], registry=REGISTRY)
+DB_HEALTH_CHECK_FAILURES = Counter(
+    'api_db_health_check_failures', 'Persistent database connections found unusable', ['alias'], registry=REGISTRY,
+)
+REDIS_POOL_WAIT = Histogram(
+    'api_redis_pool_wait_seconds', 'Time waiting for a Redis pool connection',
+    ['pool'], buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5, float('inf')), registry=REGISTRY,
+)
+REDIS_POOL_TIMEOUTS = Counter(
+    'api_redis_pool_timeouts', 'Redis connection requests failed on an exhausted pool', ['pool'], registry=REGISTRY,
+)
+
+
+class RequestStats:
+    """
+    Показатели текущего запроса, накапливаются без блокировок и переносятся в REGISTRY по окончании запроса
+    """
+    __slots__ = ('db_queries', 'db_time', 'serializer_time', 'cache')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.cache = None
+
+
+request_stats: ContextVar = ContextVar('request_stats', default=None)
+
+
+def db_wrapper(execute, sql, params, many, context):
+    # учет количества и времени запросов к БД; контекст запроса переносится и в потоки sync_to_async
+    stats = request_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_queries += 1
+        stats.db_time += perf_counter() - start
+
+
+def install_db_wrapper(sender, connection, **kwargs):
+    """
+    Обработчик connection_created: соединения локальны для потока, поэтому учет запросов
+    подключается к каждому новому соединению, а не на время запроса
+    """
+    if db_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_wrapper)
+
+
+def record_cache(result: str):
+    # hit, miss или stale (отдан устаревший ответ, пока он пересчитывается)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.cache = result
+
+
+@contextmanager
+def serializer_timer():
+    stats = request_stats.get()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.serializer_time += perf_counter() - start
+
+
+def observe(route: str, method: str, status: int, duration: float, stats: RequestStats):
+    REQUEST_DURATION.labels(route, method, status).observe(duration)
+    DB_QUERIES.labels(route).observe(stats.db_queries)
+    DB_DURATION.labels(route).inc(stats.db_time)
+    SERIALIZER_DURATION.labels(route).inc(stats.serializer_time)
+    if stats.cache:
+        CACHE_REQUESTS.labels(route, stats.cache).inc()
+
+
+def metrics_allowed(request) -> bool:
+    # сборщик Prometheus - по адресу из METRICS_ALLOWED_IPS, персонал - по сессии
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    try:
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in settings.METRICS_ALLOWED_IPS)
+
+
+def metrics_view(request):
+    """
+    Метрики в текстовом формате Prometheus. Маршруты, задержки и состояние пулов - внутренние данные,
+    поэтому доступ только из METRICS_ALLOWED_IPS или для персонала
+    """
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(REGISTRY), content_type=CONTENT_TYPE_LATEST)
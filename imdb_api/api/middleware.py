@@ -0,0 +1,95 @@
+import asyncio
+from time import perf_counter
+from django.conf import settings
+from rest_framework.permissions import SAFE_METHODS
+from .db_router import RoutingState, client_key, routing_state, set_pin_cookie
+from .metrics import RequestStats, request_stats, observe
+
+
+class MetricsMiddleware:
+    """
+    Сбор метрик по маршрутам: время запроса, количество и время запросов к БД,
+    попадания в кэш ответов (cache_response) и время сериализации.
+    При METRICS_SERVER_TIMING = True показатели добавляются в заголовок Server-Timing.
+    Поддерживает синхронную (WSGI) и асинхронную (ASGI) цепочку middleware
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, 'METRICS_SERVER_TIMING', False)
+        if asyncio.iscoroutinefunction(self.get_response):
+            # так Django определяет, что middleware нужно вызывать через await
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            request_stats.reset(token)
+        return self.process_response(request, response, perf_counter() - start, stats)
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            request_stats.reset(token)
+        return self.process_response(request, response, perf_counter() - start, stats)
+
+    def process_response(self, request, response, duration: float, stats: RequestStats):
+        match = request.resolver_match
+        route = match.route if match else 'unmatched'
+        observe(route, request.method, response.status_code, duration, stats)
+
+        if self.server_timing:
+            timings = [
+                f'total;dur={duration * 1000:.1f}',
+                f'db;dur={stats.db_time * 1000:.1f};desc="{stats.db_queries} queries"',
+                f'ser;dur={stats.serializer_time * 1000:.1f}',
+            ]
+            if stats.cache:
+                timings.append(f'cache;desc={stats.cache}')
+            response['Server-Timing'] = ', '.join(timings)
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Состояние маршрутизации запросов к БД (ReplicaRouter) на время HTTP-запроса:
+    безопасные методы читают с реплик, остальные работают только с default.
+    Состояние хранится в contextvar и доступно view, выполняемым в пуле потоков (async_view)
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        state = RoutingState(client_key(request), request.method in SAFE_METHODS)
+        token = routing_state.set(state)
+        try:
+            return set_pin_cookie(state, self.get_response(request))
+        finally:
+            routing_state.reset(token)
+
+    async def __acall__(self, request):
+        state = RoutingState(client_key(request), request.method in SAFE_METHODS)
+        token = routing_state.set(state)
+        try:
+            return set_pin_cookie(state, await self.get_response(request))
+        finally:
+            routing_state.reset(token)
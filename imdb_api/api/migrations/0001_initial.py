@@ -0,0 +1,82 @@
+# Generated by Django 3.2.17 on 2026-10-18 06:09
+
+import api.validators
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Category',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='category name')),
+                ('slug', models.SlugField(unique=True, verbose_name='category slug')),
+            ],
+            options={
+                'verbose_name': 'Category',
+                'verbose_name_plural': 'Categories',
+            },
+        ),
+        migrations.CreateModel(
+            name='Comment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(verbose_name='comment text')),
+                ('pub_date', models.DateTimeField(auto_now_add=True, verbose_name='date published')),
+            ],
+            options={
+                'verbose_name': 'Comment',
+                'verbose_name_plural': 'Comments',
+                'ordering': ['-pub_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Genre',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='genre name')),
+                ('slug', models.SlugField(unique=True, verbose_name='genre slug')),
+            ],
+            options={
+                'verbose_name': 'Genre',
+                'verbose_name_plural': 'Genres',
+            },
+        ),
+        migrations.CreateModel(
+            name='Review',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField(verbose_name='review text')),
+                ('score', models.PositiveSmallIntegerField(error_messages={'validators': 'The score must be in the range of 1 to 10.'}, help_text='The score must be in the range of 1 to 10.', validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(10)], verbose_name='score')),
+                ('pub_date', models.DateTimeField(auto_now_add=True, verbose_name='date published')),
+            ],
+            options={
+                'verbose_name': 'Review',
+                'verbose_name_plural': 'Reviews',
+                'ordering': ['-pub_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='Title',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='name of title')),
+                ('year', models.IntegerField(validators=[api.validators.validate_year], verbose_name='year of creation')),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='titles', to='api.category', verbose_name='category')),
+                ('genre', models.ManyToManyField(blank=True, null=True, related_name='titles', to='api.Genre', verbose_name='genre')),
+            ],
+            options={
+                'verbose_name': 'Title',
+                'verbose_name_plural': 'Titles',
+            },
+        ),
+    ]
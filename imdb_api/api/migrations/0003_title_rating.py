@@ -0,0 +1,44 @@
+# Generated by Django 3.2.17 on 2026-10-18 06:09
+
+from django.db import migrations, models
+from django.db.models import Count, FloatField, OuterRef, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce
+
+
+def fill_rating(apps, schema_editor):
+    Title = apps.get_model('api', 'Title')
+    Review = apps.get_model('api', 'Review')
+    reviews = Review.objects.filter(title=OuterRef('pk')).order_by().values('title')
+    review_count = Subquery(reviews.annotate(count=Count('id')).values('count'))
+    score_sum = Subquery(reviews.annotate(total=Sum('score')).values('total'))
+    Title.objects.update(
+        review_count=Coalesce(review_count, 0),
+        score_sum=Coalesce(score_sum, 0),
+        rating=Cast(score_sum, FloatField()) / review_count,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='title',
+            name='rating',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=4, null=True, verbose_name='rating'),
+        ),
+        migrations.AddField(
+            model_name='title',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='number of reviews'),
+        ),
+        migrations.AddField(
+            model_name='title',
+            name='score_sum',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='sum of review scores'),
+        ),
+        migrations.RunPython(fill_rating, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.2.17 on 2026-10-18 06:16
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+# индексы специфичны для PostgreSQL, на SQLite (локальные тесты) миграция их пропускает
+SEARCH_INDEXES = (
+    ('api_title_search_vector_idx', 'api_title USING gin (search_vector)'),
+    ('api_title_name_trgm_idx', 'api_title USING gin (upper(name) gin_trgm_ops)'),
+    ('api_category_name_trgm_idx', 'api_category USING gin (upper(name) gin_trgm_ops)'),
+    ('api_genre_name_trgm_idx', 'api_genre USING gin (upper(name) gin_trgm_ops)'),
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, definition in SEARCH_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {definition}')
+    schema_editor.execute("UPDATE api_title SET search_vector = to_tsvector('simple'::regconfig, COALESCE(name, ''))")
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, definition in SEARCH_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_feed_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='title',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
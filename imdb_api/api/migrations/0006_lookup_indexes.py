@@ -0,0 +1,58 @@
+# Generated by Django 3.2.17 on 2026-10-18 06:17
+
+from django.db import migrations, models
+from django.db.models import Count, FloatField, Min, OuterRef, Subquery, Sum
+from django.db.models.functions import Cast, Coalesce
+
+
+def delete_duplicate_reviews(apps, schema_editor):
+    """
+    До появления ограничения дубли могли создаваться гонкой двух запросов: оставляем самый ранний отзыв
+    """
+    Title = apps.get_model('api', 'Title')
+    Review = apps.get_model('api', 'Review')
+    duplicates = Review.objects.values('title', 'author').annotate(
+        first=Min('id'), count=Count('id')).filter(count__gt=1)
+    title_ids = set()
+    for duplicate in duplicates:
+        Review.objects.filter(
+            title=duplicate['title'], author=duplicate['author'], id__gt=duplicate['first']
+        ).delete()
+        title_ids.add(duplicate['title'])
+    if title_ids:
+        reviews = Review.objects.filter(title=OuterRef('pk')).order_by().values('title')
+        review_count = Subquery(reviews.annotate(count=Count('id')).values('count'))
+        score_sum = Subquery(reviews.annotate(total=Sum('score')).values('total'))
+        Title.objects.filter(pk__in=title_ids).update(
+            review_count=Coalesce(review_count, 0),
+            score_sum=Coalesce(score_sum, 0),
+            rating=Cast(score_sum, FloatField()) / review_count,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_title_search'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='title',
+            index=models.Index(fields=['year'], name='api_title_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='title',
+            index=models.Index(fields=['category', 'year'], name='api_title_category_year_idx'),
+        ),
+        # фильтр по жанрам: genre_id -> title_id без обращения к строкам таблицы
+        migrations.RunSQL(
+            'CREATE INDEX api_title_genre_genre_title_idx ON api_title_genre (genre_id, title_id)',
+            'DROP INDEX api_title_genre_genre_title_idx',
+        ),
+        migrations.RunPython(delete_duplicate_reviews, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='review',
+            constraint=models.UniqueConstraint(fields=('title', 'author'), name='api_review_unique_title_author'),
+        ),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 3.2.17 on 2026-10-18 06:41
+
+import math
+from collections import defaultdict
+from datetime import datetime, timezone
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# копии api.models.TRENDING_EPOCH, trending_weight, log2_add и ranking_scopes на момент миграции
+TRENDING_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def trending_weight(pub_date):
+    return (pub_date - TRENDING_EPOCH).total_seconds() / settings.RANKING_TRENDING_HALF_LIFE
+
+
+def log2_add(total, weight):
+    if total is None:
+        return weight
+    high, low = max(total, weight), min(total, weight)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def ranking_scopes(year, category_id, genre_ids):
+    scopes = ['all', f'year:{year}']
+    if category_id:
+        scopes.append(f'category:{category_id}')
+    scopes += [f'genre:{genre_id}' for genre_id in genre_ids]
+    return scopes
+
+
+def fill_rankings(apps, schema_editor):
+    Title = apps.get_model('api', 'Title')
+    Review = apps.get_model('api', 'Review')
+    TitleRanking = apps.get_model('api', 'TitleRanking')
+    trending = {}
+    for title_id, pub_date in Review.objects.order_by().values_list('title_id', 'pub_date').iterator():
+        trending[title_id] = log2_add(trending.get(title_id), trending_weight(pub_date))
+    genres = defaultdict(list)
+    for title_id, genre_id in Title.genre.through.objects.values_list('title_id', 'genre_id').iterator():
+        genres[title_id].append(genre_id)
+    rows = (
+        TitleRanking(scope=scope, title_id=pk, rating=rating, trending=trending.get(pk))
+        for pk, year, category_id, rating in Title.objects.values_list('pk', 'year', 'category_id', 'rating').iterator()
+        for scope in ranking_scopes(year, category_id, genres[pk])
+    )
+    TitleRanking.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TitleRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('scope', models.CharField(max_length=50, verbose_name='ranking scope')),
+                ('rating', models.DecimalField(decimal_places=2, max_digits=4, null=True, verbose_name='rating')),
+                ('trending', models.FloatField(null=True, verbose_name='log2 of time-decayed review count')),
+                ('title', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='api.title', verbose_name='title')),
+            ],
+            options={
+                'verbose_name': 'Title ranking',
+                'verbose_name_plural': 'Title rankings',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='titleranking',
+            index=models.Index(fields=['scope', '-rating', 'title'], name='api_ranking_rating_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='titleranking',
+            index=models.Index(fields=['scope', '-trending', 'title'], name='api_ranking_trending_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='titleranking',
+            constraint=models.UniqueConstraint(fields=('scope', 'title'), name='api_titleranking_unique_scope_title'),
+        ),
+        migrations.RunPython(fill_rankings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,132 @@
+from django.conf import settings
+from rest_framework import serializers, status
+from rest_framework.exceptions import NotFound
+from rest_framework.generics import get_object_or_404
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from .metrics import serializer_timer
+from .models import Title, Review
+from .renderers import FastJSONRenderer
+
+
+class RelatedQuerysetMixin:
+    """
+    Подгрузка связанных объектов, объявленных в Meta сериализатора:
+    select_related - для FK, prefetch_related - для M2M и обратных связей.
+    При выборе полей ответа (SparseFieldsMixin) - только связи и столбцы запрошенных полей.
+    Число запросов к БД не зависит от количества объектов на странице
+    """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        serializer_class = self.get_serializer_class()
+        meta = getattr(serializer_class, 'Meta', None)
+        select_related = getattr(meta, 'select_related', ())
+        prefetch_related = getattr(meta, 'prefetch_related', ())
+        fields = serializer_class.sparse_fields(self.request) if hasattr(serializer_class, 'sparse_fields') else None
+        if fields is not None:
+            # ?fields= / ?omit=: связи и столбцы только запрошенных полей
+            select_related = [relation for relation in select_related if relation.split('__')[0] in fields]
+            prefetch_related = [relation for relation in prefetch_related if relation.split('__')[0] in fields]
+            queryset = queryset.only(*serializer_class.load_fields(fields))
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
+
+class ValuesListMixin:
+    """
+    Список без создания моделей (VALUES_SERIALIZATION = True): страница читается через
+    serializer.values_queryset (values_list), представление строит serializer.to_representation_rows,
+    JSON рендерит orjson (FastJSONRenderer). Ответ совпадает с ответом ModelSerializer байт в байт
+    """
+    renderer_classes = (FastJSONRenderer, BrowsableAPIRenderer)
+
+    def list(self, request, *args, **kwargs):
+        serializer_class = self.get_serializer_class()
+        if not settings.VALUES_SERIALIZATION or not hasattr(serializer_class, 'to_representation_rows'):
+            return super().list(request, *args, **kwargs)
+
+        serializer = self.get_serializer()
+        queryset = serializer.values_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else list(queryset)
+        with serializer_timer():
+            data = serializer.to_representation_rows(rows)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+
+class NestedResourceMixin:
+    """
+    Разрешение родительских объектов вложенных URL (titles/<title_id>/reviews/<review_id>/...).
+    Весь путь title -> review проверяется одним запросом, при несовпадении возвращается 404.
+    Найденные объекты сохраняются в request.resolved_title / request.resolved_review
+    и переиспользуются сериализаторами и permissions без повторных запросов
+    """
+
+    def get_title(self):
+        request = self.request
+        if getattr(request, 'resolved_title', None) is None:
+            request.resolved_title = get_object_or_404(Title, pk=self.kwargs.get('title_id'))
+        return request.resolved_title
+
+    def get_review(self):
+        request = self.request
+        if getattr(request, 'resolved_review', None) is None:
+            review = get_object_or_404(
+                Review.objects.select_related('title'),
+                pk=self.kwargs.get('review_id'),
+                title_id=self.kwargs.get('title_id'),
+            )
+            request.resolved_review = review
+            request.resolved_title = review.title
+        return request.resolved_review
+
+
+class BulkWriteMixin:
+    """
+    Пакетная запись массивом объектов: POST создает, PATCH изменяет (у каждого элемента есть id).
+    Объекты для PATCH загружаются одним запросом; проверка, запись и инвалидация кэша
+    выполняются list_serializer_class сериализатора один раз на пакет
+    """
+    bulk_max_size = 1000
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data, many=True, max_length=self.bulk_max_size)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def patch(self, request, *args, **kwargs):
+        instances = self.get_bulk_objects(request.data)
+        serializer = self.get_serializer(
+            instances, data=request.data, many=True, partial=True, max_length=self.bulk_max_size)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data)
+
+    def get_bulk_objects(self, data) -> list:
+        if not isinstance(data, list) or not all(
+                isinstance(item, dict) and isinstance(item.get('id'), int) for item in data):
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: ['Expected a list of objects with an integer "id".']
+            })
+        ids = [item['id'] for item in data]
+        if len(ids) > self.bulk_max_size:
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: [f'Ensure the batch has no more than {self.bulk_max_size} elements.']
+            })
+        if len(set(ids)) != len(ids):
+            raise serializers.ValidationError({api_settings.NON_FIELD_ERRORS_KEY: ['Duplicate ids in the batch.']})
+        objects = self.get_queryset().in_bulk(ids)
+        missing = [pk for pk in ids if pk not in objects]
+        if missing:
+            raise NotFound(f'Objects not found: {", ".join(map(str, missing))}.')
+        for obj in objects.values():
+            self.check_object_permissions(self.request, obj)
+        return [objects[pk] for pk in ids]
@@ -1,4 +1,12 @@
-from django.db import models
+import math
+import re
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, SearchVectorField
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, F, FloatField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce, Greatest, Ln, Power
 from django.contrib.auth import get_user_model
 from django.core.validators import MaxValueValidator, MinValueValidator
 from .validators import validate_year
@@ -6,6 +14,9 @@ from .validators import validate_year
 
 User = get_user_model()
 
+SCORES = range(1, 11)
+SCORE_COUNT_FIELDS = tuple(f'score_{score}_count' for score in SCORES)
+
 
 class Category(models.Model):
     name = models.CharField('category name', max_length=200)
@@ -32,6 +43,96 @@ class Genre(models.Model):
         return self.slug
 
 
+class TitleQuerySet(models.QuerySet):
+
+    def update_rating(self, added: int = None, removed: int = None):
+        """
+        Инкрементальное обновление агрегатов рейтинга и гистограммы оценок одним UPDATE без чтения строки:
+        added - оценка добавленного отзыва, removed - удаленного (при изменении оценки - обе)
+        """
+        count_delta = (added is not None) - (removed is not None)
+        review_count = F('review_count') + count_delta
+        score_sum = F('score_sum') + (added or 0) - (removed or 0)
+        deltas = Counter()
+        if added is not None:
+            deltas[added] += 1
+        if removed is not None:
+            deltas[removed] -= 1
+        histogram = {
+            f'score_{score}_count': F(f'score_{score}_count') + delta for score, delta in deltas.items() if delta
+        }
+        return self.update(
+            review_count=review_count,
+            score_sum=score_sum,
+            rating=Case(
+                When(review_count__lte=-count_delta, then=Value(None)),
+                default=Cast(score_sum, FloatField()) / review_count,
+            ),
+            **histogram,
+        )
+
+    def lock(self) -> list:
+        """
+        Блокировка строк произведений до конца транзакции (SELECT ... FOR UPDATE в порядке pk - без взаимных
+        блокировок). Вызывается перед rebuild_rating вне сигналов: инкрементальный update_rating параллельного
+        запроса ждет пересчета и применяется к его результату, а не теряется
+        """
+        return list(self.select_for_update().order_by('pk').values_list('pk', flat=True))
+
+    def rebuild_rating(self):
+        """
+        Полный пересчет агрегатов рейтинга по таблице отзывов
+        """
+        reviews = Review.objects.filter(title=OuterRef('pk')).order_by().values('title')
+        review_count = Subquery(reviews.annotate(count=Count('id')).values('count'))
+        score_sum = Subquery(reviews.annotate(total=Sum('score')).values('total'))
+        histogram = {
+            f'score_{score}_count': Coalesce(
+                Subquery(reviews.annotate(count=Count('id', filter=Q(score=score))).values('count')), 0)
+            for score in SCORES
+        }
+        return self.update(
+            review_count=Coalesce(review_count, 0),
+            score_sum=Coalesce(score_sum, 0),
+            rating=Cast(score_sum, FloatField()) / review_count,
+            **histogram,
+        )
+
+    def update_search_vector(self):
+        """
+        Пересчет поискового вектора по названию (только PostgreSQL)
+        """
+        if connection.vendor != 'postgresql':
+            return 0
+        return self.update(search_vector=SearchVector('name', config='simple'))
+
+    def ranked(self, scope: str, ranking: str):
+        """
+        Произведения разреза TitleRanking по убыванию rating или trending: первые строки читаются
+        по индексу (scope, -ranking, title) без сортировки всего разреза
+        """
+        return self.filter(**{'rankings__scope': scope, f'rankings__{ranking}__isnull': False}).order_by(
+            f'-rankings__{ranking}', 'rankings__title_id')
+
+    def search(self, value: str):
+        """
+        Поиск по названию. На PostgreSQL - полнотекстовый с префиксным совпадением слов (typeahead)
+        и ранжированием, плюс совпадение подстроки по триграммному индексу.
+        На других БД (SQLite в локальных тестах) - только совпадение подстроки
+        """
+        if connection.vendor != 'postgresql':
+            return self.filter(name__icontains=value)
+        terms = re.findall(r'\w+', value)
+        if not terms:
+            return self.filter(name__icontains=value)
+        query = SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config='simple')
+        return self.filter(
+            Q(search_vector=query) | Q(name__icontains=value)
+        ).annotate(
+            search_rank=SearchRank(F('search_vector'), query)
+        ).order_by(F('search_rank').desc(nulls_last=True), 'id')
+
+
 class Title(models.Model):
 
     name = models.CharField('name of title', max_length=200)
@@ -51,14 +152,56 @@ class Title(models.Model):
         null=True,
         related_name='titles'
     )
+    # денормализованный рейтинг, поддерживается сигналами Review (api/signals.py)
+    rating = models.DecimalField('rating', max_digits=4, decimal_places=2, blank=True, null=True, editable=False)
+    review_count = models.PositiveIntegerField('number of reviews', default=0, editable=False)
+    score_sum = models.PositiveIntegerField('sum of review scores', default=0, editable=False)
+    # гистограмма оценок: количество отзывов с оценкой 1..10
+    score_1_count = models.PositiveIntegerField('reviews with score 1', default=0, editable=False)
+    score_2_count = models.PositiveIntegerField('reviews with score 2', default=0, editable=False)
+    score_3_count = models.PositiveIntegerField('reviews with score 3', default=0, editable=False)
+    score_4_count = models.PositiveIntegerField('reviews with score 4', default=0, editable=False)
+    score_5_count = models.PositiveIntegerField('reviews with score 5', default=0, editable=False)
+    score_6_count = models.PositiveIntegerField('reviews with score 6', default=0, editable=False)
+    score_7_count = models.PositiveIntegerField('reviews with score 7', default=0, editable=False)
+    score_8_count = models.PositiveIntegerField('reviews with score 8', default=0, editable=False)
+    score_9_count = models.PositiveIntegerField('reviews with score 9', default=0, editable=False)
+    score_10_count = models.PositiveIntegerField('reviews with score 10', default=0, editable=False)
+    # поисковый вектор по названию, поддерживается сигналом Title (api/signals.py)
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = TitleQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Title'
         verbose_name_plural = 'Titles'
+        indexes = [
+            # фильтры TitleFilter: year и category (+ year)
+            models.Index(fields=['year'], name='api_title_year_idx'),
+            models.Index(fields=['category', 'year'], name='api_title_category_year_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    @property
+    def score_histogram(self) -> dict:
+        return {score: getattr(self, field) for score, field in zip(SCORES, SCORE_COUNT_FIELDS)}
+
+
+class ReviewQuerySet(models.QuerySet):
+
+    def update_comment_count(self, delta: int):
+        return self.update(comment_count=F('comment_count') + delta)
+
+    def rebuild_comment_count(self):
+        """
+        Полный пересчет количества комментариев по таблице комментариев
+        """
+        comments = Comment.objects.filter(review=OuterRef('pk')).order_by().values('review')
+        return self.update(comment_count=Coalesce(
+            Subquery(comments.annotate(count=Count('id')).values('count')), 0))
+
 
 class Review(models.Model):
 
@@ -82,16 +225,29 @@ class Review(models.Model):
         help_text='The score must be in the range of 1 to 10.'
     )
     pub_date = models.DateTimeField('date published', auto_now_add=True)
+    # денормализованное количество комментариев, поддерживается сигналами Comment (api/signals.py)
+    comment_count = models.PositiveIntegerField('number of comments', default=0, editable=False)
+
+    objects = ReviewQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Review'
         verbose_name_plural = 'Reviews'
         ordering = ["-pub_date"]
+        indexes = [
+            # лента отзывов произведения (FeedPagination)
+            models.Index(fields=['title', 'pub_date', 'id'], name='api_review_title_feed_idx'),
+        ]
         constraints = [
             models.CheckConstraint(
                 name="%(app_label)s_%(class)s_score_range",
                 check=models.Q(score__range=(1, 10)),
             ),
+            # один отзыв пользователя на произведение
+            models.UniqueConstraint(
+                name="%(app_label)s_%(class)s_unique_title_author",
+                fields=('title', 'author'),
+            ),
         ]
 
     def __str__(self):
@@ -119,6 +275,134 @@ class Comment(models.Model):
         verbose_name = 'Comment'
         verbose_name_plural = 'Comments'
         ordering = ["-pub_date"]
+        indexes = [
+            # лента комментариев к отзыву (FeedPagination)
+            models.Index(fields=['review', 'pub_date', 'id'], name='api_comment_review_feed_idx'),
+        ]
 
     def __str__(self):
         return self.text
+
+
+# trending - log2 суммы весов отзывов, вес отзыва - 2 ** ((pub_date - TRENDING_EPOCH) / RANKING_TRENDING_HALF_LIFE):
+# вес новых отзывов растет, поэтому вклад старых затухает без пересчета сохраненных значений.
+# В шкале log2 значения растут линейно со временем и не переполняются; NULL - у произведения нет отзывов
+TRENDING_EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+# trending, который больше вычитаемого веса меньше чем на TRENDING_TOLERANCE, - погрешность округления, а не отзывы
+TRENDING_TOLERANCE = 1e-9
+# нижняя граница показателя степени в SQL: power() в PostgreSQL при антипереполнении - ошибка, а не 0
+MIN_EXPONENT = -1000.0
+
+
+def trending_weight(pub_date) -> float:
+    """
+    log2 веса отзыва в trending
+    """
+    return (pub_date - TRENDING_EPOCH).total_seconds() / settings.RANKING_TRENDING_HALF_LIFE
+
+
+def log2_add(total, weight):
+    """
+    log2(2 ** total + 2 ** weight) без вычисления самих степеней; None - пустая сумма
+    """
+    if total is None:
+        return weight
+    high, low = max(total, weight), min(total, weight)
+    return high + math.log2(1 + 2 ** (low - high))
+
+
+def _log2_exp2(sign: float, exponent):
+    # log2(1 + sign * 2 ** exponent) в SQL, exponent <= 0
+    power = Power(Value(2.0), Greatest(exponent, Value(MIN_EXPONENT)))
+    return Ln(Value(1.0) + Value(sign) * power) / math.log(2)
+
+
+def ranking_scopes(year: int, category_id, genre_ids) -> list:
+    scopes = ['all', f'year:{year}']
+    if category_id:
+        scopes.append(f'category:{category_id}')
+    scopes += [f'genre:{genre_id}' for genre_id in genre_ids]
+    return scopes
+
+
+class TitleRankingQuerySet(models.QuerySet):
+
+    def update_from_title(self, added: float = None, removed: float = None):
+        """
+        Инкрементальное обновление строк всех разрезов одним UPDATE: рейтинг копируется из Title,
+        к trending добавляется вес созданного (added) или вычитается вес удаленного (removed) отзыва
+        (log2 весов, trending_weight)
+        """
+        values = {'rating': Subquery(Title.objects.filter(pk=OuterRef('title_id')).values('rating'))}
+        if added is not None:
+            # к большему слагаемому прибавляется log2(1 + 2 ** (меньшее - большее))
+            values['trending'] = Case(
+                When(trending__isnull=True, then=Value(added)),
+                When(trending__gte=added, then=F('trending') + _log2_exp2(1.0, Value(added) - F('trending'))),
+                default=Value(added) + _log2_exp2(1.0, F('trending') - Value(added)),
+                output_field=FloatField(),
+            )
+        elif removed is not None:
+            # log2(2 ** trending - 2 ** removed); без остатка - NULL (удален последний отзыв)
+            values['trending'] = Case(
+                When(
+                    trending__gt=removed + TRENDING_TOLERANCE,
+                    then=F('trending') + _log2_exp2(-1.0, Value(removed) - F('trending')),
+                ),
+                default=Value(None),
+                output_field=FloatField(),
+            )
+        return self.update(**values)
+
+    def sync(self, title_ids):
+        """
+        Полный пересчет строк произведений: разрезы по году, категории и жанрам, рейтинг и trending по отзывам.
+        Для записи без сигналов (пакетная запись, импорт) и для rebuild_ratings
+        """
+        title_ids = list(title_ids)
+        trending = {}
+        reviews = Review.objects.filter(title_id__in=title_ids).order_by().values_list('title_id', 'pub_date')
+        for title_id, pub_date in reviews.iterator():
+            trending[title_id] = log2_add(trending.get(title_id), trending_weight(pub_date))
+        genres = defaultdict(list)
+        links = Title.genre.through.objects.filter(title_id__in=title_ids).values_list('title_id', 'genre_id')
+        for title_id, genre_id in links:
+            genres[title_id].append(genre_id)
+        rows = [
+            TitleRanking(scope=scope, title_id=pk, rating=rating, trending=trending.get(pk))
+            for pk, year, category_id, rating in Title.objects.filter(pk__in=title_ids).values_list(
+                'pk', 'year', 'category_id', 'rating')
+            for scope in ranking_scopes(year, category_id, genres[pk])
+        ]
+        with transaction.atomic():
+            self.filter(title_id__in=title_ids).delete()
+            self.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+
+class TitleRanking(models.Model):
+    """
+    Материализованные рейтинги произведений по разрезам (scope): 'all', 'year:<год>',
+    'category:<id>', 'genre:<id>'. Поддерживаются сигналами Title и Review (api/signals.py)
+    """
+    scope = models.CharField('ranking scope', max_length=50)
+    title = models.ForeignKey(Title, verbose_name='title', on_delete=models.CASCADE, related_name='rankings')
+    rating = models.DecimalField('rating', max_digits=4, decimal_places=2, null=True)
+    trending = models.FloatField('log2 of time-decayed review count', null=True)
+
+    objects = TitleRankingQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Title ranking'
+        verbose_name_plural = 'Title rankings'
+        indexes = [
+            # первые K строк разреза без сортировки
+            models.Index(fields=['scope', '-rating', 'title'], name='api_ranking_rating_idx'),
+            models.Index(fields=['scope', '-trending', 'title'], name='api_ranking_trending_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=('scope', 'title'), name="%(app_label)s_%(class)s_unique_scope_title"),
+        ]
+
+    def __str__(self):
+        return f'{self.scope}: {self.title_id}'
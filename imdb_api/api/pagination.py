@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from django.core.paginator import EmptyPage, InvalidPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+from .utils.cache_functions import cached_count
+
+# оценка количества строк таблицы по статистике планировщика PostgreSQL (обновляется ANALYZE / autovacuum)
+ESTIMATE_SQL = 'SELECT reltuples FROM pg_class WHERE oid = %s::regclass'
+
+
+def estimated_count(queryset):
+    """
+    Примерное количество строк таблицы модели без чтения таблицы; None, если оценки нет
+    (не PostgreSQL или таблица еще не анализировалась)
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(ESTIMATE_SQL, [connection.ops.quote_name(queryset.model._meta.db_table)])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] >= 0 else None
+
+
+class CountedPaginator(Paginator):
+    """
+    Paginator, получающий количество объектов от count_func, а не из COUNT(*) по object_list
+    """
+
+    def __init__(self, object_list, per_page, count_func, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_func = count_func
+
+    @cached_property
+    def count(self):
+        return self.count_func()
+
+
+class UncountedPage(Page):
+    has_more = False
+
+    def has_next(self):
+        return self.has_more
+
+
+class UncountedPaginator(Paginator):
+    """
+    Paginator без количества объектов: страница читается с одной лишней строкой,
+    по которой определяется наличие следующей страницы
+    """
+
+    def validate_number(self, number):
+        try:
+            if isinstance(number, float) and not number.is_integer():
+                raise ValueError
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        objects = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not objects and number > 1:
+            raise EmptyPage('That page contains no results')
+        page = UncountedPage(objects[:self.per_page], number, self)
+        page.has_more = len(objects) > self.per_page
+        return page
+
+
+class CachedCountPagination(PageNumberPagination):
+    """
+    Постраничная пагинация без COUNT(*) на каждый запрос:
+    - количество строк списка без фильтров на PostgreSQL - оценка планировщика (pg_class.reltuples),
+      если таблица не меньше estimate_min_rows строк. Оценка только сообщается в count:
+      существование страницы и ссылка next определяются по лишней строке, как с ?count=false;
+    - иначе количество кэшируется для комбинации фильтров (cached_count) до изменения тегов
+      view.get_count_tags(); без этого метода у view - точный COUNT(*);
+    - ?count=false - ответ только со ссылками next / previous, без count
+    """
+    count_query_param = 'count'
+    estimate_min_rows = 100000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.view = view
+        self.counted = request.query_params.get(self.count_query_param, '').lower() not in ('false', '0')
+        self.estimate = self.get_estimate(queryset) if self.counted else None
+        if self.counted and self.estimate is None:
+            return super().paginate_queryset(queryset, request, view)
+
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+        page_number = request.query_params.get(self.page_query_param, 1)
+        try:
+            self.page = UncountedPaginator(queryset, page_size).page(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(page_number=page_number, message=str(exc)))
+        self.request = request
+        return list(self.page)
+
+    def django_paginator_class(self, queryset, page_size):
+        return CountedPaginator(queryset, page_size, lambda: self.get_count(queryset))
+
+    def get_estimate(self, queryset):
+        if queryset.query.where:
+            return None
+        estimate = estimated_count(queryset)
+        return estimate if estimate is not None and estimate >= self.estimate_min_rows else None
+
+    def get_count(self, queryset) -> int:
+        get_count_tags = getattr(self.view, 'get_count_tags', None)
+        if get_count_tags is None:
+            return queryset.count()
+        return cached_count(queryset, get_count_tags())
+
+    def get_paginated_response(self, data):
+        if self.counted and self.estimate is None:
+            return super().get_paginated_response(data)
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        if self.estimate is not None:
+            response['count'] = self.estimate
+            response.move_to_end('count', last=False)
+        return Response(response)
+
+
+class PubDateCursorPagination(CursorPagination):
+    """
+    Keyset-пагинация по (pub_date, id): без OFFSET и COUNT(*), время ответа не зависит от номера страницы
+    """
+    ordering = ('-pub_date', '-id')
+
+
+class FeedPagination(CachedCountPagination):
+    """
+    Пагинация лент отзывов и комментариев.
+    По умолчанию постраничная, курсорная включается параметром ?pagination=cursor
+    (ссылки next/previous в этом режиме содержат параметр cursor)
+    """
+    mode_query_param = 'pagination'
+    cursor_mode = 'cursor'
+
+    def __init__(self):
+        self.cursor_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if (
+                request.query_params.get(self.mode_query_param) == self.cursor_mode
+                or PubDateCursorPagination.cursor_query_param in request.query_params
+        ):
+            self.cursor_paginator = PubDateCursorPagination()
+            return self.cursor_paginator.paginate_queryset(queryset, request, view)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -0,0 +1,50 @@
+import json
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+class StreamRenderer(BaseRenderer):
+    """
+    Рендерер для согласования формата потоковой выгрузки (?format= или заголовок Accept).
+    Тело ответа формирует view через StreamingHttpResponse
+    """
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # сюда попадают только ответы с ошибками (403, 429 и т.п.)
+        if data is None:
+            return b''
+        return json.dumps(data).encode(self.charset)
+
+
+class NDJSONRenderer(StreamRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class CSVRenderer(StreamRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer на orjson с тем же результатом: компактный JSON в UTF-8, U+2028 и U+2029 экранируются,
+    Decimal, даты и ленивые строки преобразует encoder_class DRF.
+    Отступы (Accept: application/json; indent=4) и то, что orjson не сериализует
+    (ключи не строки, целые больше 64 бит), рендерятся JSONRenderer.
+    Только для ответов без float: orjson записывает показатель степени иначе, чем json (1e16 и 1e+16)
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.ensure_ascii or not self.compact or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # как JSONRenderer: разделители строк недопустимы в JavaScript-строках
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
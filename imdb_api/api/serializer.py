@@ -1,11 +1,159 @@
+from collections import Counter, defaultdict
+from operator import attrgetter
+from django.db import IntegrityError, connection, models, router, transaction
+from django.utils.encoding import smart_str
 from rest_framework import serializers
-from rest_framework.generics import get_object_or_404
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.settings import api_settings
 from rest_framework.validators import UniqueValidator
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from api.models import Category, Genre, Title, Review, Comment
+from api.metrics import serializer_timer
+from api.models import Category, Genre, Title, TitleRanking, Review, Comment, SCORES, SCORE_COUNT_FIELDS
+from api.utils.cache_functions import (
+    invalidate_tags,
+    title_tag,
+    review_tag,
+    category_tag,
+    genre_tag,
+    TITLES_TAG,
+    TITLE_SEARCH_TAG,
+)
+from api.utils.reference_cache import CATEGORIES, GENRES, USERNAMES
 from users.models import User
 
 
+class TimedSerializerMixin:
+    """
+    Учет времени сериализации в метриках запроса (api/metrics.py)
+    """
+
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+
+    def to_representation(self, data):
+        # справочные данные всей страницы загружаются одним обращением к кэшу (поля с preload)
+        data = list(data.all() if isinstance(data, models.Manager) else data)
+        for field in self.child.fields.values():
+            if hasattr(field, 'preload'):
+                field.preload(data)
+        return super().to_representation(data)
+
+
+class SparseFieldsMixin:
+    """
+    Выбор полей ответа в безопасных запросах: ?fields=name,rating - только перечисленные,
+    ?omit=genre,category - все, кроме перечисленных; id возвращается всегда.
+    Столбцы поля - Meta.field_columns (по умолчанию одноименный), столбцы, нужные независимо
+    от полей ответа (курсор пагинации, теги кэша), - Meta.load_always.
+    RelatedQuerysetMixin передает выбор в queryset: only() по столбцам запрошенных полей,
+    select_related / prefetch_related - только для запрошенных связей
+    """
+    fields_query_param = 'fields'
+    omit_query_param = 'omit'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        fields = self.sparse_fields(self.context.get('request'))
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def sparse_fields(cls, request):
+        """
+        Запрошенные поля в порядке Meta.fields или None, если нужен полный ответ
+        """
+        if request is None or request.method not in SAFE_METHODS:
+            return None
+        params = request.query_params
+        if cls.fields_query_param not in params and cls.omit_query_param not in params:
+            return None
+        names = {}
+        for param in (cls.fields_query_param, cls.omit_query_param):
+            names[param] = [name.strip() for name in params.get(param, '').split(',') if name.strip()]
+            unknown = [name for name in names[param] if name not in cls.Meta.fields]
+            if unknown:
+                raise serializers.ValidationError({param: [f'Unknown fields: {", ".join(unknown)}.']})
+        included = names[cls.fields_query_param] if cls.fields_query_param in params else cls.Meta.fields
+        omitted = names[cls.omit_query_param]
+        return tuple(name for name in cls.Meta.fields if name == 'id' or (name in included and name not in omitted))
+
+    @classmethod
+    def columns(cls, fields) -> list:
+        # столбцы values_list для полей ответа
+        field_columns = getattr(cls.Meta, 'field_columns', {})
+        columns = dict.fromkeys(('id', *getattr(cls.Meta, 'load_always', ())))
+        for name in fields:
+            columns.update(dict.fromkeys(field_columns.get(name, (name,))))
+        return list(columns)
+
+    @classmethod
+    def load_fields(cls, fields) -> list:
+        # поля модели для only(): столбцы связанных моделей читаются через select_related
+        opts = cls.Meta.model._meta
+        return list(dict.fromkeys(opts.get_field(column.split('__')[0]).name for column in cls.columns(fields)))
+
+
+class ValuesSerializerMixin(SparseFieldsMixin):
+    """
+    Чтение списков без создания моделей (ValuesListMixin): строки страницы читаются из
+    values_list(*columns, named=True), значение поля строит функция из row_getters
+    (по умолчанию - одноименный столбец). Результат должен совпадать с to_representation сериализатора
+    """
+
+    def values_queryset(self, queryset):
+        columns = self.columns(self.fields)
+        return queryset.select_related(None).prefetch_related(None).values_list(*columns, named=True)
+
+    def row_getters(self, rows) -> dict:
+        return {}
+
+    def to_representation_rows(self, rows) -> list:
+        getters = self.row_getters(rows)
+        fields = [(name, getters.get(name) or attrgetter(name)) for name in self.fields]
+        return [{name: get(row) for name, get in fields} for row in rows]
+
+
+class CachedSlugRelatedField(serializers.SlugRelatedField):
+    """
+    Поиск объекта по slug через ReferenceCache (api/utils/reference_cache.py) без запроса к БД
+    """
+
+    def __init__(self, reference_cache, **kwargs):
+        self.reference_cache = reference_cache
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        values = self.reference_cache.get(smart_str(data))
+        if values is None:
+            self.fail('does_not_exist', slug_name=self.slug_field, value=smart_str(data))
+        model = self.get_queryset().model
+        return model.from_db(router.db_for_read(model), list(values), list(values.values()))
+
+
+class CachedUsernameField(serializers.SlugRelatedField):
+    """
+    Имя автора по id через ReferenceCache: связанный пользователь не загружается из БД
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(slug_field='username', **kwargs)
+
+    def use_pk_only_optimization(self):
+        return True
+
+    def to_representation(self, value):
+        return USERNAMES.get(value.pk)
+
+    def preload(self, instances):
+        USERNAMES.get_many({instance.serializable_value(self.source) for instance in instances})
+
+
 class UserSerializer(serializers.ModelSerializer):
     username = serializers.CharField(
         validators=[UniqueValidator(
@@ -56,23 +204,146 @@ class GenreSerializer(serializers.ModelSerializer):
         lookup_field = 'slug'
 
 
-class TitleReadSerializer(serializers.ModelSerializer):
+class TitleReadSerializer(ValuesSerializerMixin, TimedSerializerMixin, serializers.ModelSerializer):
     category = CategorySerializer(many=False, read_only=True)
     genre = GenreSerializer(many=True, read_only=True)
     rating = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
+    # количество отзывов по оценкам 1..10
+    score_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True)
 
     class Meta:
         model = Title
-        fields = ('id', 'name', 'year', 'category', 'genre', 'rating')
+        fields = ('id', 'name', 'year', 'category', 'genre', 'rating', 'score_histogram')
+        select_related = ('category',)
+        prefetch_related = ('genre',)
+        list_serializer_class = TimedListSerializer
+        field_columns = {
+            'category': ('category__name', 'category__slug'),
+            'genre': (),
+            'score_histogram': SCORE_COUNT_FIELDS,
+        }
+
+    def row_getters(self, rows) -> dict:
+        fields = self.fields
+        getters = {
+            'category': lambda row: (
+                {'name': row.category__name, 'slug': row.category__slug} if row.category__slug is not None else None),
+        }
+        if 'genre' in fields:
+            # жанры страницы одним запросом, как prefetch_related('genre')
+            genres = defaultdict(list)
+            if rows:
+                links = Genre.objects.filter(titles__in=[row.id for row in rows]).values_list('titles', 'name', 'slug')
+                for title_id, name, slug in links:
+                    genres[title_id].append({'name': name, 'slug': slug})
+            getters['genre'] = lambda row: genres[row.id]
+        if 'rating' in fields:
+            rating = fields['rating'].to_representation
+            getters['rating'] = lambda row: rating(row.rating) if row.rating is not None else None
+        if 'score_histogram' in fields:
+            keys, scores = [str(score) for score in SCORES], attrgetter(*SCORE_COUNT_FIELDS)
+            getters['score_histogram'] = lambda row: dict(zip(keys, scores(row)))
+        return getters
+
+
+def _batch_errors(errors: list):
+    # ошибки пакета в формате ListSerializer: по словарю на элемент, пустой - для корректных
+    if any(errors):
+        raise serializers.ValidationError(errors)
+
+
+class TitleListSerializer(serializers.ListSerializer):
+    """
+    Пакетное создание и изменение произведений (TitleBulkView): slug всех категорий и жанров пакета
+    разрешаются одним обращением к ReferenceCache, запись - bulk_create / bulk_update,
+    теги кэша инвалидируются один раз на пакет (сигналы при пакетной записи не отправляются)
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, list):
+            items = [item for item in data if isinstance(item, dict)]
+            CATEGORIES.get_many({item['category'] for item in items if isinstance(item.get('category'), str)})
+            GENRES.get_many({
+                slug for item in items if isinstance(item.get('genre'), list)
+                for slug in item['genre'] if isinstance(slug, str)
+            })
+        return super().to_internal_value(data)
+
+    def create(self, validated_data):
+        genres = [item.pop('genre', []) for item in validated_data]
+        titles = [Title(**item) for item in validated_data]
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Title.objects.bulk_create(titles)
+            else:
+                # SQLite (Django 3.2) не возвращает id из bulk_create
+                for title in titles:
+                    title.save()
+            through = Title.genre.through
+            through.objects.bulk_create(
+                through(title_id=title.pk, genre_id=genre.pk)
+                for title, items in zip(titles, genres) for genre in items
+            )
+            Title.objects.filter(pk__in=[title.pk for title in titles]).update_search_vector()
+            TitleRanking.objects.sync(title.pk for title in titles)
+
+        tags = {TITLES_TAG}
+        tags.update(category_tag(title.category.slug) for title in titles if title.category)
+        tags.update(genre_tag(genre.slug) for items in genres for genre in items)
+        invalidate_tags(*tags)
+        return self.refetch(titles)
+
+    def update(self, instances, validated_data):
+        fields, tags = set(), set()
+        renamed, genres = [], {}
+        for title, item in zip(instances, validated_data):
+            tags.add(title_tag(title.pk))
+            if 'genre' in item:
+                genres[title.pk] = item.pop('genre')
+            if item.get('name', title.name) != title.name:
+                renamed.append(title.pk)
+            if (item.get('name', title.name), item.get('year', title.year)) != (title.name, title.year):
+                tags.add(TITLE_SEARCH_TAG)
+            if 'category' in item and item['category'] != title.category:
+                tags.update(category_tag(category.slug) for category in (title.category, item['category']) if category)
+            for attr, value in item.items():
+                setattr(title, attr, value)
+                fields.add(attr)
+
+        with transaction.atomic():
+            if fields:
+                Title.objects.bulk_update(instances, fields)
+            if genres:
+                through = Title.genre.through
+                links = through.objects.filter(title_id__in=genres.keys())
+                tags.update(genre_tag(slug) for slug in links.values_list('genre__slug', flat=True))
+                links.delete()
+                through.objects.bulk_create(
+                    through(title_id=pk, genre_id=genre.pk) for pk, items in genres.items() for genre in items)
+                tags.update(genre_tag(genre.slug) for items in genres.values() for genre in items)
+            Title.objects.filter(pk__in=renamed).update_search_vector()
+            if genres or fields & {'year', 'category'}:
+                TitleRanking.objects.sync(title.pk for title in instances)
+        invalidate_tags(*tags)
+        return self.refetch(instances)
+
+    @staticmethod
+    def refetch(titles: list) -> list:
+        # представление с жанрами для всего пакета двумя запросами, в порядке элементов запроса
+        objects = Title.objects.select_related('category').prefetch_related('genre').in_bulk(
+            [title.pk for title in titles])
+        return [objects[title.pk] for title in titles]
 
 
 class TitleWriteSerializer(serializers.ModelSerializer):
-    category = serializers.SlugRelatedField(
+    category = CachedSlugRelatedField(
+        CATEGORIES,
         queryset=Category.objects.all(),
         slug_field='slug',
         required=False
     )
-    genre = serializers.SlugRelatedField(
+    genre = CachedSlugRelatedField(
+        GENRES,
         queryset=Genre.objects.all(),
         slug_field='slug',
         many=True,
@@ -80,17 +351,45 @@ class TitleWriteSerializer(serializers.ModelSerializer):
     )
 
     class Meta:
-        fields = '__all__'
+        exclude = ('rating', 'review_count', 'score_sum', 'search_vector', *SCORE_COUNT_FIELDS)
         model = Title
+        list_serializer_class = TitleListSerializer
+
 
+def _feed_getters(fields, rows, **getters) -> dict:
+    # автор и дата отзыва или комментария: имена авторов страницы одним обращением к кэшу
+    if 'author' in fields:
+        usernames = USERNAMES.get_many({row.author_id for row in rows})
+        getters['author'] = lambda row: usernames.get(row.author_id)
+    if 'pub_date' in fields:
+        pub_date = fields['pub_date'].to_representation
+        getters['pub_date'] = lambda row: pub_date(row.pub_date)
+    return getters
 
-class ReviewReadSerializer(serializers.ModelSerializer):
-    author = serializers.SlugRelatedField(queryset=User.objects.all(), slug_field='username')
+
+class ReviewReadSerializer(ValuesSerializerMixin, TimedSerializerMixin, serializers.ModelSerializer):
+    author = CachedUsernameField(queryset=User.objects.all())
     title = serializers.SlugRelatedField(queryset=Title.objects.all(), slug_field='name')
 
     class Meta:
-        fields = ('id', 'text', 'author', 'score', 'pub_date', 'title')
+        fields = ('id', 'text', 'author', 'score', 'pub_date', 'title', 'comment_count')
         model = Review
+        select_related = ('title',)
+        list_serializer_class = TimedListSerializer
+        field_columns = {'author': ('author_id',), 'title': ('title__name',)}
+        # курсор ленты и теги кэша отзыва
+        load_always = ('pub_date', 'author_id', 'title_id')
+
+    def row_getters(self, rows) -> dict:
+        return _feed_getters(self.fields, rows, title=attrgetter('title__name'))
+
+
+def _review_exists(author, title_ids) -> bool:
+    """
+    Есть ли отзыв автора к одному из произведений: IntegrityError при записи отзыва вызван
+    ограничением api_review_unique_title_author (имя ограничения есть не в сообщениях всех БД)
+    """
+    return Review.objects.filter(author=author, title_id__in=title_ids).exists()
 
 
 class ReviewWriteSerializer(serializers.ModelSerializer):
@@ -105,23 +404,116 @@ class ReviewWriteSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('The score must be in the range of 1 to 10.')
         return value
 
-    def validate(self, data):
-        request = self.context['request']
-        author = request.user
-        title_id = self.context.get('view').kwargs.get('title_id')
-        title = get_object_or_404(Title, pk=title_id)
-        if (
-                request.method == 'POST'
-                and Review.objects.filter(title=title, author=author).exists()
-        ):
-            raise serializers.ValidationError('The review of this title already exists.')
-        return data
-
-
-class CommentSerializer(serializers.ModelSerializer):
-    author = serializers.SlugRelatedField(queryset=User.objects.all(), slug_field='username', required=False)
+    def create(self, validated_data):
+        # повторный отзыв отсекается ограничением БД api_review_unique_title_author, без предварительного запроса
+        try:
+            with transaction.atomic():
+                return super().create(validated_data)
+        except IntegrityError:
+            # другие нарушения (внешний ключ, NOT NULL) - не повторный отзыв
+            if not _review_exists(validated_data['author'], [validated_data['title'].pk]):
+                raise
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: ['The review of this title already exists.']
+            })
+
+
+class CommentSerializer(ValuesSerializerMixin, TimedSerializerMixin, serializers.ModelSerializer):
+    author = CachedUsernameField(queryset=User.objects.all(), required=False)
     review = serializers.SlugRelatedField(queryset=Review.objects.all(), slug_field='text', required=False)
 
     class Meta:
         fields = ('id', 'text', 'author', 'review', 'pub_date')
         model = Comment
+        select_related = ('review',)
+        list_serializer_class = TimedListSerializer
+        field_columns = {'author': ('author_id',), 'review': ('review__text',)}
+        # курсор ленты и теги кэша комментариев
+        load_always = ('pub_date', 'author_id')
+
+    def row_getters(self, rows) -> dict:
+        return _feed_getters(self.fields, rows, review=attrgetter('review__text'))
+
+
+class ReviewListSerializer(serializers.ListSerializer):
+    """
+    Пакетное создание и изменение отзывов текущего пользователя (ReviewBulkView).
+    Существование произведений и повторные отзывы проверяются одним запросом на пакет,
+    рейтинг пересчитывается и кэш инвалидируется один раз по затронутым произведениям
+    """
+
+    def to_internal_value(self, data):
+        # ошибки по элементам пакета (validate() свел бы их в non_field_errors)
+        attrs = super().to_internal_value(data)
+        if self.instance is not None:
+            _batch_errors([
+                {'title': ['The title of a review cannot be changed.']} if 'title_id' in item else {} for item in attrs
+            ])
+            return attrs
+
+        title_ids = {item['title_id'] for item in attrs}
+        titles = set(Title.objects.filter(pk__in=title_ids).values_list('pk', flat=True))
+        reviewed = set(Review.objects.filter(
+            author=self.context['request'].user, title_id__in=titles).values_list('title_id', flat=True))
+        repeated = Counter(item['title_id'] for item in attrs)
+        errors = []
+        for item in attrs:
+            if item['title_id'] not in titles:
+                errors.append({'title': [f'Title {item["title_id"]} does not exist.']})
+            elif item['title_id'] in reviewed or repeated[item['title_id']] > 1:
+                errors.append({api_settings.NON_FIELD_ERRORS_KEY: ['The review of this title already exists.']})
+            else:
+                errors.append({})
+        _batch_errors(errors)
+        return attrs
+
+    def create(self, validated_data):
+        author = self.context['request'].user
+        reviews = [Review(author=author, **item) for item in validated_data]
+        title_ids = {review.title_id for review in reviews}
+        try:
+            with transaction.atomic():
+                Title.objects.filter(pk__in=title_ids).lock()
+                Review.objects.bulk_create(reviews)
+                Title.objects.filter(pk__in=title_ids).rebuild_rating()
+                TitleRanking.objects.sync(title_ids)
+        except IntegrityError:
+            # отзыв того же автора, записанный параллельным запросом; другие нарушения не маскируются
+            if not _review_exists(author, title_ids):
+                raise
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: ['The review of this title already exists.']
+            })
+        invalidate_tags(*[title_tag(pk) for pk in title_ids])
+        if reviews and reviews[0].pk is None:
+            # SQLite (Django 3.2) не возвращает id из bulk_create: пара (title, author) уникальна
+            created = Review.objects.filter(author=author, title_id__in=title_ids)
+            created = {review.title_id: review for review in created}
+            reviews = [created[review.title_id] for review in reviews]
+        return reviews
+
+    def update(self, instances, validated_data):
+        fields = set()
+        for review, item in zip(instances, validated_data):
+            for attr, value in item.items():
+                setattr(review, attr, value)
+                fields.add(attr)
+        title_ids = {review.title_id for review in instances}
+        with transaction.atomic():
+            if 'score' in fields:
+                Title.objects.filter(pk__in=title_ids).lock()
+            if fields:
+                Review.objects.bulk_update(instances, fields)
+            if 'score' in fields:
+                Title.objects.filter(pk__in=title_ids).rebuild_rating()
+                TitleRanking.objects.filter(title_id__in=title_ids).update_from_title()
+        invalidate_tags(*[title_tag(pk) for pk in title_ids], *[review_tag(review.pk) for review in instances])
+        return instances
+
+
+class ReviewBulkSerializer(ReviewWriteSerializer):
+    title = serializers.IntegerField(source='title_id')
+
+    class Meta(ReviewWriteSerializer.Meta):
+        fields = ('id', 'title', 'text', 'score', 'pub_date')
+        list_serializer_class = ReviewListSerializer
@@ -0,0 +1,234 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from users.models import User
+from .models import Category, Genre, Title, TitleRanking, Review, Comment, trending_weight
+from .utils.cache_functions import (
+    invalidate_tags,
+    title_tag,
+    review_tag,
+    comments_tag,
+    user_tag,
+    category_tag,
+    genre_tag,
+    TITLES_TAG,
+    TITLE_SEARCH_TAG,
+    CATEGORIES_TAG,
+    GENRES_TAG,
+)
+from .utils.reference_cache import AUTH_TOKENS, AUTH_USERS, CATEGORIES, GENRES, USERNAMES
+
+
+@receiver(pre_save, sender=Review)
+def remember_review_score(sender, instance, **kwargs):
+    # запоминаем прежние title и score, чтобы при изменении отзыва применить разницу
+    instance._rating_state = None
+    if instance.pk:
+        instance._rating_state = Review.objects.filter(pk=instance.pk).values_list('title_id', 'score').first()
+
+
+@receiver(post_save, sender=Review)
+def update_rating_on_save(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_rating_state', None)
+    if created or previous is None:
+        Title.objects.filter(pk=instance.title_id).update_rating(added=instance.score)
+        invalidate_tags(title_tag(instance.title_id))
+        return
+    title_id, score = previous
+    if title_id != instance.title_id:
+        Title.objects.filter(pk=title_id).update_rating(removed=score)
+        Title.objects.filter(pk=instance.title_id).update_rating(added=instance.score)
+        invalidate_tags(title_tag(title_id), title_tag(instance.title_id))
+    elif score != instance.score:
+        Title.objects.filter(pk=title_id).update_rating(added=instance.score, removed=score)
+        invalidate_tags(title_tag(title_id))
+
+
+@receiver(post_delete, sender=Review)
+def update_rating_on_delete(sender, instance, **kwargs):
+    # срабатывает и при каскадном удалении отзывов вместе с пользователем
+    Title.objects.filter(pk=instance.title_id).update_rating(removed=instance.score)
+    invalidate_tags(title_tag(instance.title_id))
+
+
+@receiver(post_save, sender=Review)
+def update_rankings_on_save(sender, instance, created, **kwargs):
+    # после update_rating_on_save: рейтинг копируется из уже обновленного Title
+    previous = getattr(instance, '_rating_state', None)
+    weight = trending_weight(instance.pub_date)
+    if created or previous is None:
+        TitleRanking.objects.filter(title_id=instance.title_id).update_from_title(added=weight)
+        return
+    title_id, score = previous
+    if title_id != instance.title_id:
+        TitleRanking.objects.filter(title_id=title_id).update_from_title(removed=weight)
+        TitleRanking.objects.filter(title_id=instance.title_id).update_from_title(added=weight)
+    elif score != instance.score:
+        TitleRanking.objects.filter(title_id=title_id).update_from_title()
+
+
+@receiver(post_delete, sender=Review)
+def update_rankings_on_delete(sender, instance, **kwargs):
+    weight = trending_weight(instance.pub_date)
+    TitleRanking.objects.filter(title_id=instance.title_id).update_from_title(removed=weight)
+
+
+def _category_slugs(*pks):
+    return list(Category.objects.filter(pk__in=[pk for pk in pks if pk]).values_list('slug', flat=True))
+
+
+@receiver(pre_save, sender=Title)
+def remember_title_state(sender, instance, **kwargs):
+    instance._cache_state = None
+    if instance.pk:
+        instance._cache_state = Title.objects.filter(pk=instance.pk).values_list(
+            'name', 'year', 'category_id').first()
+
+
+@receiver(post_save, sender=Title)
+def invalidate_title_on_save(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_cache_state', None)
+    tags = [title_tag(instance.pk)]
+    if created or previous is None or previous[0] != instance.name:
+        Title.objects.filter(pk=instance.pk).update_search_vector()
+    if created or previous is None:
+        tags.append(TITLES_TAG)
+        tags += [category_tag(slug) for slug in _category_slugs(instance.category_id)]
+    else:
+        name, year, category_id = previous
+        if (name, year) != (instance.name, instance.year):
+            tags.append(TITLE_SEARCH_TAG)
+        if category_id != instance.category_id:
+            tags += [category_tag(slug) for slug in _category_slugs(category_id, instance.category_id)]
+    invalidate_tags(*tags)
+
+
+@receiver(post_save, sender=Title)
+def sync_rankings_on_save(sender, instance, created, **kwargs):
+    # разрезы рейтингов зависят от года и категории
+    previous = getattr(instance, '_cache_state', None)
+    if created or previous is None or previous[1:] != (instance.year, instance.category_id):
+        TitleRanking.objects.sync([instance.pk])
+
+
+@receiver(pre_delete, sender=Title)
+def remember_title_tags(sender, instance, **kwargs):
+    # связи M2M удаляются каскадно без m2m_changed, поэтому жанры собираем до удаления
+    tags = [title_tag(instance.pk), TITLES_TAG]
+    tags += [category_tag(slug) for slug in _category_slugs(instance.category_id)]
+    tags += [genre_tag(slug) for slug in instance.genre.values_list('slug', flat=True)]
+    instance._cache_tags = tags
+
+
+@receiver(post_delete, sender=Title)
+def invalidate_title_on_delete(sender, instance, **kwargs):
+    invalidate_tags(*getattr(instance, '_cache_tags', [title_tag(instance.pk), TITLES_TAG]))
+
+
+@receiver(m2m_changed, sender=Title.genre.through)
+def invalidate_title_genres(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        # изменение со стороны жанра: instance - Genre, pk_set - произведения
+        titles = pk_set if pk_set is not None else instance.titles.values_list('pk', flat=True)
+        tags = [genre_tag(instance.slug)] + [title_tag(pk) for pk in titles]
+    else:
+        genres = Genre.objects.filter(pk__in=pk_set) if pk_set is not None else instance.genre.all()
+        tags = [title_tag(instance.pk)] + [genre_tag(slug) for slug in genres.values_list('slug', flat=True)]
+    invalidate_tags(*tags)
+
+
+@receiver(m2m_changed, sender=Title.genre.through)
+def sync_rankings_on_genres_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        TitleRanking.objects.sync([instance.pk])
+    elif action == 'post_clear':
+        TitleRanking.objects.filter(scope=f'genre:{instance.pk}').delete()
+    else:
+        TitleRanking.objects.sync(pk_set)
+
+
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Genre)
+def delete_rankings(sender, instance, **kwargs):
+    # связи с произведениями удаляются без сигналов (SET_NULL, каскад M2M)
+    TitleRanking.objects.filter(scope=f'{sender._meta.model_name}:{instance.pk}').delete()
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Genre)
+def remember_slug(sender, instance, **kwargs):
+    instance._cache_slug = None
+    if instance.pk:
+        instance._cache_slug = sender.objects.filter(pk=instance.pk).values_list('slug', flat=True).first()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    slugs = {instance.slug, getattr(instance, '_cache_slug', None) or instance.slug}
+    invalidate_tags(CATEGORIES_TAG, *[category_tag(slug) for slug in slugs])
+    CATEGORIES.invalidate(*slugs)
+
+
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def invalidate_genre(sender, instance, **kwargs):
+    slugs = {instance.slug, getattr(instance, '_cache_slug', None) or instance.slug}
+    invalidate_tags(GENRES_TAG, *[genre_tag(slug) for slug in slugs])
+    GENRES.invalidate(*slugs)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    USERNAMES.invalidate(instance.pk)
+    AUTH_USERS.invalidate(instance.pk)
+    invalidate_tags(user_tag(instance.pk))
+
+
+@receiver(post_save, sender=Token)
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    AUTH_TOKENS.invalidate(instance.key)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review(sender, instance, **kwargs):
+    invalidate_tags(review_tag(instance.pk))
+
+
+@receiver(pre_save, sender=Comment)
+def remember_comment_review(sender, instance, **kwargs):
+    instance._review_id = None
+    if instance.pk:
+        instance._review_id = Comment.objects.filter(pk=instance.pk).values_list('review_id', flat=True).first()
+
+
+@receiver(post_save, sender=Comment)
+def update_comment_count_on_save(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_review_id', None)
+    if created or previous is None:
+        Review.objects.filter(pk=instance.review_id).update_comment_count(1)
+        invalidate_tags(review_tag(instance.review_id))
+    elif previous != instance.review_id:
+        Review.objects.filter(pk=previous).update_comment_count(-1)
+        Review.objects.filter(pk=instance.review_id).update_comment_count(1)
+        invalidate_tags(review_tag(previous), review_tag(instance.review_id), comments_tag(previous))
+
+
+@receiver(post_delete, sender=Comment)
+def update_comment_count_on_delete(sender, instance, **kwargs):
+    # при каскадном удалении отзыва обновляется уже удаляемая строка - без последствий
+    Review.objects.filter(pk=instance.review_id).update_comment_count(-1)
+    invalidate_tags(review_tag(instance.review_id))
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comments(sender, instance, **kwargs):
+    invalidate_tags(comments_tag(instance.review_id))
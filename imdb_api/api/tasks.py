@@ -1,7 +1,73 @@
+from io import BytesIO
+from smtplib import SMTPException
+from urllib.parse import unquote_to_bytes, urlsplit
+from celery.utils.time import get_exponential_backoff_interval
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIRequest
+from django.utils.module_loading import import_string
 from imdb_api.celery import app
-from api.utils.send_email import send_email
+from api.utils.send_email import queue_email, schedule_flush, send_outbox_batch
 
 
 @app.task
 def send_email_task(mail_subject: str, message: str, to_email: str):
-    send_email(mail_subject=mail_subject, message=message, to_email=to_email)
+    queue_email(mail_subject=mail_subject, message=message, to_email=to_email)
+
+
+@app.task(bind=True, ignore_result=True, max_retries=settings.EMAIL_MAX_RETRIES)
+def flush_email_outbox(self):
+    """
+    Отправка пакета писем из очереди исходящих (очередь Celery email, CELERY_TASK_ROUTES).
+    При ошибке почтового сервера письма остаются в очереди, задача повторяется
+    с экспоненциально растущей задержкой
+    """
+    try:
+        delay = send_outbox_batch()
+    except (SMTPException, OSError) as exc:
+        countdown = get_exponential_backoff_interval(
+            settings.EMAIL_RETRY_BACKOFF, self.request.retries, settings.EMAIL_RETRY_BACKOFF_MAX, full_jitter=True)
+        raise self.retry(exc=exc, countdown=countdown)
+    if delay == 0:
+        # пакет отправлен, в очереди остались письма
+        flush_email_outbox.delay()
+    elif delay is not None:
+        # все оставшиеся письма - сверх лимитов доменов: продолжение после смены окна
+        schedule_flush(delay)
+
+
+def refresh_request(url: str) -> WSGIRequest:
+    """
+    GET-запрос по адресу url с тем же окружением WSGI, что у запроса, полученного сервером:
+    адрес и строка запроса сохраняются без изменений, от них зависит ключ кэша
+    """
+    parsed = urlsplit(url)
+    secure = parsed.scheme == 'https'
+    environ = {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        # PATH_INFO по PEP 3333 - байты пути, декодированные как latin-1
+        'PATH_INFO': unquote_to_bytes(parsed.path).decode('iso-8859-1'),
+        'QUERY_STRING': parsed.query,
+        'SERVER_NAME': parsed.hostname,
+        'SERVER_PORT': str(parsed.port or (443 if secure else 80)),
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': parsed.netloc,
+        'wsgi.url_scheme': parsed.scheme,
+        'wsgi.input': BytesIO(),
+    }
+    if secure and settings.SECURE_PROXY_SSL_HEADER:
+        header, value = settings.SECURE_PROXY_SSL_HEADER
+        environ[header] = value
+    return WSGIRequest(environ)
+
+
+@app.task(ignore_result=True)
+def refresh_cached_response(view_path: str, url: str, view_kwargs: dict):
+    """
+    Пересчет ответа, закэшированного cache_response: один раз для всех запросов,
+    получивших устаревшие данные. Данные закэшированных view не зависят от пользователя,
+    поэтому запрос выполняется анонимно и без лимитов запросов
+    """
+    request = refresh_request(url)
+    request.cache_refresh = True
+    import_string(view_path).as_view(throttle_classes=())(request, **view_kwargs)
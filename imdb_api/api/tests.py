@@ -1,3 +1,1168 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from smtplib import SMTPException
+from unittest import mock, skipUnless
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from redis.exceptions import ConnectionError as RedisConnectionError
+from imdb_api.celery import app as celery_app
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from users.models import User
+from . import checks, db_router, pagination, views
+from .authentication import CachedJWTAuthentication, CachedTokenAuthentication
+from .async_views import async_view
+from .metrics import REGISTRY, RequestStats, request_stats
+from .models import Category, Genre, Title, TitleQuerySet, TitleRanking, Review, Comment
+from .renderers import FastJSONRenderer
+from .serializer import ReviewWriteSerializer
+from .tasks import flush_email_outbox, refresh_cached_response
+from .utils import pools, reference_cache, send_email
+from .utils.cache_functions import get_tag_versions, invalidate_tags, title_tag
+from .utils.reference_cache import AUTH_TOKENS, CATEGORIES, GENRES, USERNAMES, ReferenceCache
 
-# Create your tests here.
+LOCMEM_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def clear_caches():
+    cache.clear()
+    for reference_cache in ReferenceCache.registry.values():
+        reference_cache.discard_local()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class TitleSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ('The Godfather', 'The Godfather Part II', 'Goodfellas', 'Casablanca'):
+            Title.objects.create(name=name, year=1990)
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, value):
+        response = APIClient().get('/api/v1/titles/', {'name': value})
+        return [title['name'] for title in response.data['results']]
+
+    def test_prefix(self):
+        self.assertCountEqual(self.search('godf'), ['The Godfather', 'The Godfather Part II'])
+
+    def test_substring(self):
+        self.assertEqual(self.search('sablan'), ['Casablanca'])
+
+    def test_no_match(self):
+        self.assertEqual(self.search('matrix'), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ResponseCacheTest(TestCase):
+    """
+    Устаревший ответ отдается, пока его пересчитывает один запрос или задача Celery
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.title = Title.objects.create(name='old', year=2000)
+
+    def setUp(self):
+        cache.clear()
+        self.path = f'/api/v1/titles/{self.title.pk}/'
+        url_hash = hashlib.md5(f'http://testserver{self.path}'.encode()).hexdigest()
+        self.key = f'title-view:{url_hash}'
+        self.lock_key = f'{self.key}:lock'
+
+    def get_name(self):
+        return APIClient().get(self.path).data['name']
+
+    def rename(self):
+        self.title.name = 'new'
+        self.title.save()
+
+    def expire(self):
+        # срок записи истек, данные изменились без инвалидации тегов
+        versions, data, expires, delta = cache.get(self.key)
+        cache.set(self.key, (versions, data, 0, delta))
+        Title.objects.filter(pk=self.title.pk).update(name='new')
+
+    def test_stale_while_revalidate(self):
+        etag = APIClient().get(self.path)['ETag']
+        self.expire()
+        # блокировка занята: ответ пересчитывает другой запрос
+        cache.add(self.lock_key, 1)
+        response = APIClient().get(self.path)
+        self.assertEqual((response.data['name'], response['ETag']), ('old', etag))
+        cache.delete(self.lock_key)
+        self.assertEqual(self.get_name(), 'new')
+        self.assertIsNone(cache.get(self.lock_key))
+
+    def test_invalidated_entry(self):
+        # запись, инвалидированная тегом, не отдается как устаревшая: запрос ждет пересчета,
+        # затем строит ответ сам
+        etag = APIClient().get(self.path)['ETag']
+        self.rename()
+        cache.add(self.lock_key, 1)
+        with mock.patch('api.utils.cache_functions.LOCK_WAIT', 0.1):
+            response = APIClient().get(self.path, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.data['name'], 'new')
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(CACHE_REFRESH_IN_BACKGROUND=True)
+    def test_background_refresh(self):
+        self.get_name()
+        self.expire()
+        with mock.patch.object(refresh_cached_response, 'delay') as delay:
+            self.assertEqual(self.get_name(), 'old')
+            self.assertEqual(self.get_name(), 'old')
+        delay.assert_called_once_with(
+            'api.views.TitleRetrieveUpdateDestroyView', f'http://testserver{self.path}', {'title_id': self.title.pk})
+
+        refresh_cached_response(*delay.call_args.args)
+        self.assertIsNone(cache.get(self.lock_key))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_name(), 'new')
+
+    def test_invalidation_on_commit(self):
+        # внутри транзакции версия тега меняется при записи и еще раз после коммита
+        tags = [title_tag(self.title.pk)]
+        before = get_tag_versions(tags)
+        with self.captureOnCommitCallbacks(execute=True):
+            invalidate_tags(*tags)
+            during = get_tag_versions(tags)
+        self.assertNotEqual(during, before)
+        self.assertNotEqual(get_tag_versions(tags), during)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class QueryCountTest(TestCase):
+    """
+    Число запросов к БД на эндпоинт не должно зависеть от размера страницы (нет N+1)
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        genres = [Genre.objects.create(name=f'genre {i}', slug=f'genre-{i}') for i in range(3)]
+        for i in range(10):
+            category = Category.objects.create(name=f'category {i}', slug=f'category-{i}')
+            title = Title.objects.create(name=f'title {i}', year=2000 + i, category=category)
+            title.genre.set(genres)
+        cls.title = title
+        for i in range(10):
+            author = User.objects.create(username=f'user-{i}', email=f'user-{i}@example.com')
+            review = Review.objects.create(text='review', title=cls.title, author=author, score=i + 1)
+            Comment.objects.create(text='comment', review=review, author=author)
+        cls.review = review
+
+    def setUp(self):
+        clear_caches()
+        self.client = APIClient()
+
+    def test_title_list(self):
+        # COUNT, произведения с категориями, жанры
+        with self.assertNumQueries(3):
+            self.client.get('/api/v1/titles/')
+
+    def test_title_detail(self):
+        with self.assertNumQueries(2):
+            self.client.get(f'/api/v1/titles/{self.title.pk}/')
+
+    def test_review_list(self):
+        # произведение, COUNT, отзывы с произведением; имена авторов одним запросом, затем из кэша вместе с COUNT
+        with self.assertNumQueries(4):
+            self.client.get(f'/api/v1/titles/{self.title.pk}/reviews/')
+        with self.assertNumQueries(2):
+            self.client.get(f'/api/v1/titles/{self.title.pk}/reviews/')
+
+    def test_review_list_cursor(self):
+        # курсорная пагинация: без COUNT(*)
+        USERNAMES.get_many(User.objects.values_list('pk', flat=True))
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/v1/titles/{self.title.pk}/reviews/?pagination=cursor')
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_comment_list(self):
+        # отзыв вместе с произведением, COUNT, комментарии с отзывом (имена авторов в кэше)
+        USERNAMES.get_many(User.objects.values_list('pk', flat=True))
+        with self.assertNumQueries(3):
+            self.client.get(f'/api/v1/titles/{self.title.pk}/reviews/{self.review.pk}/comments/')
+
+    def test_comment_detail(self):
+        comment = self.review.comments.get()
+        USERNAMES.get(comment.author_id)
+        # путь title -> review -> comment проверяется одним запросом
+        with self.assertNumQueries(1):
+            self.client.get(f'/api/v1/titles/{self.title.pk}/reviews/{self.review.pk}/comments/{comment.pk}/')
+
+    def test_nested_not_found(self):
+        other = Title.objects.create(name='other', year=2000)
+        response = self.client.get(f'/api/v1/titles/{other.pk}/reviews/{self.review.pk}/comments/')
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ReferenceCacheTest(TestCase):
+    """
+    Slug категорий и жанров и имена авторов берутся из кэша процесса и сбрасываются при изменении
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='movie', slug='movie')
+        cls.genre = Genre.objects.create(name='drama', slug='drama')
+        cls.admin = User.objects.create(username='admin', email='admin@example.com', role='admin')
+
+    def setUp(self):
+        clear_caches()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def test_slug_resolution(self):
+        data = {'name': 'title', 'year': 2000, 'category': 'movie', 'genre': ['drama']}
+        self.client.post('/api/v1/titles/', data)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/v1/titles/', data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.data['category'], response.data['genre']), ('movie', ['drama']))
+        lookups = [query['sql'] for query in context.captured_queries if '"slug" IN' in query['sql']
+                   or '"slug" =' in query['sql']]
+        self.assertEqual(lookups, [])
+
+    def test_unknown_slug(self):
+        response = self.client.post('/api/v1/titles/', {'name': 'title', 'year': 2000, 'category': 'missing'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('category', response.data)
+
+    def test_invalidation(self):
+        self.assertEqual(CATEGORIES.get('movie')['name'], 'movie')
+        self.category.slug = 'film'
+        self.category.save()
+        self.assertIsNone(CATEGORIES.get('movie'))
+        self.assertEqual(CATEGORIES.get('film')['id'], self.category.pk)
+
+        self.assertEqual(USERNAMES.get(self.admin.pk), 'admin')
+        self.admin.username = 'root'
+        self.admin.save()
+        self.assertEqual(USERNAMES.get(self.admin.pk), 'root')
+
+    def test_invalidation_after_commit(self):
+        # повтор после коммита нужен только внутри транзакции, иначе ключи сбрасываются один раз
+        with mock.patch.object(CATEGORIES, '_invalidate') as invalidate:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                CATEGORIES.invalidate('movie')
+            self.assertEqual((invalidate.call_count, len(callbacks)), (2, 1))
+            invalidate.reset_mock()
+            with mock.patch.object(connection, 'in_atomic_block', False):
+                with self.captureOnCommitCallbacks() as callbacks:
+                    CATEGORIES.invalidate('movie')
+            self.assertEqual((invalidate.call_count, len(callbacks)), (1, 0))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AuthCacheTest(TestCase):
+    """
+    JWT и токены DRF проверяются без запросов к БД; изменения пользователя и токена сбрасывают кэш
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='user', email='user@example.com')
+
+    def setUp(self):
+        clear_caches()
+
+    def authenticate(self, authenticator, header: str):
+        return authenticator.authenticate(RequestFactory().get('/', HTTP_AUTHORIZATION=header))
+
+    def test_jwt(self):
+        header = f'Bearer {AccessToken.for_user(self.user)}'
+        self.assertEqual(self.authenticate(CachedJWTAuthentication(), header)[0], self.user)
+        with self.assertNumQueries(0):
+            user, _ = self.authenticate(CachedJWTAuthentication(), header)
+        self.assertEqual((user.username, user.role), ('user', 'user'))
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                (user.email, user.is_staff, user.is_superuser, user.last_login, user.date_joined),
+                (self.user.email, False, False, None, self.user.date_joined))
+        self.assertEqual(user.get_deferred_fields(), {'password'})
+
+        self.user.role = 'admin'
+        self.user.save()
+        self.assertEqual(self.authenticate(CachedJWTAuthentication(), header)[0].role, 'admin')
+        self.user.is_active = False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(CachedJWTAuthentication(), header)
+
+    def test_token(self):
+        token = Token.objects.create(user=self.user)
+        header = f'Token {token.key}'
+        self.authenticate(CachedTokenAuthentication(), header)
+        with self.assertNumQueries(0):
+            user, auth = self.authenticate(CachedTokenAuthentication(), header)
+        self.assertEqual((user.pk, auth.key), (self.user.pk, token.key))
+
+        token.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate(CachedTokenAuthentication(), header)
+
+    def test_token_invalidation_message(self):
+        # ключ токена не попадает в канал pub/sub: другие процессы сбрасывают запись по хэшу
+        token = Token.objects.create(user=self.user)
+        self.assertEqual(AUTH_TOKENS.get(token.key), self.user.pk)
+        redis = mock.Mock()
+        with mock.patch.object(reference_cache, '_uses_redis', return_value=True):
+            with mock.patch.object(reference_cache, 'get_redis_connection', return_value=redis):
+                AUTH_TOKENS.invalidate(token.key)
+        channel, message = redis.publish.call_args.args
+        self.assertNotIn(token.key, message)
+        AUTH_TOKENS.get(token.key)
+        self.assertIn(token.key, AUTH_TOKENS._local)
+        reference_cache._on_message(message)
+        self.assertNotIn(token.key, AUTH_TOKENS._local)
+
+    def test_listener_survives_malformed_messages(self):
+        class Stop(BaseException):
+            pass
+
+        token = Token.objects.create(user=self.user)
+        AUTH_TOKENS.get(token.key)
+        messages = [b'not json', json.dumps({'cache': 'unknown', 'keys': []}), json.dumps({'keys': []}),
+                    json.dumps({'cache': AUTH_TOKENS.name, 'keys': AUTH_TOKENS._published_keys([token.key])})]
+        redis = mock.Mock()
+        redis.pubsub.return_value.listen.return_value = [{'data': message} for message in messages]
+        with mock.patch.object(reference_cache, 'get_redis_connection', side_effect=[redis, Stop]):
+            with self.assertRaises(Stop), self.assertLogs(reference_cache.logger, 'WARNING') as logs:
+                reference_cache._listen()
+        self.assertEqual(len(logs.records), 2)
+        self.assertNotIn(token.key, AUTH_TOKENS._local)
+
+    def test_permissions(self):
+        client = APIClient(HTTP_AUTHORIZATION=f'Bearer {AccessToken.for_user(self.user)}')
+        self.assertEqual(client.post('/api/v1/categories/', {'name': 'film', 'slug': 'film'}).status_code, 403)
+        self.user.role = 'admin'
+        self.user.save()
+        self.assertEqual(client.post('/api/v1/categories/', {'name': 'film', 'slug': 'film'}).status_code, 201)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ConditionalGetTest(TestCase):
+    """
+    ETag / Last-Modified по версиям тегов: 304 без запросов к БД, новый ETag после изменения
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.title = Title.objects.create(name='title', year=2000)
+        cls.author = User.objects.create(username='author', email='author@example.com')
+        cls.review = Review.objects.create(text='review', title=cls.title, author=cls.author, score=5)
+        Comment.objects.create(text='comment', review=cls.review, author=cls.author)
+
+    def setUp(self):
+        clear_caches()
+        self.client = APIClient()
+
+    def assertNotModified(self, path):
+        response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+        return response
+
+    def assertModified(self, path, response):
+        changed = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+
+    def test_title(self):
+        path = f'/api/v1/titles/{self.title.pk}/'
+        response = self.assertNotModified(path)
+        self.assertEqual(
+            self.client.get(path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        Review.objects.create(text='review', title=self.title, author=User.objects.create(username='other'), score=9)
+        self.assertModified(path, response)
+
+    def test_review(self):
+        path = f'/api/v1/titles/{self.title.pk}/reviews/{self.review.pk}/'
+        response = self.assertNotModified(path)
+        self.author.username = 'renamed'
+        self.author.save()
+        self.assertModified(path, response)
+
+    def test_comments(self):
+        path = f'/api/v1/titles/{self.title.pk}/reviews/{self.review.pk}/comments/'
+        response = self.assertNotModified(path)
+        Comment.objects.create(text='new', review=self.review, author=self.author)
+        self.assertModified(path, response)
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class BulkWriteTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Category.objects.create(name='movie', slug='movie')
+        for slug in ('drama', 'comedy'):
+            Genre.objects.create(name=slug, slug=slug)
+        cls.titles = [Title.objects.create(name=f'title {i}', year=2000) for i in range(6)]
+        cls.admin = User.objects.create(username='admin', email='admin@example.com', role='admin')
+        cls.user = User.objects.create(username='user', email='user@example.com')
+
+    def setUp(self):
+        clear_caches()
+        self.client = APIClient()
+
+    def test_create_titles(self):
+        self.client.force_authenticate(self.admin)
+        self.assertEqual(self.client.get('/api/v1/titles/', {'genre': 'drama'}).data['count'], 0)
+        data = [{'name': f'new {i}', 'year': 2010, 'category': 'movie', 'genre': ['drama', 'comedy']} for i in range(3)]
+        response = self.client.post('/api/v1/titles/bulk/', data, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([title['name'] for title in response.data], ['new 0', 'new 1', 'new 2'])
+        self.assertEqual(response.data[0]['genre'], ['drama', 'comedy'])
+        # закэшированный список сброшен одной инвалидацией на пакет
+        self.assertEqual(self.client.get('/api/v1/titles/', {'genre': 'drama'}).data['count'], 3)
+
+    def test_create_titles_errors(self):
+        self.client.force_authenticate(self.admin)
+        data = [{'name': 'ok', 'year': 2010}, {'name': 'bad', 'year': 2010, 'category': 'missing'}]
+        response = self.client.post('/api/v1/titles/bulk/', data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0], {})
+        self.assertIn('category', response.data[1])
+        self.assertFalse(Title.objects.filter(name='ok').exists())
+
+    def test_update_titles(self):
+        self.client.force_authenticate(self.admin)
+        title = self.titles[0]
+        self.client.get(f'/api/v1/titles/{title.pk}/')
+        data = [{'id': title.pk, 'name': 'renamed', 'genre': ['comedy']}, {'id': self.titles[1].pk, 'year': 1999}]
+        response = self.client.patch('/api/v1/titles/bulk/', data, format='json')
+        self.assertEqual(response.status_code, 200)
+        detail = self.client.get(f'/api/v1/titles/{title.pk}/').data
+        self.assertEqual((detail['name'], [genre['slug'] for genre in detail['genre']]), ('renamed', ['comedy']))
+        self.assertEqual(Title.objects.get(pk=self.titles[1].pk).year, 1999)
+
+    def test_titles_admin_only(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.post('/api/v1/titles/bulk/', [{'name': 'new', 'year': 2010}], format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def create_reviews(self, titles):
+        data = [{'title': title.pk, 'text': 'review', 'score': 8} for title in titles]
+        return self.client.post('/api/v1/reviews/bulk/', data, format='json')
+
+    def test_create_reviews(self):
+        self.client.force_authenticate(self.user)
+        response = self.create_reviews(self.titles[:2])
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(all(review['id'] for review in response.data))
+        self.assertEqual(Title.objects.get(pk=self.titles[0].pk).rating, 8)
+
+        response = self.create_reviews([self.titles[1], self.titles[2], self.titles[2]])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('non_field_errors', response.data[0])
+        self.assertIn('non_field_errors', response.data[2])
+
+    def test_create_reviews_query_count(self):
+        # проверка и запись пакета - фиксированное число запросов, независимо от размера
+        self.client.force_authenticate(self.user)
+        with CaptureQueriesContext(connection) as small:
+            self.create_reviews(self.titles[:2])
+        with CaptureQueriesContext(connection) as large:
+            self.create_reviews(self.titles[2:])
+        self.assertEqual(len(small), len(large))
+
+    def test_update_reviews(self):
+        self.client.force_authenticate(self.user)
+        ids = [review['id'] for review in self.create_reviews(self.titles[:2]).data]
+        response = self.client.patch('/api/v1/reviews/bulk/', [{'id': ids[0], 'score': 2}], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Title.objects.get(pk=self.titles[0].pk).rating, 2)
+
+        self.client.force_authenticate(User.objects.create(username='other', email='other@example.com'))
+        response = self.client.patch('/api/v1/reviews/bulk/', [{'id': ids[1], 'score': 2}], format='json')
+        self.assertEqual(response.status_code, 403)
+
+    def test_review_integrity_errors(self):
+        # повторный отзыв - ошибка валидации, остальные нарушения ограничений БД не маскируются
+        self.client.force_authenticate(self.user)
+        path = f'/api/v1/titles/{self.titles[0].pk}/reviews/'
+        self.assertEqual(self.client.post(path, {'text': 'review', 'score': 5}).status_code, 201)
+        serializer = ReviewWriteSerializer(data={'text': 'review', 'score': 5})
+        serializer.is_valid(raise_exception=True)
+        with self.assertRaisesMessage(ValidationError, 'The review of this title already exists.'):
+            serializer.save(author=self.user, title=self.titles[0])
+        with self.assertRaises(IntegrityError):
+            serializer.save(author=self.user, title=self.titles[1], text=None)
+
+    def test_reviews_lock_titles(self):
+        # полный пересчет рейтинга после пакетной записи - под блокировкой строк затронутых произведений
+        self.client.force_authenticate(self.user)
+        with mock.patch.object(TitleQuerySet, 'lock', autospec=True, side_effect=TitleQuerySet.lock) as lock:
+            ids = [review['id'] for review in self.create_reviews(self.titles[:2]).data]
+            self.client.patch('/api/v1/reviews/bulk/', [{'id': ids[0], 'score': 2}], format='json')
+        self.assertEqual(
+            [sorted(call.args[0].values_list('pk', flat=True)) for call in lock.call_args_list],
+            [sorted(title.pk for title in self.titles[:2]), [self.titles[0].pk]])
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class RankingTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        movie = Category.objects.create(name='movie', slug='movie')
+        drama = Genre.objects.create(name='drama', slug='drama')
+        comedy = Genre.objects.create(name='comedy', slug='comedy')
+        cls.titles = {}
+        rows = (('a', 2000, movie, drama), ('b', 2001, None, drama), ('c', 2000, movie, comedy))
+        for name, year, category, genre in rows:
+            cls.titles[name] = Title.objects.create(name=name, year=year, category=category)
+            cls.titles[name].genre.set([genre])
+        cls.users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+        for title, scores in (('a', (8, 6)), ('b', (9,)), ('c', (5,))):
+            for user, score in zip(cls.users, scores):
+                Review.objects.create(text='review', title=cls.titles[title], author=user, score=score)
+
+    def setUp(self):
+        clear_caches()
+        self.client = APIClient()
+
+    def names(self, path, **params):
+        response = self.client.get(path, params)
+        self.assertEqual(response.status_code, 200)
+        return [title['name'] for title in response.data]
+
+    def test_top_rated(self):
+        self.assertEqual(self.names('/api/v1/titles/top/'), ['b', 'a', 'c'])
+        self.assertEqual(self.names('/api/v1/titles/top/', genre='drama'), ['b', 'a'])
+        self.assertEqual(self.names('/api/v1/titles/top/', category='movie', limit=1), ['a'])
+        self.assertEqual(self.names('/api/v1/titles/top/', year=2000), ['a', 'c'])
+
+    def test_incremental_updates(self):
+        review = Review.objects.create(text='review', title=self.titles['c'], author=self.users[1], score=10)
+        self.assertEqual(self.names('/api/v1/titles/top/'), ['b', 'c', 'a'])
+        review.delete()
+        self.assertEqual(self.names('/api/v1/titles/top/'), ['b', 'a', 'c'])
+        self.titles['c'].genre.set(Genre.objects.filter(slug='drama'))
+        self.assertEqual(self.names('/api/v1/titles/top/', genre='drama'), ['b', 'a', 'c'])
+        self.assertEqual(self.names('/api/v1/titles/top/', genre='comedy'), [])
+
+    def test_trending(self):
+        # при равном числе отзывов выше произведение с более новым отзывом
+        self.assertEqual(self.names('/api/v1/titles/trending/'), ['a', 'c', 'b'])
+        # два давних отзыва весят меньше одного нового
+        Review.objects.filter(title=self.titles['a']).update(pub_date=timezone.now() - timedelta(days=60))
+        TitleRanking.objects.sync(title.pk for title in self.titles.values())
+        self.assertEqual(self.names('/api/v1/titles/trending/')[-1], 'a')
+
+    @override_settings(RANKING_TRENDING_HALF_LIFE=60 * 60)
+    def test_trending_log_scale(self):
+        # при коротком периоде полураспада 2 ** ((pub_date - TRENDING_EPOCH) / период) переполняет float,
+        # поэтому хранится log2 суммы весов
+        TitleRanking.objects.sync(title.pk for title in self.titles.values())
+        self.assertEqual(self.names('/api/v1/titles/trending/'), ['a', 'c', 'b'])
+        review = Review.objects.create(text='review', title=self.titles['b'], author=self.users[1], score=5)
+        self.assertEqual(self.names('/api/v1/titles/trending/'), ['b', 'a', 'c'])
+        review.delete()
+        Review.objects.get(title=self.titles['c']).delete()
+        self.assertEqual(self.names('/api/v1/titles/trending/'), ['a', 'b'])
+        incremental = dict(TitleRanking.objects.filter(scope='all').values_list('title_id', 'trending'))
+        TitleRanking.objects.sync(title.pk for title in self.titles.values())
+        for title_id, trending in TitleRanking.objects.filter(scope='all').values_list('title_id', 'trending'):
+            if trending is None:
+                self.assertIsNone(incremental[title_id])
+            else:
+                self.assertAlmostEqual(incremental[title_id], trending, places=6)
+
+    def test_half_life_setting(self):
+        self.assertEqual(checks.check_ranking_settings(None), [])
+        for value in (0, -60, '3600'):
+            with override_settings(RANKING_TRENDING_HALF_LIFE=value):
+                self.assertEqual([error.id for error in checks.check_ranking_settings(None)], ['api.E001'])
+
+    def test_invalid_scope(self):
+        self.assertEqual(self.client.get('/api/v1/titles/top/', {'genre': 'drama', 'year': 2000}).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/titles/top/', {'limit': 1000}).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/titles/top/', {'genre': 'unknown'}).status_code, 404)
+
+
+@skipUnless(settings.CELERY_BROKER_URL.startswith('memory://'), 'needs the in-memory Celery broker')
+@override_settings(CACHES=LOCMEM_CACHE, EMAIL_BATCH_SIZE=10, EMAIL_DOMAIN_RATE_LIMITS={'example.com': (2, 60)})
+class EmailOutboxTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        with celery_app.pool.acquire(block=True) as broker, broker.SimpleQueue(send_email.OUTBOX_QUEUE) as outbox:
+            outbox.clear()
+        # задача отправки запускается вручную
+        patcher = mock.patch.object(send_email, 'schedule_flush')
+        self.schedule_flush = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def outbox_size(self):
+        with celery_app.pool.acquire(block=True) as broker, broker.SimpleQueue(send_email.OUTBOX_QUEUE) as outbox:
+            return outbox.qsize()
+
+    def test_signup_is_queued(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = APIClient().post('/api/v1/auth/email/', {'email': 'new@example.org'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.outbox_size(), 1)
+        self.assertEqual(mail.outbox, [])
+        self.schedule_flush.assert_called_once_with(settings.EMAIL_BATCH_DELAY)
+
+    def test_signup_without_broker(self):
+        # брокер недоступен: письмо отправляется сразу, регистрация не падает
+        with mock.patch.object(send_email, 'queue_email', side_effect=OSError('broker unavailable')):
+            with self.assertLogs(send_email.logger, 'WARNING'), self.captureOnCommitCallbacks(execute=True):
+                response = APIClient().post('/api/v1/auth/email/', {'email': 'new@example.org'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([email.to for email in mail.outbox], [['new@example.org']])
+
+    def test_batch_over_one_connection(self):
+        for i in range(3):
+            send_email.queue_email('subject', 'body', f'user{i}@example.org')
+        with mock.patch.object(send_email, 'get_connection', wraps=send_email.get_connection) as get_connection:
+            flush_email_outbox()
+        get_connection.assert_called_once()
+        self.assertEqual(sorted(email.to[0] for email in mail.outbox), [f'user{i}@example.org' for i in range(3)])
+        self.assertEqual(self.outbox_size(), 0)
+
+    def test_domain_rate_limit(self):
+        for address in ('a@example.com', 'b@example.com', 'c@example.com', 'd@example.org'):
+            send_email.queue_email('subject', 'body', address)
+        self.assertEqual(send_email.send_outbox_batch(), 0)
+        self.assertEqual(len(mail.outbox), 3)
+        # письмо сверх лимита example.com ждет следующего окна
+        self.assertGreater(send_email.send_outbox_batch(), 0)
+        self.assertEqual((len(mail.outbox), self.outbox_size()), (3, 1))
+
+    def test_failed_batch_is_requeued(self):
+        send_email.queue_email('subject', 'body', 'user@example.org')
+        connection = mock.Mock(**{'send_messages.side_effect': SMTPException('unavailable')})
+        with mock.patch.object(send_email, 'get_connection', return_value=connection), \
+                self.assertRaises(SMTPException):
+            send_email.send_outbox_batch()
+        self.assertEqual(self.outbox_size(), 1)
+        send_email.send_outbox_batch()
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_partially_sent_batch(self):
+        # в очередь возвращаются только неотправленные письма
+        for i in range(3):
+            send_email.queue_email('subject', 'body', f'user{i}@example.org')
+        connection = mock.Mock(**{'send_messages.side_effect': [1, SMTPException('unavailable')]})
+        with mock.patch.object(send_email, 'get_connection', return_value=connection), \
+                self.assertRaises(SMTPException):
+            send_email.send_outbox_batch()
+        self.assertEqual(self.outbox_size(), 2)
+        connection.close.assert_called_once()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SummaryCountersTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.title = Title.objects.create(name='title', year=2000)
+        cls.users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(2)]
+
+    def setUp(self):
+        clear_caches()
+
+    def histogram(self):
+        return APIClient().get(f'/api/v1/titles/{self.title.pk}/').data['score_histogram']
+
+    def test_score_histogram(self):
+        first = Review.objects.create(text='review', title=self.title, author=self.users[0], score=7)
+        Review.objects.create(text='review', title=self.title, author=self.users[1], score=7)
+        self.assertEqual(self.histogram()['7'], 2)
+        first.score = 3
+        first.save()
+        histogram = self.histogram()
+        self.assertEqual((histogram['3'], histogram['7'], sum(histogram.values())), (1, 1, 2))
+        first.delete()
+        self.assertEqual(self.histogram(), {str(score): int(score == 7) for score in range(1, 11)})
+
+    def test_review_comment_count(self):
+        review = Review.objects.create(text='review', title=self.title, author=self.users[0], score=5)
+        comments = [Comment.objects.create(text='comment', review=review, author=user) for user in self.users]
+        path = f'/api/v1/titles/{self.title.pk}/reviews/'
+        self.assertEqual(APIClient().get(path).data['results'][0]['comment_count'], 2)
+        comments[0].delete()
+        self.assertEqual(APIClient().get(f'{path}{review.pk}/').data['comment_count'], 1)
+
+    def test_reconcile_counts(self):
+        review = Review.objects.create(text='review', title=self.title, author=self.users[0], score=5)
+        Comment.objects.create(text='comment', review=review, author=self.users[1])
+        Title.objects.update(score_5_count=0, review_count=3)
+        Review.objects.update(comment_count=7)
+        out = StringIO()
+        call_command('reconcile_counts', '--dry-run', stdout=out)
+        self.assertIn('titles: found 1', out.getvalue())
+        self.assertEqual(Review.objects.get().comment_count, 7)
+        call_command('reconcile_counts', stdout=StringIO())
+        self.title.refresh_from_db()
+        self.assertEqual((self.title.review_count, self.title.score_5_count), (1, 1))
+        self.assertEqual(Review.objects.get().comment_count, 1)
+
+    def test_reconcile_score_sum(self):
+        # количество и гистограмма верны, расходится только сумма оценок
+        for user, score in zip(self.users, (4, 8)):
+            Review.objects.create(text='review', title=self.title, author=user, score=score)
+        Title.objects.update(score_sum=100, rating=50)
+        call_command('reconcile_counts', stdout=StringIO())
+        self.title.refresh_from_db()
+        self.assertEqual((self.title.score_sum, self.title.rating), (12, 6))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class PaginationCountTest(TestCase):
+    """
+    COUNT(*) выполняется один раз на комбинацию фильтров до изменения ее тегов; ?count=false - без COUNT
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.title = Title.objects.create(name='title', year=2000)
+        cls.users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+        for i, user in enumerate(cls.users):
+            Review.objects.create(text='review', title=cls.title, author=user, score=i + 1)
+        cls.path = f'/api/v1/titles/{cls.title.pk}/reviews/'
+
+    def setUp(self):
+        clear_caches()
+
+    def get(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get(path)
+        counts = sum('COUNT(' in query['sql'] for query in queries.captured_queries)
+        return response.data, counts
+
+    def test_cached_count(self):
+        self.assertEqual(self.get(self.path), (mock.ANY, 1))
+        data, counts = self.get(f'{self.path}?page=1')
+        self.assertEqual((data['count'], counts), (3, 0))
+        Review.objects.filter(author=self.users[0]).get().delete()
+        data, counts = self.get(self.path)
+        self.assertEqual((data['count'], counts), (2, 1))
+
+    def test_without_count(self):
+        with mock.patch.object(pagination.FeedPagination, 'page_size', 2):
+            data, counts = self.get(f'{self.path}?count=false')
+            self.assertEqual(counts, 0)
+            self.assertNotIn('count', data)
+            self.assertEqual(len(data['results']), 2)
+            self.assertIn('page=2', data['next'])
+            data, counts = self.get(f'{self.path}?count=false&page=2')
+            self.assertEqual((len(data['results']), data['next']), (1, None))
+            self.assertIsNotNone(data['previous'])
+            response = APIClient().get(f'{self.path}?count=false&page=3')
+            self.assertEqual(response.status_code, 404)
+
+    def test_estimated_count(self):
+        Genre.objects.create(name='drama', slug='drama')
+        with mock.patch.object(pagination, 'estimated_count', return_value=250000) as estimated_count:
+            data, counts = self.get('/api/v1/genres/')
+            self.assertEqual((data['count'], counts), (250000, 0))
+            # оценка не определяет страницы: следующей страницы нет, несуществующая - 404
+            self.assertEqual((len(data['results']), data['next']), (1, None))
+            self.assertEqual(APIClient().get('/api/v1/genres/?page=2').status_code, 404)
+            # с фильтром оценка по таблице неприменима
+            self.assertEqual(APIClient().get('/api/v1/genres/?search=drama').data['count'], 1)
+        estimated_count.assert_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ImportDataTest(TestCase):
+    """
+    Рейтинг пересчитывается после записи чанков; --resume пропускает чанки, закоммиченные до сбоя
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.title = Title.objects.create(name='title', year=2000)
+        cls.users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(3)]
+
+    def setUp(self):
+        clear_caches()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'reviews.jsonl')
+        self.checkpoint_path = f'{self.path}.checkpoint'
+
+    def write(self, authors):
+        with open(self.path, 'w') as file:
+            for score, author in enumerate(authors, start=1):
+                file.write(json.dumps({'text': 'review', 'title': self.title.pk, 'author': author, 'score': score}))
+                file.write('\n')
+
+    def run_import(self, **options):
+        call_command('import_data', 'reviews', self.path, batch_size=1, stdout=StringIO(), **options)
+
+    def assertImported(self):
+        self.title.refresh_from_db()
+        self.assertEqual((Review.objects.count(), self.title.rating), (3, Decimal('2.00')))
+        self.assertEqual(TitleRanking.objects.get(title=self.title, scope='all').rating, Decimal('2.00'))
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_import(self):
+        self.write(user.username for user in self.users)
+        self.run_import()
+        self.assertImported()
+
+    def test_resume_after_failed_chunk(self):
+        self.write(['user0', 'unknown', 'user2'])
+        with self.assertRaisesMessage(CommandError, 'Rows from 2'):
+            self.run_import()
+        with open(self.checkpoint_path) as file:
+            self.assertEqual(json.load(file)['rows'], 1)
+        self.write(user.username for user in self.users)
+        self.run_import(resume=True)
+        self.assertImported()
+
+    def test_resume_skips_committed_chunks(self):
+        # второй чанк записан другим процессом до сбоя, пересчет рейтинга не выполнен
+        self.write(user.username for user in self.users)
+        Review.objects.bulk_create([Review(text='review', title=self.title, author=self.users[1], score=2)])
+        with open(self.checkpoint_path, 'w') as file:
+            json.dump({'rows': 0, 'batch_size': 1, 'committed': [1], 'rebuild': [self.title.pk]}, file)
+        self.run_import(resume=True)
+        self.assertImported()
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class ValuesSerializationTest(TestCase):
+    """
+    Списки, построенные из values_list и отрендеренные orjson, совпадают с ответами ModelSerializer байт в байт
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Фильм', slug='film')
+        genres = [Genre.objects.create(name=f'жанр {i}', slug=f'genre-{i}') for i in range(2)]
+        cls.title = Title.objects.create(name='title \u2028 "quoted" ✓', year=2000, category=category)
+        cls.title.genre.set(genres)
+        Title.objects.create(name='no category', year=2001)
+        users = [User.objects.create(username=f'user{i}', email=f'user{i}@example.com') for i in range(2)]
+        reviews = [Review.objects.create(text=f'отзыв {i}', title=cls.title, author=user, score=i + 7)
+                   for i, user in enumerate(users)]
+        Comment.objects.create(text='comment\n', review=reviews[0], author=users[1])
+        cls.review = reviews[0]
+
+    def get_content(self, path: str, fast: bool) -> bytes:
+        clear_caches()
+        with override_settings(VALUES_SERIALIZATION=fast):
+            response = APIClient().get(path)
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def test_identical_output(self):
+        reviews = f'/api/v1/titles/{self.title.pk}/reviews/'
+        for path in (
+                '/api/v1/titles/',
+                '/api/v1/titles/?genre=genre-0,genre-1',
+                '/api/v1/titles/top/',
+                reviews,
+                f'{reviews}?pagination=cursor',
+                f'{reviews}{self.review.pk}/comments/',
+        ):
+            with self.subTest(path=path):
+                self.assertEqual(self.get_content(path, fast=True), self.get_content(path, fast=False))
+
+    def test_renderer_fallback(self):
+        renderer = FastJSONRenderer()
+        data = {1: Decimal('1.50'), 'when': timezone.now(), 'big': 2 ** 70}
+        self.assertEqual(renderer.render(data), JSONRenderer().render(data))
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class SparseFieldsTest(TestCase):
+    """
+    ?fields= / ?omit= сокращают и ответ, и запросы к БД
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='film', slug='film')
+        cls.title = Title.objects.create(name='title', year=2000, category=category)
+        cls.title.genre.set([Genre.objects.create(name='drama', slug='drama')])
+        user = User.objects.create(username='user', email='user@example.com')
+        cls.review = Review.objects.create(text='review', title=cls.title, author=user, score=8)
+
+    def setUp(self):
+        clear_caches()
+
+    def get(self, path):
+        with CaptureQueriesContext(connection) as queries:
+            response = APIClient().get(path)
+        return response, [query['sql'] for query in queries.captured_queries]
+
+    def test_title_list(self):
+        for fast in (True, False):
+            clear_caches()
+            with self.subTest(fast=fast), override_settings(VALUES_SERIALIZATION=fast):
+                response, queries = self.get('/api/v1/titles/?fields=name,rating')
+                self.assertEqual(list(response.data['results'][0]), ['id', 'name', 'rating'])
+                # COUNT и произведения: без категорий, жанров и лишних столбцов
+                self.assertEqual(len(queries), 2)
+                self.assertNotIn('api_category', queries[1])
+                self.assertNotIn('"year"', queries[1])
+
+    def test_omit(self):
+        response, queries = self.get(f'/api/v1/titles/{self.title.pk}/reviews/?omit=title,text&pagination=cursor')
+        self.assertEqual(list(response.data['results'][0]), ['id', 'author', 'score', 'pub_date', 'comment_count'])
+        self.assertNotIn('"text"', queries[-1])
+        self.assertNotIn('JOIN', queries[-1])
+
+    def test_title_detail(self):
+        response, queries = self.get(f'/api/v1/titles/{self.title.pk}/?fields=name')
+        self.assertEqual(response.data, {'id': self.title.pk, 'name': 'title'})
+        self.assertEqual(len(queries), 1)
+
+    def test_unknown_field(self):
+        response = APIClient().get('/api/v1/titles/?fields=name,budget')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'fields': ['Unknown fields: budget.']})
+
+
+@override_settings(CACHES=LOCMEM_CACHE)
+class AsyncViewTest(TransactionTestCase):
+    """
+    Асинхронные view (ASGI) отдают те же ответы, что и синхронные; view выполняется в пуле потоков,
+    поэтому данные должны быть закоммичены (TransactionTestCase)
+    """
+
+    def setUp(self):
+        cache.clear()
+        genre = Genre.objects.create(name='drama', slug='drama')
+        self.title = Title.objects.create(name='title', year=2000)
+        self.title.genre.set([genre])
+        author = User.objects.create(username='author', email='author@example.com')
+        self.review = Review.objects.create(text='review', title=self.title, author=author, score=7)
+        Comment.objects.create(text='comment', review=self.review, author=author)
+
+    def get(self, view, path, **kwargs):
+        return async_to_sync(async_view(view.as_view()))(AsyncRequestFactory().get(path), **kwargs)
+
+    def test_same_response(self):
+        cases = (
+            (views.TitleListCreateView, '/api/v1/titles/', {}),
+            (views.TitleRetrieveUpdateDestroyView, f'/api/v1/titles/{self.title.pk}/', {'title_id': self.title.pk}),
+            (views.ReviewListCreateView, f'/api/v1/titles/{self.title.pk}/reviews/', {'title_id': self.title.pk}),
+            (views.CommentListCreateView, f'/api/v1/titles/{self.title.pk}/reviews/{self.review.pk}/comments/',
+             {'title_id': self.title.pk, 'review_id': self.review.pk}),
+        )
+        for view, path, kwargs in cases:
+            with self.subTest(path=path):
+                response = self.get(view, path, **kwargs)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.content), APIClient().get(path).json())
+
+    def test_cached_response(self):
+        path = f'/api/v1/titles/{self.title.pk}/'
+        first = self.get(views.TitleRetrieveUpdateDestroyView, path, title_id=self.title.pk)
+        # запросы выполняются в других потоках, поэтому считаются через метрики запроса
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        try:
+            second = self.get(views.TitleRetrieveUpdateDestroyView, path, title_id=self.title.pk)
+        finally:
+            request_stats.reset(token)
+        self.assertEqual(first.content, second.content)
+        self.assertEqual((stats.cache, stats.db_queries), ('hit', 0))
+
+    def test_not_found(self):
+        response = self.get(views.TitleRetrieveUpdateDestroyView, '/api/v1/titles/0/', title_id=0)
+        self.assertEqual(response.status_code, 404)
+
+
+@skipUnless('replica' in settings.DATABASES, 'stand-in replica database is not configured')
+@override_settings(CACHES=LOCMEM_CACHE, DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTest(TransactionTestCase):
+    """
+    Маршрутизация чтения на реплику. Реплику заменяет отдельная БД без репликации (imdb_api.test_settings),
+    поэтому по данным ответа видно, из какой БД он прочитан
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        clear_caches()
+        db_router._lag.clear()
+        Genre.objects.create(name='primary', slug='primary')
+        Genre.objects.using('replica').create(name='replica', slug='replica')
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='admin', email='admin@example.com', role='admin'))
+
+    def genres(self, **extra):
+        return [genre['slug'] for genre in self.client.get('/api/v1/genres/', **extra).data['results']]
+
+    def test_safe_methods_read_replica(self):
+        self.assertEqual(self.genres(), ['replica'])
+
+    def test_read_your_writes(self):
+        # force_authenticate не передает ни токена, ни сессии: клиент закрепляется по выданной cookie
+        response = self.client.post('/api/v1/genres/', {'name': 'new', 'slug': 'new'})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        self.assertEqual(self.genres(), ['primary', 'new'])
+        # другой клиент с того же адреса продолжает читать с реплики
+        self.assertEqual([genre['slug'] for genre in APIClient().get('/api/v1/genres/').data['results']], ['replica'])
+        self.client.cookies.pop(settings.REPLICA_PIN_COOKIE)
+        self.assertEqual(self.genres(), ['replica'])
+
+    def test_lagging_replica_is_skipped(self):
+        with mock.patch.object(db_router, 'measure_lag', return_value=60.0):
+            self.assertEqual(self.genres(), ['primary'])
+
+    def test_cached_data_read_primary(self):
+        # данные, которые сохраняются в кэш, не читаются с (возможно отстающей) реплики
+        title = Title.objects.create(name='primary', year=2000)
+        Title.objects.using('replica').bulk_create([Title(pk=title.pk, name='replica', year=2000)])
+        self.assertEqual(self.client.get(f'/api/v1/titles/{title.pk}/').data['name'], 'primary')
+        token = db_router.routing_state.set(db_router.RoutingState('client', safe=True))
+        try:
+            self.assertEqual(GENRES.get('primary')['name'], 'primary')
+            self.assertIsNone(GENRES.get('replica'))
+        finally:
+            db_router.routing_state.reset(token)
+
+
+@override_settings(CACHES=LOCMEM_CACHE, METRICS_ALLOWED_IPS=['10.1.0.0/16'])
+class MetricsEndpointTest(TestCase):
+    """
+    /metrics/ доступен только из METRICS_ALLOWED_IPS и персоналу
+    """
+
+    def test_access(self):
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='203.0.113.5').status_code, 403)
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.1.2.3')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'api_request_duration_seconds', response.content)
+        user = User.objects.create(username='user', email='user@example.com')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='203.0.113.5').status_code, 403)
+        user.is_staff = True
+        user.save()
+        self.assertEqual(self.client.get('/metrics/', REMOTE_ADDR='203.0.113.5').status_code, 200)
+
+
+class ConnectionPoolTest(TestCase):
+
+    def test_exhausted_redis_pool(self):
+        pool = pools.InstrumentedConnectionPool(max_connections=1, timeout=0.01)
+        name = pools._pool_name(pool)
+        before = REGISTRY.get_sample_value('api_redis_pool_timeouts_total', {'pool': name}) or 0
+        pool.pool.get_nowait()  # единственное соединение занято
+        with self.assertRaises(RedisConnectionError):
+            pool.get_connection('GET')
+        self.assertEqual(REGISTRY.get_sample_value('api_redis_pool_timeouts_total', {'pool': name}), before + 1)
+        self.assertEqual(REGISTRY.get_sample_value('api_redis_pool_max_connections', {'pool': name}), 1)
+
+    def test_idle_db_connection_health_check(self):
+        def fake_connection(usable, idle_for):
+            return mock.Mock(
+                alias='fake', connection=object(),
+                idle_since=time.monotonic() - idle_for, **{'is_usable.return_value': usable},
+            )
+        broken, busy = fake_connection(False, 60), fake_connection(False, 1)
+        with mock.patch.object(pools.connections, 'all', return_value=[broken, busy]), \
+                override_settings(DB_CONN_HEALTH_CHECKS=False, DB_HEALTH_CHECK_IDLE=30):
+            pools.check_connections()
+            broken.is_usable.assert_not_called()
+            with override_settings(DB_CONN_HEALTH_CHECKS=True):
+                pools.check_connections()
+        broken.close.assert_called_once()
+        # недавно использованное соединение не проверяется
+        busy.is_usable.assert_not_called()
+        busy.close.assert_not_called()
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plans are checked on PostgreSQL only')
+@override_settings(CACHES=LOCMEM_CACHE)
+class QueryPlanTest(TestCase):
+    """
+    Основные запросы эндпоинтов на заполненных таблицах не должны использовать Seq Scan
+    """
+    LARGE_TABLES = ('api_title', 'api_title_genre', 'api_review', 'api_comment')
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = Category.objects.bulk_create(
+            Category(name=f'category {i}', slug=f'category-{i}') for i in range(50))
+        genres = Genre.objects.bulk_create(Genre(name=f'genre {i}', slug=f'genre-{i}') for i in range(50))
+        titles = Title.objects.bulk_create(
+            Title(name=f'title {i}', year=1900 + i % 100, category=categories[i % 50]) for i in range(5000))
+        Title.objects.update_search_vector()
+        Title.genre.through.objects.bulk_create(
+            Title.genre.through(title=title, genre=genres[i % 50]) for i, title in enumerate(titles))
+        authors = User.objects.bulk_create(
+            User(username=f'user-{i}', email=f'user-{i}@example.com') for i in range(10))
+        reviews = Review.objects.bulk_create(
+            Review(text='review', title=title, author=author, score=5) for title in titles for author in authors)
+        Comment.objects.bulk_create(Comment(text='comment', review=review, author=review.author) for review in reviews)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.title, cls.review = titles[100], reviews[1000]
+        cls.comment = Comment.objects.filter(review=cls.review).first()
+
+    def setUp(self):
+        cache.clear()
+
+    def seq_scans(self, plan):
+        if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in self.LARGE_TABLES:
+            yield plan['Relation Name']
+        for child in plan.get('Plans', ()):
+            yield from self.seq_scans(child)
+
+    def assertNoSeqScan(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = APIClient().get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in context.captured_queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {query["sql"]}')
+                explain = cursor.fetchone()[0]
+            plan = (json.loads(explain) if isinstance(explain, str) else explain)[0]['Plan']
+            self.assertEqual(list(self.seq_scans(plan)), [], f'{url}: {query["sql"]}')
+
+    def test_title_filters(self):
+        filters = ('year=1950', 'category=category-7', 'genre=genre-3', 'name=title 42', 'category=category-0&year=1950')
+        for params in filters:
+            with self.subTest(params=params):
+                self.assertNoSeqScan(f'/api/v1/titles/?{params}')
+
+    def test_title_detail(self):
+        self.assertNoSeqScan(f'/api/v1/titles/{self.title.pk}/')
+
+    def test_reviews(self):
+        self.assertNoSeqScan(f'/api/v1/titles/{self.title.pk}/reviews/')
+        self.assertNoSeqScan(f'/api/v1/titles/{self.title.pk}/reviews/?pagination=cursor')
+        self.assertNoSeqScan(f'/api/v1/titles/{self.review.title_id}/reviews/{self.review.pk}/')
+
+    def test_comments(self):
+        self.assertNoSeqScan(f'/api/v1/titles/{self.review.title_id}/reviews/{self.review.pk}/comments/')
+        self.assertNoSeqScan(
+            f'/api/v1/titles/{self.review.title_id}/reviews/{self.review.pk}/comments/{self.comment.pk}/')
@@ -1,24 +1,37 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 from . import views
+from .async_views import async_view
 
 
 router = DefaultRouter()
 router.register(r'categories', viewset=views.CategoryViewSet, basename='categories')
 router.register(r'genres', viewset=views.GenreViewSet, basename='genres')
 
+# под ASGI эндпоинты чтения не блокируют event loop; под WSGI остаются синхронными
+read_view = async_view if settings.ASYNC_VIEWS else (lambda view: view)
+
 urlpatterns = [
     # categories, genres
     path('v1/', include(router.urls)),
     # titles
-    path('v1/titles/', view=views.TitleListCreateView.as_view()),
-    path('v1/titles/<int:title_id>/', view=views.TitleRetrieveUpdateDestroyView.as_view()),
+    path('v1/titles/', view=read_view(views.TitleListCreateView.as_view())),
+    path('v1/titles/bulk/', view=views.TitleBulkView.as_view()),
+    path('v1/titles/export/', view=views.TitleExportView.as_view()),
+    path('v1/titles/top/', view=views.TitleRankingView.as_view(ranking='rating')),
+    path('v1/titles/trending/', view=views.TitleRankingView.as_view(ranking='trending')),
+    path('v1/titles/<int:title_id>/', view=read_view(views.TitleRetrieveUpdateDestroyView.as_view())),
     # reviews
-    path('v1/titles/<int:title_id>/reviews/', view=views.ReviewListCreateView.as_view()),
+    path('v1/reviews/bulk/', view=views.ReviewBulkView.as_view()),
+    path('v1/titles/<int:title_id>/reviews/', view=read_view(views.ReviewListCreateView.as_view())),
     path('v1/titles/<int:title_id>/reviews/<int:review_id>/', view=views.ReviewRetrieveUpdateDestroyView.as_view()),
     # comments
-    path('v1/titles/<int:title_id>/reviews/<int:review_id>/comments/', view=views.CommentListCreateView.as_view()),
+    path(
+        'v1/titles/<int:title_id>/reviews/<int:review_id>/comments/',
+        view=read_view(views.CommentListCreateView.as_view())
+    ),
     path(
         'v1/titles/<int:title_id>/reviews/<int:review_id>/comments/<int:comment_id>/',
         view=views.CommentRetrieveUpdateDestroyView.as_view()
@@ -1,10 +1,350 @@
-from django.core.cache import cache
+import asyncio
+import hashlib
+import math
+import random
+import time
+import uuid
+from functools import wraps
+from weakref import WeakKeyDictionary
+import redis.asyncio
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from kombu.exceptions import OperationalError
+from rest_framework.response import Response
+from api.db_router import primary_reads
+from api.metrics import record_cache
+
+# теги, от которых зависят закэшированные ответы
+TITLES_TAG = 'titles'  # состав списка произведений (создание / удаление)
+TITLE_SEARCH_TAG = 'title-search'  # поля, по которым фильтруется список (name, year)
+CATEGORIES_TAG = 'categories'  # список категорий (создание, изменение, удаление)
+GENRES_TAG = 'genres'  # список жанров
+
+STALE_TIMEOUT = 300  # сколько устаревший ответ хранится сверх timeout и отдается во время пересчета
+LOCK_TIMEOUT = 30  # максимальное время пересчета ответа одним запросом
+LOCK_WAIT = 5  # сколько запрос без записи в кэше ждет пересчета другим запросом
+LOCK_POLL_INTERVAL = 0.05
+XFETCH_BETA = 1.0  # > 1 - пересчет раньше, < 1 - позже
+ETAG_TIMEOUT = 24 * 60 * 60  # сколько хранятся теги последнего ответа для условных GET
+COUNT_TIMEOUT = 60 * 60  # сколько хранится количество строк запроса (cached_count)
+
+
+def title_tag(pk) -> str:
+    return f'title:{pk}'
+
+
+def category_tag(slug: str) -> str:
+    return f'category:{slug}'
+
+
+def genre_tag(slug: str) -> str:
+    return f'genre:{slug}'
+
+
+def review_tag(pk) -> str:
+    return f'review:{pk}'
+
+
+def comments_tag(review_pk) -> str:
+    # состав и содержимое комментариев отзыва
+    return f'review-comments:{review_pk}'
+
+
+def user_tag(pk) -> str:
+    return f'user:{pk}'
+
+
+def _new_version() -> str:
+    # время создания версии (мс) - источник Last-Modified, случайная часть - уникальность
+    return f'{time.time_ns() // 1000000:x}-{uuid.uuid4().hex[:12]}'
+
+
+def _version_key(tag: str) -> str:
+    return f'tag-version:{tag}'
+
+
+def get_tag_versions(tags) -> dict:
+    """
+    Текущие версии (поколения) тегов. Отсутствующая в кэше версия создается заново,
+    поэтому записи, сохраненные до вытеснения версии из кэша, становятся недействительными
+    """
+    keys = {_version_key(tag): tag for tag in tags}
+    versions = cache.get_many(keys.keys())
+    missing = {key: _new_version() for key in keys if key not in versions}
+    if missing:
+        for key, version in missing.items():
+            cache.add(key, version, timeout=None)
+        versions.update(cache.get_many(missing.keys()))
+    return {tag: versions.get(key) for key, tag in keys.items()}
+
+
+def _bump_versions(tags):
+    cache.set_many({_version_key(tag): _new_version() for tag in tags}, timeout=None)
+
+
+def invalidate_tags(*tags):
+    """
+    Инвалидация всех ответов, зависящих от тегов: стоимость O(количества тегов),
+    без обхода ключей кэша. Внутри транзакции версии меняются еще раз после коммита:
+    ответ, построенный параллельным запросом по данным до коммита, не остается в кэше под новой версией
+    """
+    if not tags:
+        return
+    _bump_versions(tags)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: _bump_versions(tags))
+
+
+def make_etag(versions: dict) -> str:
+    digest = hashlib.md5(repr(sorted(versions.items())).encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def last_modified(versions: dict):
+    # время последнего изменения - самая новая из версий тегов ответа
+    stamps = [int(version.split('-')[0], 16) // 1000 for version in versions.values() if version and '-' in version]
+    return max(stamps, default=None)
+
+
+def set_validators(response, versions: dict):
+    response['ETag'] = make_etag(versions)
+    modified = last_modified(versions)
+    if modified is not None:
+        response['Last-Modified'] = http_date(modified)
+    return response
+
+
+def not_modified(request, versions: dict):
+    """
+    304 Not Modified (или 412 для If-Match), если условия запроса выполняются для версий тегов, иначе None
+    """
+    response = get_conditional_response(request, etag=make_etag(versions), last_modified=last_modified(versions))
+    return set_validators(response, versions) if response is not None else None
 
 
-def delete_cache(key_prefix: str):
+def title_tags(title: dict) -> set:
     """
-    Удаление ключей из кэша по заданному key_prefix
+    Теги сериализованного произведения (TitleReadSerializer)
     """
-    keys_pattern = f"views.decorators.cache.cache_*.{key_prefix}.*.{settings.LANGUAGE_CODE}.{settings.TIME_ZONE}"
-    cache.delete_pattern(keys_pattern)
+    tags = {title_tag(title['id'])}
+    if title.get('category'):
+        tags.add(category_tag(title['category']['slug']))
+    tags.update(genre_tag(genre['slug']) for genre in title.get('genre', ()))
+    return tags
+
+
+def cached_count(queryset, tags) -> int:
+    """
+    COUNT(*) запроса из кэша. Ключ - SQL запроса без сортировки, то есть комбинация фильтров;
+    количество пересчитывается, если изменилась версия одного из тегов, от которых зависит состав строк.
+    COUNT(*) выполняется в default: количество с отставшей реплики осталось бы в кэше под новыми версиями
+    """
+    sql, params = queryset.order_by().query.sql_with_params()
+    key = f'count:{hashlib.md5(f"{sql}:{params!r}".encode()).hexdigest()}'
+    versions = get_tag_versions(tags)
+    entry = cache.get(key)
+    if entry is not None and entry[0] == versions:
+        return entry[1]
+    with primary_reads():
+        count = queryset.count()
+    cache.set(key, (versions, count), COUNT_TIMEOUT)
+    return count
+
+
+def response_cache_key(request, key_prefix: str) -> str:
+    url_hash = hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+    return f'{key_prefix}:{url_hash}'
+
+
+def _lock_key(key: str) -> str:
+    return f'{key}:lock'
+
+
+def _is_fresh(entry, versions: dict) -> bool:
+    """
+    Запись свежая, если версии ее тегов не изменились и не наступил досрочный пересчет.
+    Досрочный пересчет вероятностный (XFetch): чем ближе срок и чем дольше пересчет, тем вероятнее,
+    поэтому одновременные запросы не приходят к истекшей записи все разом
+    """
+    entry_versions, data, expires, delta = entry
+    if versions != entry_versions:
+        return False
+    return time.time() - delta * XFETCH_BETA * math.log(1 - random.random()) < expires
+
+
+def _wait_for_entry(key: str):
+    # single flight: ответ строит запрос, взявший блокировку, остальные ждут его результат
+    deadline = time.monotonic() + LOCK_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None and get_tag_versions(entry[0]) == entry[0]:
+            return entry
+        if cache.get(_lock_key(key)) is None:
+            return None
+    return None
+
+
+def _schedule_refresh(view, request) -> bool:
+    from api.tasks import refresh_cached_response
+
+    view_path = f'{view.__class__.__module__}.{view.__class__.__qualname__}'
+    try:
+        refresh_cached_response.delay(view_path, request.build_absolute_uri(), view.kwargs)
+    except OperationalError:
+        # брокер недоступен: пересчет выполняется в текущем запросе
+        return False
+    return True
+
+
+def _cached(entry):
+    # версии, под которыми сохранены данные: по ним conditional_response строит ETag и Last-Modified
+    response = Response(entry[1])
+    response.cache_versions = entry[0]
+    return response
+
+
+def cache_response(timeout: int, key_prefix: str):
+    """
+    Кэширование данных ответа метода DRF view вместе с версиями тегов, от которых он зависит.
+    Теги возвращает метод view.get_cache_tags(data); запись недействительна,
+    если версия хотя бы одного из ее тегов изменилась, и устаревает, когда истек timeout.
+    Устаревшая запись хранится еще STALE_TIMEOUT секунд и отдается, пока ее пересчитывает
+    один запрос (блокировка на ключ) или задача Celery (CACHE_REFRESH_IN_BACKGROUND);
+    недействительную запись остальные запросы не отдают, а ждут пересчета.
+    Ответ для кэша строится чтением из default (primary_reads), не с реплики
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            key = response_cache_key(request, key_prefix)
+            lock_key = _lock_key(key)
+            refresh = getattr(request, 'cache_refresh', False)
+            entry = cache.get(key)
+            # версии известных тегов читаются до построения ответа: запись во время построения
+            # делает сохраненный ответ устаревшим, а не закрепляет его под новой версией
+            known = get_tag_versions(entry[0]) if entry is not None else {}
+            if refresh or (entry is not None and entry[0] != known):
+                # запись, инвалидированная тегом, не отдается даже как устаревшая:
+                # клиент после своей записи получает новые данные
+                entry = None
+
+            if entry is not None:
+                if _is_fresh(entry, known):
+                    record_cache('hit')
+                    return _cached(entry)
+                # stale-while-revalidate: пересчет запускает только запрос, взявший блокировку
+                if not cache.add(lock_key, 1, LOCK_TIMEOUT) or (
+                        getattr(settings, 'CACHE_REFRESH_IN_BACKGROUND', False) and _schedule_refresh(view, request)):
+                    record_cache('stale')
+                    return _cached(entry)
+            elif not refresh and not cache.add(lock_key, 1, LOCK_TIMEOUT):
+                entry = _wait_for_entry(key)
+                if entry is not None:
+                    record_cache('hit')
+                    return _cached(entry)
+                # запрос, взявший блокировку, не успел: пересчет без блокировки
+                lock_key = None
+
+            record_cache('miss')
+            try:
+                start = time.perf_counter()
+                with primary_reads():
+                    response = method(view, request, *args, **kwargs)
+                delta = time.perf_counter() - start
+                if response.status_code == 200:
+                    tags = view.get_cache_tags(response.data)
+                    versions = {tag: known[tag] for tag in tags if tag in known}
+                    versions.update(get_tag_versions([tag for tag in tags if tag not in known]))
+                    cache.set(key, (versions, response.data, time.time() + timeout, delta), timeout + STALE_TIMEOUT)
+                    response.cache_versions = versions
+            finally:
+                if lock_key:
+                    cache.delete(lock_key)
+            return response
+        return wrapper
+    return decorator
+
+
+def conditional_response(key_prefix: str):
+    """
+    Условные GET для метода DRF view: сильный ETag и Last-Modified по версиям тегов ответа
+    (view.get_cache_tags(data)). Теги последнего ответа хранятся по ключу URL, поэтому
+    304 Not Modified отдается после чтения из кэша, без ORM и сериализаторов.
+    Версии читаются до построения ответа: запись во время построения изменит ETag следующего запроса.
+    Ответ cache_response (в том числе устаревший) получает валидаторы версий, под которыми сохранены его данные.
+    Ответ строится чтением из default: ETag текущих версий не достается данным отставшей реплики
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(view, request, *args, **kwargs):
+            key = f'etag-tags:{response_cache_key(request, key_prefix)}'
+            tags = cache.get(key)
+            versions = get_tag_versions(tags) if tags is not None else {}
+            if tags is not None:
+                response = not_modified(request, versions)
+                if response is not None:
+                    return response
+
+            with primary_reads():
+                response = method(view, request, *args, **kwargs)
+            served = getattr(response, 'cache_versions', None)
+            if response.status_code == 200 and served is not None:
+                cache.set(key, list(served), ETAG_TIMEOUT)
+                set_validators(response, served)
+            elif response.status_code == 200:
+                tags = view.get_cache_tags(response.data)
+                new_tags = [tag for tag in tags if tag not in versions]
+                versions = {tag: versions[tag] for tag in tags if tag in versions}
+                versions.update(get_tag_versions(new_tags))
+                cache.set(key, tags, ETAG_TIMEOUT)
+                set_validators(response, versions)
+            return response
+        return wrapper
+    return decorator
+
+
+# асинхронный клиент Redis на каждый event loop (клиент нельзя использовать из другого loop)
+_async_clients = WeakKeyDictionary()
+
+
+def _async_redis():
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        # ограниченный пул, как у синхронного клиента кэша (REDIS_MAX_CONNECTIONS)
+        pool = redis.asyncio.BlockingConnectionPool.from_url(
+            settings.CACHES['default']['LOCATION'],
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+        )
+        _async_clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+    return _async_clients[loop]
+
+
+async def get_cached_entry(request, key_prefix: str):
+    """
+    Асинхронное чтение записи (версии тегов, данные), сохраненной cache_response, без занятия потока.
+    Возвращает None при промахе или устаревшей записи - тогда ответ (устаревший или пересчитанный)
+    выдает синхронный view
+    """
+    key = response_cache_key(request, key_prefix)
+    client = getattr(cache, 'client', None)
+    if not hasattr(client, 'decode'):
+        # не Redis (LocMemCache в тестах): обращение к кэшу не блокирует
+        entry = cache.get(key)
+        if entry is None or not _is_fresh(entry, get_tag_versions(entry[0])):
+            return None
+        return entry[:2]
+
+    redis_client = _async_redis()
+    raw = await redis_client.get(client.make_key(key))
+    if raw is None:
+        return None
+    entry = client.decode(raw)
+    tags = list(entry[0])
+    raw_versions = await redis_client.mget([client.make_key(_version_key(tag)) for tag in tags])
+    versions = {tag: client.decode(value) if value is not None else None for tag, value in zip(tags, raw_versions)}
+    return entry[:2] if _is_fresh(entry, versions) else None
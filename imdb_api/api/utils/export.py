@@ -0,0 +1,57 @@
+import csv
+import io
+import json
+from collections import defaultdict
+from itertools import islice
+from api.models import Title
+
+EXPORT_FIELDS = ('id', 'name', 'year', 'category', 'genre', 'rating')
+
+
+def export_titles(queryset, chunk_size: int = 2000):
+    """
+    Построчная выгрузка произведений с категорией, жанрами и рейтингом.
+    Произведения читаются серверным курсором (iterator), жанры - одним запросом на чанк,
+    поэтому расход памяти не зависит от размера каталога
+    """
+    titles = queryset.order_by('id').values('id', 'name', 'year', 'category__slug', 'rating').iterator(
+        chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(titles, chunk_size))
+        if not chunk:
+            return
+        genres = defaultdict(list)
+        links = Title.genre.through.objects.filter(title_id__in=[title['id'] for title in chunk])
+        for title_id, slug in links.order_by('genre__slug').values_list('title_id', 'genre__slug'):
+            genres[title_id].append(slug)
+        for title in chunk:
+            yield {
+                'id': title['id'],
+                'name': title['name'],
+                'year': title['year'],
+                'category': title['category__slug'],
+                'genre': genres[title['id']],
+                'rating': str(title['rating']) if title['rating'] is not None else None,
+            }
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + '\n'
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({**row, 'genre': ','.join(row['genre'])})
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+EXPORT_FORMATS = {
+    'ndjson': to_ndjson,
+    'csv': to_csv,
+}
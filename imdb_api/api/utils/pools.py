@@ -0,0 +1,113 @@
+import time
+from weakref import WeakSet
+from celery.backends.redis import RedisBackend
+from django.conf import settings
+from django.db import connections
+from django_redis import get_redis_connection
+from prometheus_client.core import GaugeMetricFamily
+from redis import BlockingConnectionPool
+from redis.exceptions import ConnectionError
+from api.metrics import REGISTRY, DB_CONNECTIONS, DB_HEALTH_CHECK_FAILURES, REDIS_POOL_TIMEOUTS, REDIS_POOL_WAIT
+
+_pools = WeakSet()
+
+
+def _pool_name(pool) -> str:
+    kwargs = pool.connection_kwargs
+    return f'{kwargs.get("host", kwargs.get("path"))}:{kwargs.get("port", "")}/{kwargs.get("db", 0)}'
+
+
+class InstrumentedConnectionPool(BlockingConnectionPool):
+    """
+    Ограниченный пул соединений Redis: при исчерпании запрос ждет свободное соединение
+    не дольше timeout секунд. Время ожидания и отказы попадают в метрики,
+    занятые и свободные соединения - в api_redis_pool_connections
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().get_connection(*args, **kwargs)
+        except ConnectionError as exc:
+            # пул исчерпан (ошибка BlockingConnectionPool), а не сбой подключения
+            if str(exc) == 'No connection available.':
+                REDIS_POOL_TIMEOUTS.labels(_pool_name(self)).inc()
+            raise
+        finally:
+            REDIS_POOL_WAIT.labels(_pool_name(self)).observe(time.perf_counter() - start)
+
+
+class PoolCollector:
+    """
+    Заполненность пулов Redis процесса на момент чтения /metrics/
+    """
+
+    def collect(self):
+        connections_family = GaugeMetricFamily(
+            'api_redis_pool_connections', 'Redis pool connections', labels=['pool', 'state'])
+        limit_family = GaugeMetricFamily('api_redis_pool_max_connections', 'Redis pool size', labels=['pool'])
+        for pool in list(_pools):
+            name = _pool_name(pool)
+            # в очереди пула лежат свободные соединения и None - места для еще не созданных
+            idle = sum(connection is not None for connection in list(pool.pool.queue))
+            connections_family.add_metric([name, 'idle'], idle)
+            connections_family.add_metric([name, 'in_use'], len(pool._connections) - idle)
+            limit_family.add_metric([name], pool.max_connections)
+        yield connections_family
+        yield limit_family
+
+
+REGISTRY.register(PoolCollector())
+
+
+class SharedPoolRedisBackend(RedisBackend):
+    """
+    Бэкенд результатов Celery, использующий пул соединений кэша Django (тот же Redis),
+    вместо собственного неограниченного пула
+    """
+
+    def _get_pool(self, **params):
+        try:
+            return get_redis_connection('default').connection_pool
+        except NotImplementedError:
+            # кэш не Redis
+            return super()._get_pool(**params)
+
+
+def count_connection(sender, connection, **kwargs):
+    # обработчик connection_created: при постоянных соединениях растет только при переподключении
+    DB_CONNECTIONS.labels(connection.alias).inc()
+
+
+def check_connections(**kwargs):
+    """
+    Проверка постоянных соединений с БД (CONN_MAX_AGE) перед запросом при DB_CONN_HEALTH_CHECKS,
+    как CONN_HEALTH_CHECKS в Django 4.1.
+    Проверяются только соединения, простаивавшие дольше DB_HEALTH_CHECK_IDLE секунд:
+    под нагрузкой лишних запросов к БД нет, а соединение, закрытое сервером во время простоя,
+    переоткрывается до запроса пользователя, а не после ошибки в нем
+    """
+    if not settings.DB_CONN_HEALTH_CHECKS:
+        return
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        idle_since = getattr(connection, 'idle_since', None)
+        if idle_since is not None and now - idle_since > settings.DB_HEALTH_CHECK_IDLE:
+            if not connection.is_usable():
+                DB_HEALTH_CHECK_FAILURES.labels(connection.alias).inc()
+                connection.close()
+        connection.idle_since = None
+
+
+def mark_idle(**kwargs):
+    # обработчик request_finished: время, с которого открытые соединения не используются
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is not None:
+            connection.idle_since = now
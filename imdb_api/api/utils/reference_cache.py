@@ -0,0 +1,216 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import RedisError
+from rest_framework.authtoken.models import Token
+from api.db_router import primary_reads
+from api.models import Category, Genre
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+INVALIDATION_CHANNEL = 'reference-cache-invalidation'
+
+
+class ReferenceCache:
+    """
+    Двухуровневый кэш небольших, редко изменяемых справочных данных:
+    LRU с TTL в памяти процесса -> Redis (кэш Django) -> БД.
+    load(keys) возвращает словарь {ключ: значение} для найденных в БД ключей и читает из default.
+    Изменения рассылаются всем процессам через Redis pub/sub; TTL ограничивает устаревание,
+    если сообщение потеряно
+    """
+    registry = {}
+
+    def __init__(self, name: str, load, maxsize: int = 10000, ttl: int = 60, timeout: int = 3600):
+        self.name = name
+        self.load = load
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        ReferenceCache.registry[name] = self
+
+    def __deepcopy__(self, memo):
+        # кэш общий для процесса: поля сериализаторов DRF копируются вместе с аргументами
+        return self
+
+    def _cache_key(self, key) -> str:
+        return f'reference:{self.name}:{key}'
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys) -> dict:
+        _start_listener()
+        keys = set(keys)
+        found = self._get_local(keys)
+        missing = keys - found.keys()
+        if missing:
+            cache_keys = {self._cache_key(key): key for key in missing}
+            shared = {cache_keys[cache_key]: value for cache_key, value in cache.get_many(cache_keys).items()}
+            missing -= shared.keys()
+            if missing:
+                with primary_reads():
+                    loaded = self.load(missing)
+                cache.set_many({self._cache_key(key): value for key, value in loaded.items()}, self.timeout)
+                shared.update(loaded)
+            self._set_local(shared)
+            found.update(shared)
+        return found
+
+    def _get_local(self, keys) -> dict:
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._local.get(key)
+                if item is not None and item[0] > now:
+                    self._local.move_to_end(key)
+                    found[key] = item[1]
+        return found
+
+    def _set_local(self, values: dict):
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._local[key] = (expires, value)
+                self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+    def discard_local(self, keys=None):
+        with self._lock:
+            if keys is None:
+                self._local.clear()
+            for key in keys or ():
+                self._local.pop(key, None)
+
+    def invalidate(self, *keys):
+        """
+        Удаление ключей из Redis и из памяти всех процессов. Внутри транзакции повторяется после коммита:
+        до него другой процесс мог снова закэшировать прежнее значение из БД
+        """
+        self._invalidate(keys)
+        if transaction.get_connection().in_atomic_block:
+            transaction.on_commit(lambda: self._invalidate(keys))
+
+    def _invalidate(self, keys):
+        cache.delete_many([self._cache_key(key) for key in keys])
+        self.discard_local(keys)
+        if _uses_redis():
+            try:
+                get_redis_connection('default').publish(
+                    INVALIDATION_CHANNEL, json.dumps({'cache': self.name, 'keys': self._published_keys(keys)}))
+            except RedisError:
+                logger.warning('Reference cache invalidation was not published', exc_info=True)
+
+    def _published_keys(self, keys) -> list:
+        # ключи в сообщении об инвалидации для других процессов
+        return list(keys)
+
+    def discard_published(self, keys):
+        self.discard_local(keys)
+
+
+class SecretReferenceCache(ReferenceCache):
+    """
+    ReferenceCache для секретных ключей (токенов): в Redis и в сообщениях об инвалидации ключ - хэш
+    """
+
+    @staticmethod
+    def _digest(key) -> str:
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def _cache_key(self, key) -> str:
+        return f'reference:{self.name}:{self._digest(key)}'
+
+    def _published_keys(self, keys) -> list:
+        # в канал pub/sub ключи тоже попадают только в виде хэша
+        return [self._digest(key) for key in keys]
+
+    def discard_published(self, keys):
+        digests = set(keys)
+        with self._lock:
+            for key in [key for key in self._local if self._digest(key) in digests]:
+                del self._local[key]
+
+
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _uses_redis() -> bool:
+    # без Redis (LocMemCache) процесс один, рассылка не нужна
+    return hasattr(getattr(cache, 'client', None), 'get_client')
+
+
+def _on_message(raw):
+    # ошибка разбора одного сообщения не должна останавливать поток подписки
+    try:
+        data = json.loads(raw)
+        reference_cache = ReferenceCache.registry.get(data['cache'])
+        if reference_cache is not None:
+            reference_cache.discard_published(data['keys'])
+    except Exception:
+        logger.warning('Malformed reference cache invalidation message: %r', raw, exc_info=True)
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                _on_message(message['data'])
+        except RedisError:
+            logger.warning('Reference cache subscription lost, reconnecting', exc_info=True)
+            # сообщения, отправленные без подписки, потеряны: локальные копии больше не надежны
+            for reference_cache in ReferenceCache.registry.values():
+                reference_cache.discard_local()
+            time.sleep(1)
+
+
+def _start_listener():
+    # поток подписки запускается лениво в каждом рабочем процессе (потоки не переживают fork)
+    global _listener_pid
+    if _listener_pid == os.getpid() or not _uses_redis():
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid():
+            for reference_cache in ReferenceCache.registry.values():
+                reference_cache.discard_local()
+            threading.Thread(target=_listen, name='reference-cache-listener', daemon=True).start()
+            _listener_pid = os.getpid()
+
+
+def _load_by_slug(model):
+    def load(slugs) -> dict:
+        return {row['slug']: row for row in model.objects.filter(slug__in=slugs).values()}
+    return load
+
+
+# slug -> значения полей категории / жанра, id -> username автора
+CATEGORIES = ReferenceCache('category', _load_by_slug(Category))
+GENRES = ReferenceCache('genre', _load_by_slug(Genre))
+USERNAMES = ReferenceCache(
+    'username', lambda pks: dict(User.objects.filter(pk__in=pks).values_list('pk', 'username')))
+
+# аутентификация без запросов к БД: id -> поля пользователя; ключ токена DRF -> id пользователя.
+# Кэшируются все поля, кроме хэша пароля: обращение к request.user.email, is_staff и т. п. не читает БД.
+# Короткий TTL ограничивает устаревание при изменениях в обход сигналов (QuerySet.update)
+AUTH_USER_FIELDS = tuple(field.attname for field in User._meta.concrete_fields if field.attname != 'password')
+AUTH_USERS = ReferenceCache(
+    'auth-user', lambda pks: {row['id']: row for row in User.objects.filter(pk__in=pks).values(*AUTH_USER_FIELDS)},
+    ttl=30, timeout=300)
+AUTH_TOKENS = SecretReferenceCache(
+    'auth-token', lambda keys: dict(Token.objects.filter(key__in=keys).values_list('key', 'user_id')),
+    ttl=30, timeout=300)
@@ -1,6 +1,128 @@
-from django.core.mail import EmailMessage
+import logging
+import math
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.core.cache import cache
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from imdb_api.celery import app
+
+logger = logging.getLogger(__name__)
+
+# очередь брокера с исходящими письмами: ее читает только задача flush_email_outbox
+OUTBOX_QUEUE = 'email-outbox'
+FLUSH_SCHEDULED_KEY = 'email-outbox:flush-scheduled'
 
 
 def send_email(mail_subject: str, message: str, to_email: str):
     email = EmailMessage(subject=mail_subject, body=message, to=[to_email])
     email.send()
+
+
+def queue_email(mail_subject: str, message: str, to_email: str):
+    """
+    Письмо ставится в очередь исходящих и уходит пакетом не позже чем через EMAIL_BATCH_DELAY + 1 секунду
+    """
+    with app.pool.acquire(block=True) as broker, broker.SimpleQueue(OUTBOX_QUEUE) as outbox:
+        outbox.put({'subject': mail_subject, 'body': message, 'to': to_email})
+    schedule_flush(settings.EMAIL_BATCH_DELAY)
+
+
+def queue_email_on_commit(mail_subject: str, message: str, to_email: str):
+    """
+    Письмо ставится в очередь после коммита транзакции. Если брокер или кэш недоступны,
+    письмо отправляется сразу: запрос не завершается ошибкой после записи в БД
+    """
+    def enqueue():
+        try:
+            queue_email(mail_subject, message, to_email)
+        except Exception:
+            logger.warning('Email was not queued, sending it directly', exc_info=True)
+            try:
+                send_email(mail_subject, message, to_email)
+            except Exception:
+                logger.exception('Email to %s was not sent', to_email)
+
+    transaction.on_commit(enqueue)
+
+
+def schedule_flush(delay: int):
+    """
+    Одна задача отправки на окно delay: письма, поставленные в очередь до ее запуска, уходят одним пакетом.
+    Ключ живет меньше задержки задачи, поэтому письмо, пришедшее после чтения очереди, запланирует новую
+    """
+    from api.tasks import flush_email_outbox
+
+    if cache.add(FLUSH_SCHEDULED_KEY, 1, delay):
+        flush_email_outbox.apply_async(countdown=delay + 1)
+
+
+def take_domain_quota(domain: str, wanted: int):
+    """
+    Сколько из wanted писем домену можно отправить в текущем окне лимита (счетчик в кэше)
+    и через сколько секунд начнется следующее окно
+    """
+    limit, period = settings.EMAIL_DOMAIN_RATE_LIMITS.get(domain, settings.EMAIL_DOMAIN_RATE_LIMIT)
+    now = time.time()
+    window = int(now // period)
+    key = f'email-rate:{domain}:{window}'
+    cache.add(key, 0, period)
+    try:
+        used = cache.incr(key, wanted)
+    except ValueError:
+        # окно истекло между add и incr
+        cache.set(key, wanted, period)
+        used = wanted
+    allowed = max(0, min(wanted, limit - (used - wanted)))
+    return allowed, (window + 1) * period - now
+
+
+def send_outbox_batch():
+    """
+    Отправка до EMAIL_BATCH_SIZE писем очереди исходящих через одно соединение почтового бэкенда.
+    Письма отправляются и подтверждаются по одному: при ошибке в очередь возвращаются только неотправленные.
+    Письма сверх лимита домена получателя тоже возвращаются в очередь. Доставка - не менее одного раза:
+    письмо повторится, только если процесс упадет между отправкой и подтверждением.
+    Возвращает задержку следующей отправки: 0 - в очереди остались письма, None - очередь пуста
+    """
+    with app.pool.acquire(block=True) as broker, broker.SimpleQueue(OUTBOX_QUEUE) as outbox:
+        messages = []
+        while len(messages) < settings.EMAIL_BATCH_SIZE:
+            try:
+                messages.append(outbox.get(block=False))
+            except outbox.Empty:
+                break
+
+        by_domain = defaultdict(list)
+        for message in messages:
+            by_domain[message.payload['to'].rpartition('@')[2].lower()].append(message)
+        ready, deferred, wait = [], [], None
+        for domain, items in by_domain.items():
+            allowed, next_window = take_domain_quota(domain, len(items))
+            ready += items[:allowed]
+            deferred += items[allowed:]
+            if allowed < len(items):
+                wait = next_window if wait is None else min(wait, next_window)
+        for message in deferred:
+            message.requeue()
+
+        if ready:
+            connection = get_connection()
+            sent = 0
+            try:
+                connection.open()
+                for message in ready:
+                    payload = message.payload
+                    connection.send_messages(
+                        [EmailMessage(subject=payload['subject'], body=payload['body'], to=[payload['to']])])
+                    message.ack()
+                    sent += 1
+            except Exception:
+                for message in ready[sent:]:
+                    message.requeue()
+                raise
+            finally:
+                connection.close()
+            return 0 if outbox.qsize() else None
+        return math.ceil(wait) if wait is not None else None
@@ -1,20 +1,35 @@
-from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from rest_framework import status, filters, mixins, generics, views, viewsets
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import NotFound, ValidationError
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions
 from users.models import User
 from .utils.confirmation_code import ConfirmationCodeGenerator
-from .utils.send_email import send_email
-from .tasks import send_email_task
-from .utils.cache_functions import delete_cache
-from django.utils.decorators import method_decorator
-from django.views.decorators.cache import cache_page
+from .utils.send_email import queue_email_on_commit
+from .utils.cache_functions import (
+    cache_response,
+    conditional_response,
+    title_tags,
+    title_tag,
+    review_tag,
+    comments_tag,
+    user_tag,
+    category_tag,
+    genre_tag,
+    TITLES_TAG,
+    TITLE_SEARCH_TAG,
+    CATEGORIES_TAG,
+    GENRES_TAG,
+)
 from .filters import TitleFilter
-from .models import Category, Genre, Title
+from .mixins import RelatedQuerysetMixin, NestedResourceMixin, BulkWriteMixin, ValuesListMixin
+from .pagination import CachedCountPagination, FeedPagination
+from .renderers import NDJSONRenderer, CSVRenderer
+from .utils.export import export_titles, EXPORT_FORMATS
+from .utils.reference_cache import CATEGORIES, GENRES
+from django.http import StreamingHttpResponse
+from .models import Category, Genre, Title, Review, Comment
 from .permissions import IsNotAuth, IsAdminOrReadOnly, IsAuthorOrModeratorOrAdminOrReadOnly
-from django.db.models import Avg
 from .serializer import (
     UserSerializer,
     ConfirmationCodeSerializer,
@@ -25,6 +40,7 @@ from .serializer import (
     TitleWriteSerializer,
     ReviewReadSerializer,
     ReviewWriteSerializer,
+    ReviewBulkSerializer,
     CommentSerializer,
 )
 
@@ -55,8 +71,8 @@ class APISignup(views.APIView):
                        f"{confirmation_code}")
             to_email = str(request.data.get('email'))
 
-            # send_email(mail_subject, message, to_email)
-            send_email_task.delay(mail_subject, message, to_email)  # celery
+            # письмо уходит пакетом из очереди исходящих (задача Celery flush_email_outbox)
+            queue_email_on_commit(mail_subject, message, to_email)
 
             return Response({'email': serializer.data['email']}, status=status.HTTP_200_OK)
         else:
@@ -96,11 +112,14 @@ class CategoryViewSet(mixins.CreateModelMixin,
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = (IsAdminOrReadOnly,)
-    pagination_class = PageNumberPagination
+    pagination_class = CachedCountPagination
     filter_backends = (filters.SearchFilter,)
     search_fields = ('name',)
     lookup_field = 'slug'
 
+    def get_count_tags(self):
+        return {CATEGORIES_TAG}
+
 
 class GenreViewSet(mixins.CreateModelMixin,
                    mixins.ListModelMixin,
@@ -110,16 +129,19 @@ class GenreViewSet(mixins.CreateModelMixin,
     queryset = Genre.objects.all()
     serializer_class = GenreSerializer
     permission_classes = (IsAdminOrReadOnly,)
-    pagination_class = PageNumberPagination
+    pagination_class = CachedCountPagination
     filter_backends = (filters.SearchFilter,)
     search_fields = ('name',)
     lookup_field = 'slug'
 
+    def get_count_tags(self):
+        return {GENRES_TAG}
+
 
-class TitleListCreateView(generics.ListCreateAPIView):
-    queryset = Title.objects.all().annotate(rating=Avg('reviews__score'))
+class TitleListCreateView(RelatedQuerysetMixin, ValuesListMixin, generics.ListCreateAPIView):
+    queryset = Title.objects.all()
     permission_classes = (IsAdminOrReadOnly,)
-    pagination_class = PageNumberPagination
+    pagination_class = CachedCountPagination
     filter_backends = (DjangoFilterBackend,)
     filterset_class = TitleFilter
 
@@ -131,19 +153,35 @@ class TitleListCreateView(generics.ListCreateAPIView):
         else:
             return TitleWriteSerializer
 
-    @method_decorator(cache_page(300, key_prefix=CACHE_KEY_PREFIX))
+    def get_cache_tags(self, data):
+        # кэш инвалидируется сигналами (api/signals.py) только по затронутым тегам
+        tags = self.get_count_tags()
+        for title in data['results']:
+            tags |= title_tags(title)
+        return tags
+
+    def get_count_tags(self):
+        # теги состава списка при текущих фильтрах
+        tags = set()
+        params = self.request.query_params
+        if params.get('category'):
+            tags.add(category_tag(params['category']))
+        if params.get('genre'):
+            tags.update(genre_tag(slug) for slug in params['genre'].split(','))
+        if not (params.get('category') or params.get('genre')):
+            tags.add(TITLES_TAG)
+        if params.get('name') or params.get('year'):
+            tags.add(TITLE_SEARCH_TAG)
+        return tags
+
+    @conditional_response(key_prefix=CACHE_KEY_PREFIX)
+    @cache_response(300, key_prefix=CACHE_KEY_PREFIX)
     def list(self, request, *args, **kwargs):
         return super().list(request, *args, **kwargs)
 
-    def create(self, request, *args, **kwargs):
-        response = super().create(request, *args, **kwargs)
-        # при добавлении нового title кэш очищается
-        delete_cache(self.CACHE_KEY_PREFIX)
-        return response
-
 
-class TitleRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Title.objects.all().annotate(rating=Avg('reviews__score'))
+class TitleRetrieveUpdateDestroyView(RelatedQuerysetMixin, generics.RetrieveUpdateDestroyAPIView):
+    queryset = Title.objects.all()
     permission_classes = (IsAdminOrReadOnly,)
     lookup_url_kwarg = 'title_id'
 
@@ -155,32 +193,103 @@ class TitleRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
         else:
             return TitleReadSerializer
 
-    @method_decorator(cache_page(300, key_prefix=CACHE_KEY_PREFIX))
+    def get_cache_tags(self, data):
+        return title_tags(data)
+
+    @conditional_response(key_prefix=CACHE_KEY_PREFIX)
+    @cache_response(300, key_prefix=CACHE_KEY_PREFIX)
     def retrieve(self, request, *args, **kwargs):
         return super().retrieve(request, *args, **kwargs)
 
-    def update(self, request, *args, **kwargs):
-        response = super().update(request, *args, **kwargs)
-        delete_cache(self.CACHE_KEY_PREFIX)
-        return response
 
-    def destroy(self, request, *args, **kwargs):
-        response = super().destroy(request, *args, **kwargs)
-        delete_cache(self.CACHE_KEY_PREFIX)
+class TitleBulkView(BulkWriteMixin, generics.GenericAPIView):
+    """
+    Пакетное создание (POST) и изменение (PATCH) произведений массивом объектов
+    """
+    queryset = Title.objects.select_related('category')
+    serializer_class = TitleWriteSerializer
+    permission_classes = (IsAdminOrReadOnly,)
+
+
+class TitleRankingView(RelatedQuerysetMixin, ValuesListMixin, generics.ListAPIView):
+    """
+    Лучшие (ranking = 'rating') или обсуждаемые в последнее время (ranking = 'trending') произведения
+    во всем каталоге или в одном разрезе: ?category=<slug>, ?genre=<slug> или ?year=<год>.
+    Первые ?limit= строк читаются по индексу материализованного рейтинга TitleRanking
+    """
+    queryset = Title.objects.all()
+    serializer_class = TitleReadSerializer
+    permission_classes = (IsAdminOrReadOnly,)
+    pagination_class = None
+    ranking = 'rating'
+    default_limit = 10
+    max_limit = 100
+
+    def get_scope(self) -> str:
+        params = self.request.query_params
+        given = [name for name in ('category', 'genre', 'year') if params.get(name)]
+        if len(given) > 1:
+            raise ValidationError({'detail': 'Only one of category, genre and year can be set.'})
+        if not given:
+            return 'all'
+        name = given[0]
+        if name == 'year':
+            if not params['year'].isdigit():
+                raise ValidationError({'year': ['A valid integer is required.']})
+            return f'year:{int(params["year"])}'
+        item = (CATEGORIES if name == 'category' else GENRES).get(params[name])
+        if item is None:
+            raise NotFound(f'{name.capitalize()} "{params[name]}" does not exist.')
+        return f'{name}:{item["id"]}'
+
+    def get_limit(self) -> int:
+        limit = self.request.query_params.get('limit', str(self.default_limit))
+        if not limit.isdigit() or not 0 < int(limit) <= self.max_limit:
+            raise ValidationError({'limit': [f'Ensure this value is between 1 and {self.max_limit}.']})
+        return int(limit)
+
+    def get_queryset(self):
+        return super().get_queryset().ranked(self.get_scope(), self.ranking)
+
+    def filter_queryset(self, queryset):
+        return super().filter_queryset(queryset)[:self.get_limit()]
+
+
+class TitleExportView(generics.GenericAPIView):
+    """
+    Потоковая выгрузка всего каталога произведений в NDJSON (по умолчанию) или CSV (?format=csv).
+    Поддерживает те же фильтры, что и список произведений
+    """
+    queryset = Title.objects.all()
+    permission_classes = (IsAdminOrReadOnly,)
+    filter_backends = (DjangoFilterBackend,)
+    filterset_class = TitleFilter
+    renderer_classes = (NDJSONRenderer, CSVRenderer)
+
+    def get(self, request, *args, **kwargs):
+        renderer = request.accepted_renderer
+        rows = export_titles(self.filter_queryset(self.get_queryset()))
+        response = StreamingHttpResponse(
+            EXPORT_FORMATS[renderer.format](rows),
+            content_type=f'{renderer.media_type}; charset={renderer.charset}',
+        )
+        response['Content-Disposition'] = f'attachment; filename="titles.{renderer.format}"'
         return response
 
 
-class ReviewListCreateView(generics.ListCreateAPIView):
+class ReviewListCreateView(RelatedQuerysetMixin, ValuesListMixin, NestedResourceMixin, generics.ListCreateAPIView):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
-    pagination_class = PageNumberPagination
+    pagination_class = FeedPagination
 
     def get_queryset(self):
-        title = get_object_or_404(Title, id=self.kwargs.get('title_id'))
-        return title.reviews.all()
+        return self.get_title().reviews.all()
+
+    def get_count_tags(self):
+        # версия произведения меняется при создании и удалении его отзывов
+        return {title_tag(self.kwargs.get('title_id'))}
 
     def perform_create(self, serializer):
-        title = get_object_or_404(Title, id=self.kwargs.get('title_id'))
-        serializer.save(author=self.request.user, title=title)
+        serializer.save(author=self.request.user, title=self.get_title())
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
@@ -189,13 +298,24 @@ class ReviewListCreateView(generics.ListCreateAPIView):
             return ReviewWriteSerializer
 
 
-class ReviewRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
+class ReviewBulkView(BulkWriteMixin, generics.GenericAPIView):
+    """
+    Пакетное создание (POST, поле title - id произведения) и изменение (PATCH) отзывов
+    """
+    queryset = Review.objects.select_related('author')
+    serializer_class = ReviewBulkSerializer
+    permission_classes = (permissions.IsAuthenticated, IsAuthorOrModeratorOrAdminOrReadOnly)
+
+
+class ReviewRetrieveUpdateDestroyView(RelatedQuerysetMixin, generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (IsAuthorOrModeratorOrAdminOrReadOnly,)
-    lookup_field = 'title_id'
+    lookup_url_kwarg = 'review_id'
+
+    ETAG_KEY_PREFIX = 'review-view'
 
     def get_queryset(self):
-        title = get_object_or_404(Title, id=self.kwargs.get('title_id'))
-        return title.reviews.filter(id=self.kwargs.get('review_id'))
+        # произведение проверяется в том же запросе, что и отзыв
+        return Review.objects.filter(title_id=self.kwargs.get('title_id'))
 
     def get_serializer_class(self):
         if self.request.method in ['PUT', 'PATCH']:
@@ -203,30 +323,59 @@ class ReviewRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
         else:
             return ReviewReadSerializer
 
+    def get_object(self):
+        # объект нужен get_cache_tags (автор не входит в данные ответа)
+        self.object = super().get_object()
+        return self.object
 
-class CommentListCreateView(generics.ListCreateAPIView):
+    def get_cache_tags(self, data):
+        return {review_tag(self.object.pk), title_tag(self.object.title_id), user_tag(self.object.author_id)}
+
+    @conditional_response(key_prefix=ETAG_KEY_PREFIX)
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
+
+
+class CommentListCreateView(RelatedQuerysetMixin, ValuesListMixin, NestedResourceMixin, generics.ListCreateAPIView):
     serializer_class = CommentSerializer
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
-    pagination_class = PageNumberPagination
-    lookup_field = 'title_id'
+    pagination_class = FeedPagination
+
+    ETAG_KEY_PREFIX = 'comment-view'
 
     def get_queryset(self):
-        title = get_object_or_404(Title, id=self.kwargs.get('title_id'))
-        review = title.reviews.get(id=self.kwargs.get('review_id'))
-        return review.comments.all()
+        return self.get_review().comments.all()
+
+    def get_count_tags(self):
+        return {comments_tag(self.kwargs.get('review_id'))}
 
     def perform_create(self, serializer):
-        title = get_object_or_404(Title, id=self.kwargs.get('title_id'))
-        review = title.reviews.get(id=self.kwargs.get('review_id'))
-        serializer.save(author=self.request.user, review=review)
+        serializer.save(author=self.request.user, review=self.get_review())
+
+    def paginate_queryset(self, queryset):
+        # комментарии страницы нужны get_cache_tags (авторы не входят в данные ответа)
+        self.page_objects = super().paginate_queryset(queryset)
+        return self.page_objects
+
+    def get_cache_tags(self, data):
+        review = self.get_review()
+        tags = {comments_tag(review.pk), review_tag(review.pk)}
+        tags.update(user_tag(comment.author_id) for comment in self.page_objects or ())
+        return tags
+
+    @conditional_response(key_prefix=ETAG_KEY_PREFIX)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
 
-class CommentRetrieveUpdateDestroyView(generics.RetrieveUpdateDestroyAPIView):
+class CommentRetrieveUpdateDestroyView(RelatedQuerysetMixin, generics.RetrieveUpdateDestroyAPIView):
     serializer_class = CommentSerializer
     permission_classes = (IsAuthorOrModeratorOrAdminOrReadOnly,)
-    lookup_field = 'review_id'
+    lookup_url_kwarg = 'comment_id'
 
     def get_queryset(self):
-        title = get_object_or_404(Title, id=self.kwargs.get('title_id'))
-        review = title.reviews.get(id=self.kwargs.get('review_id'))
-        return review.comments.filter(id=self.kwargs.get('comment_id'))
+        # весь путь title -> review -> comment проверяется одним запросом
+        return Comment.objects.filter(
+            review_id=self.kwargs.get('review_id'),
+            review__title_id=self.kwargs.get('title_id'),
+        )
@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'imdb_api.settings')
+os.environ.setdefault('ASYNC_VIEWS', 'yes')
 
 application = get_asgi_application()
@@ -61,6 +61,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.MetricsMiddleware',  # метрики запросов, отдаются на /metrics/
+    'api.middleware.ReplicaRoutingMiddleware',  # чтение с реплик БД (api.db_router)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -72,6 +74,16 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'imdb_api.urls'
 
+# заголовок Server-Timing с временем запроса, БД, сериализации и результатом кэша
+METRICS_SERVER_TIMING = strtobool(os.getenv('METRICS_SERVER_TIMING', 'no'))
+# адреса и подсети, с которых доступен /metrics/ (через запятую); остальным - только персоналу (is_staff)
+METRICS_ALLOWED_IPS = [
+    value.strip() for value in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if value.strip()
+]
+
+# асинхронные view для чтения произведений, отзывов и комментариев (включается в asgi.py)
+ASYNC_VIEWS = strtobool(os.getenv('ASYNC_VIEWS', 'no'))
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -102,9 +114,37 @@ DATABASES = {
         'PASSWORD': os.getenv('POSTGRES_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # постоянные соединения: открываются один раз на поток, а не на каждый запрос
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
     }
 }
 
+# локальный запуск (в т.ч. тестов) без PostgreSQL: DB_ENGINE=sqlite
+# полнотекстовый поиск в этом случае заменяется поиском подстроки (TitleQuerySet.search)
+if os.getenv('DB_ENGINE') == 'sqlite':
+    DATABASES['default'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+    }
+
+# реплики для чтения: DB_REPLICAS - хосты PostgreSQL (при DB_ENGINE=sqlite - файлы БД) через запятую.
+# В тестах реплики совпадают с default (MIRROR)
+DATABASE_REPLICAS = []
+for number, replica in enumerate(filter(None, os.getenv('DB_REPLICAS', '').split(',')), 1):
+    alias = f'replica_{number}'
+    field = 'NAME' if os.getenv('DB_ENGINE') == 'sqlite' else 'HOST'
+    DATABASES[alias] = {**DATABASES['default'], field: replica.strip(), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['api.db_router.ReplicaRouter']
+# сколько секунд после записи клиент читает с default (read-your-writes)
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
+# cookie, по которой закрепляется анонимный клиент без сессии
+REPLICA_PIN_COOKIE = 'replica_pin'
+# при большем отставании (секунды) реплика не используется
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 2))
+REPLICA_LAG_CHECK_INTERVAL = 1  # как часто процесс измеряет отставание реплики
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -162,17 +202,29 @@ AUTH_USER_MODEL = 'users.User'
 EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
 
+# письма отправляются пакетами из очереди исходящих (api.utils.send_email):
+# размер пакета, время накопления пакета (секунды) и лимит писем на домен получателя (писем, секунд)
+EMAIL_BATCH_SIZE = int(os.getenv('EMAIL_BATCH_SIZE', 100))
+EMAIL_BATCH_DELAY = int(os.getenv('EMAIL_BATCH_DELAY', 1))
+EMAIL_DOMAIN_RATE_LIMIT = (int(os.getenv('EMAIL_DOMAIN_RATE_LIMIT', 100)), 60)
+EMAIL_DOMAIN_RATE_LIMITS = {}  # лимиты отдельных доменов, например {'gmail.com': (500, 60)}
+# повторы при ошибке почтового сервера: задержка 2, 4, 8... секунд, но не больше EMAIL_RETRY_BACKOFF_MAX
+EMAIL_MAX_RETRIES = 10
+EMAIL_RETRY_BACKOFF = 2
+EMAIL_RETRY_BACKOFF_MAX = 600
+
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.IsAuthenticated',
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',  # обычный токен
-        'rest_framework_simplejwt.authentication.JWTAuthentication',  # jwt токен
+        # пользователь и токен - из кэша процесса и Redis (api/utils/reference_cache.py), без запросов к БД
+        'api.authentication.CachedTokenAuthentication',  # обычный токен
+        'api.authentication.CachedJWTAuthentication',  # jwt токен
     ],
 
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.CachedCountPagination',
     'PAGE_SIZE': 100,
 
     # лимит запросов для авторизованных и неавторизованных пользователей
@@ -229,19 +281,64 @@ LOGGING = {
     },
 }
 
+# проверка постоянных соединений с БД после простоя (api.utils.pools.check_connections).
+# Django 3.2 не знает ключа CONN_HEALTH_CHECKS в DATABASES: после перехода на Django 4.1
+# заменить на него эту настройку и check_connections
+DB_CONN_HEALTH_CHECKS = strtobool(os.getenv('DB_CONN_HEALTH_CHECKS', 'yes'))
+# простой соединения с БД (секунды), после которого оно проверяется перед запросом
+DB_HEALTH_CHECK_IDLE = int(os.getenv('DB_HEALTH_CHECK_IDLE', 30))
+
 REDIS_HOST = os.getenv('REDIS_HOST')
 REDIS_PORT = os.getenv('REDIS_PORT')
+REDIS_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+
+# общий пул соединений Redis процесса (кэш, результаты Celery): размер и ожидание свободного соединения
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 5))
+REDIS_POOL_KWARGS = {
+    'max_connections': REDIS_MAX_CONNECTIONS,
+    'timeout': REDIS_POOL_TIMEOUT,
+    'health_check_interval': 30,
+    'socket_keepalive': True,
+}
 
-CELERY_BROKER_URL = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
-CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 3600}
-CELERY_RESULT_BACKEND = f'redis://{REDIS_HOST}:{REDIS_PORT}/0'
+# CELERY_BROKER_URL=memory:// - брокер в памяти процесса для тестов очереди писем
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', REDIS_URL)
+# соединения брокера kombu использует свои (отдельный тип соединения для опроса очередей), но тоже ограничено
+CELERY_BROKER_POOL_LIMIT = int(os.getenv('CELERY_BROKER_POOL_LIMIT', 10))
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'visibility_timeout': 3600,
+    'max_connections': CELERY_BROKER_POOL_LIMIT,
+    'health_check_interval': 30,
+}
+# бэкенд результатов берет соединения из пула кэша
+CELERY_RESULT_BACKEND = f'api.utils.pools:SharedPoolRedisBackend+{REDIS_URL}'
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# отдельная очередь почты (воркер: celery -A imdb_api worker -Q email), чтобы всплеск регистраций
+# не задерживал остальные задачи и наоборот
+CELERY_TASK_ROUTES = {
+    'api.tasks.send_email_task': {'queue': 'email'},
+    'api.tasks.flush_email_outbox': {'queue': 'email'},
+}
 
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
-        "LOCATION": f"redis://{REDIS_HOST}:{REDIS_PORT}/0",
+        "LOCATION": REDIS_URL,
+        "OPTIONS": {
+            "CONNECTION_POOL_CLASS": "api.utils.pools.InstrumentedConnectionPool",
+            "CONNECTION_POOL_KWARGS": REDIS_POOL_KWARGS,
+        },
     }
 }
+
+# период полураспада веса отзыва в рейтинге trending (секунды)
+RANKING_TRENDING_HALF_LIFE = int(os.getenv('RANKING_TRENDING_HALF_LIFE', 7 * 24 * 60 * 60))
+
+# списки произведений, отзывов и комментариев читаются через values_list и рендерятся orjson (ValuesListMixin)
+VALUES_SERIALIZATION = strtobool(os.getenv('VALUES_SERIALIZATION', 'yes'))
+
+# пересчет устаревших ответов cache_response в задаче Celery вместо запроса пользователя
+CACHE_REFRESH_IN_BACKGROUND = strtobool(os.getenv('CACHE_REFRESH_IN_BACKGROUND', 'no'))
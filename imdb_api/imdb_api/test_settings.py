@@ -0,0 +1,17 @@
+"""
+Настройки для запуска тестов: python manage.py test --settings=imdb_api.test_settings
+"""
+import os
+from .settings import *  # noqa: F401,F403
+from .settings import BASE_DIR, DATABASES
+
+# отдельная БД без репликации, заменяющая реплику в тестах маршрутизации (api.tests.ReplicaRoutingTest);
+# для PostgreSQL - имя БД в DB_REPLICA_STANDIN
+default = DATABASES['default']
+if default['ENGINE'] == 'django.db.backends.sqlite3':
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db_replica.sqlite3'),
+    }
+else:
+    DATABASES['replica'] = {**default, 'NAME': os.getenv('DB_REPLICA_STANDIN', f'{default["NAME"]}_replica')}
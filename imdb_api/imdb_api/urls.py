@@ -16,6 +16,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView
+from api.metrics import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -24,6 +25,8 @@ urlpatterns = [
     path('api-auth/', include('rest_framework.urls')),
     # api doc
     path('redoc/', TemplateView.as_view(template_name='redoc.html'), name='redoc'),
+    # metrics
+    path('metrics/', metrics_view),
     # auth
     path('auth/', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),  # обычный токен